@@ -0,0 +1,294 @@
+# -*- coding: UTF-8 -*-
+
+'''
+asyncio API of Model2SAS, for embedding in an event loop based service
+
+genPoints and calcSas of many projects can run at the same time on one
+worker pool. Each request runs its model2sas method in a driver thread,
+and the heavy parts (lattice chunks of voxelization, q slices of intensity)
+are sent to the shared pool by a scheduler in the event loop, taking the
+requests in turn, so that a long request does not hold back short ones.
+
+Usage:
+    async with AsyncService.service(backend='process', proc_num=8) as svc:
+        handle = await svc.genPoints(project, grid_num=20000)
+        await handle
+        project.setupData()
+
+        handle = await svc.calcSas(project, 0.01, 1, qnum=200, lmax=50)
+        async for index, I_slice in handle:     # partial results, index in q
+            ...
+        q, I = await handle
+
+    handle.cancel() stops a request, slices not started are dropped. Slices
+    already running in worker processes finish, but are discarded.
+
+A project should only have one request running at a time.
+'''
+
+import asyncio
+import threading
+import collections
+from multiprocessing import Pool, cpu_count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from Functions import executor
+
+
+class _scheduler:
+    ''' Runs calls of several requests on one pool, taking requests in turn
+    Only used in the thread of the event loop.
+    '''
+
+    def __init__(self, loop, backend, proc_num, pool):
+        self.loop = loop
+        self.backend = backend
+        self.proc_num = proc_num
+        self.pool = pool
+        self.pending = collections.OrderedDict()    # request -> deque of (func, args, future)
+        self.running = 0
+        if backend == 'broker':
+            # a broker call blocks until its task is done
+            self.broker_threads = ThreadPoolExecutor(max_workers=proc_num)
+
+    async def run(self, request, func, args):
+        future = self.loop.create_future()
+        self.pending.setdefault(request, collections.deque()).append((func, args, future))
+        self._dispatch()
+        # if the caller is cancelled, future is cancelled too and skipped by _next
+        return await future
+
+    def cancelRequest(self, request):
+        for func, args, future in self.pending.pop(request, ()):
+            future.cancel()
+
+    def _next(self):
+        # round robin: the request served is moved to the end
+        for i in range(len(self.pending)):
+            request, queue = self.pending.popitem(last=False)
+            while queue and queue[0][2].done():
+                queue.popleft()
+            if queue:
+                entry = queue.popleft()
+                if queue:
+                    self.pending[request] = queue
+                return entry
+        return None
+
+    def _dispatch(self):
+        while self.running < self.proc_num:
+            entry = self._next()
+            if entry is None:
+                return
+            self.running += 1
+            self._start(*entry)
+
+    def _start(self, func, args, future):
+        def finish(result, error):
+            self.running -= 1
+            if not future.done():
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            self._dispatch()
+        def finishThreadsafe(result, error=None):
+            try:
+                self.loop.call_soon_threadsafe(finish, result, error)
+            except RuntimeError:
+                # loop closed, the request is gone with it
+                pass
+        def finishFuture(concurrent_future):
+            error = concurrent_future.exception()
+            finishThreadsafe(None if error else concurrent_future.result(), error)
+
+        if self.backend == 'process':
+            self.pool.apply_async(func, args, callback=finishThreadsafe, error_callback=lambda error: finishThreadsafe(None, error))
+        elif self.backend == 'thread':
+            self.pool.submit(func, *args).add_done_callback(finishFuture)
+        else:
+            self.broker_threads.submit(lambda: self.pool.starmap(func, [args])[0]).add_done_callback(finishFuture)
+
+
+class _requestExecutor(executor):
+    ''' Executor given to model2sas methods in the driver thread of a
+    request, its calls go through the scheduler of the service
+    '''
+
+    def __init__(self, scheduler, request):
+        self.backend = scheduler.backend
+        self.proc_num = scheduler.proc_num
+        self.pool = scheduler.pool
+        self.own_pool = False
+        self.scheduler = scheduler
+        self.request = request
+
+    def _submit(self, func, args):
+        return asyncio.run_coroutine_threadsafe(self.scheduler.run(self.request, func, args), self.scheduler.loop)
+
+    def starmap(self, func, args_list):
+        futures = [self._submit(func, args) for args in args_list]
+        return [future.result() for future in futures]
+
+    def imapUnordered(self, func, args_list, cancel=None, poll_interval=0.2):
+        pending = {self._submit(func, args) for args in args_list}
+        try:
+            while pending:
+                done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if not future.cancelled():
+                        yield future.result()
+                if cancel is not None and cancel.is_set():
+                    return
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class handle:
+    ''' Awaitable handle of a request
+
+        result = await handle
+        async for item in handle: ...   partial results as they come
+        handle.cancel()
+
+    Attributes:
+        progress: (done, total) of the partial results
+        cancel_event: threading.Event, set when cancelled
+    '''
+    _end = object()
+
+    def __init__(self, service):
+        self._service = service
+        self._loop = service.loop
+        self._queue = asyncio.Queue()
+        self.cancel_event = threading.Event()
+        self.progress = (0, 0)
+        self.executor = _requestExecutor(service.scheduler, self)
+        self._future = None
+
+    def _start(self, func):
+        def drive():
+            try:
+                return func(self)
+            finally:
+                self._push(handle._end)
+        self._future = self._loop.run_in_executor(self._service.driver_threads, drive)
+        # cancelling a task that awaits this handle cancels the request
+        self._future.add_done_callback(lambda future: self.cancel() if future.cancelled() else None)
+
+    def _push(self, item, progress=None):
+        ''' Called in the driver thread '''
+        def put():
+            if progress is not None:
+                self.progress = progress
+            self._queue.put_nowait(item)
+        self._loop.call_soon_threadsafe(put)
+
+    def __await__(self):
+        return self._future.__await__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        item = await self._queue.get()
+        if item is handle._end:
+            # stay at the end for another iteration
+            self._queue.put_nowait(item)
+            raise StopAsyncIteration
+        return item
+
+    def cancel(self):
+        self.cancel_event.set()
+        self._service.scheduler.cancelRequest(self)
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def done(self):
+        return self._future.done()
+
+
+class service:
+    ''' Shared worker pool for async requests
+
+    Args:
+        backend: 'process' | 'thread' | 'broker', see Functions.executor
+        proc_num: processes or threads of the pool, or calls running at the
+            same time on a broker. Default from cpu_usage.
+        pool: external multiprocessing.Pool, ThreadPoolExecutor or
+            Broker.broker, otherwise a pool is created and closed with
+            the service
+        max_requests: requests with a running driver thread, more requests
+            wait for a free one
+    '''
+
+    def __init__(self, backend='process', proc_num=None, cpu_usage=0.6, pool=None, max_requests=32):
+        if backend not in ('process', 'thread', 'broker'):
+            raise ValueError('backend should be process, thread or broker')
+        if backend == 'broker' and pool is None:
+            raise ValueError('broker backend needs a Broker.broker as pool')
+        self.backend = backend
+        self.proc_num = int(proc_num) if proc_num else max(1, round(cpu_usage*cpu_count()))
+        self.own_pool = pool is None
+        if pool is None:
+            pool = Pool(processes=self.proc_num) if backend == 'process' else ThreadPoolExecutor(max_workers=self.proc_num)
+        self.pool = pool
+        self.driver_threads = ThreadPoolExecutor(max_workers=max_requests)
+        self.loop = None
+        self.scheduler = None
+
+    def _handle(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+            self.scheduler = _scheduler(self.loop, self.backend, self.proc_num, self.pool)
+        return handle(self)
+
+    async def genPoints(self, project, **kwargs):
+        ''' model2sas.genPoints as a request
+        Items of async for are (name, i, n, done, total), see model.genPoints.
+        Result is True, or False if cancelled.
+        '''
+        request = self._handle()
+        def run(request):
+            def progress(*item):
+                request._push(item, progress=item[3:])
+            return project.genPoints(progress=progress, cancel=request.cancel_event, pool_executor=request.executor, **kwargs)
+        request._start(run)
+        return request
+
+    async def calcSas(self, project, qmin, qmax, **kwargs):
+        ''' model2sas.calcSas as a request, project.setupData() must be done
+        Items of async for are (index, I_slice), index is the index in q.
+        Result is (q, I), I is nan where q is not finished when cancelled.
+        '''
+        request = self._handle()
+        def run(request):
+            finished = [0]
+            qnum = kwargs.get('qnum', 200)
+            def callback(index, I_slice):
+                finished[0] += index.size
+                request._push((index, I_slice), progress=(finished[0], qnum))
+            project.calcSas(qmin, qmax, pool=request.executor, callback=callback, cancel=request.cancel_event, **kwargs)
+            return project.q, project.I
+        request._start(run)
+        return request
+
+    def close(self):
+        self.driver_threads.shutdown(wait=False, cancel_futures=True)
+        if self.backend == 'broker' and self.scheduler is not None:
+            self.scheduler.broker_threads.shutdown(wait=False, cancel_futures=True)
+        if self.own_pool:
+            if self.backend == 'process':
+                self.pool.terminate()
+                self.pool.join()
+            else:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+        return False
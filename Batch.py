@@ -0,0 +1,193 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Headless batch runner, no GUI module is imported.
+
+Usage:
+    python Batch.py jobs.json -o results --proc-num 8
+
+Job file (json):
+{
+    "jobs": [
+        {
+            "name": "torus",
+            "priority": 0,
+            "models": [
+                {"file": "models/torus.stl", "sld": 1},
+                {"file": "models/hollow_sphere.py"},
+                {"shape": "(r >= R1) & (r <= R2)", "sld": "15", "coord": "sph",
+                 "params": {"R1": 10, "R2": 15},
+                 "boundary_min": [-15, -15, -15], "boundary_max": [15, 15, 15]}
+            ],
+            "interval": null,
+            "grid_num": 10000,
+            "qmin": 0.01, "qmax": 1, "qnum": 200, "logq": false,
+            "lmax": 50,
+            "engine": "direct",
+            "tol": 0.01,
+            "backend": "process",
+            "checkpoint": "checkpoints"
+        }
+    ]
+}
+
+    priority: smaller runs earlier, default 0
+    interval: lattice interval, or null to use grid_num
+    engine: 'direct' | 'coarse' | 'adaptive' | 'auto'
+    tol: relative error target of 'auto' engine, grid_num and lmax are
+        chosen by model2sas.autoTune
+    backend: optional, 'process' | 'thread' | 'serial'
+    checkpoint: optional, directory to resume interrupted calculation
+
+Results of each job are written to <output>/<name>.npz (q, I, error),
+and <output>/summary.json records status and timings of every job.
+'''
+
+import os
+import sys
+import json
+import math
+import time
+import heapq
+import argparse
+import traceback
+from multiprocessing import Pool, cpu_count
+
+# no display on cluster nodes
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+from Model2SAS import model2sas
+import FileIO
+
+
+def readJobFile(filepath):
+    with open(filepath, 'r') as f:
+        job_file = json.load(f)
+    jobs = job_file['jobs'] if isinstance(job_file, dict) else job_file
+    base_dir = os.path.dirname(os.path.abspath(filepath))
+    for i, job in enumerate(jobs):
+        job.setdefault('name', 'job{}'.format(i))
+        # model file paths are relative to job file
+        for model_info in job['models']:
+            if 'file' in model_info:
+                model_info['file'] = os.path.join(base_dir, model_info['file'])
+    return jobs
+
+
+def runJob(job, pool=None, proc_num=None):
+    ''' Run one job
+
+    Returns:
+        project: model2sas object
+        timings: dict, seconds of each stage
+    '''
+    timings = {}
+    begintime = time.time()
+    project = model2sas(job['name'])
+    for model_info in job['models']:
+        if 'file' in model_info:
+            project.importFile(model_info['file'], sld=model_info.get('sld', 1))
+        else:
+            project.importExpression(
+                model_info['shape'], model_info.get('sld', 1), coord=model_info.get('coord', 'xyz'),
+                params=model_info.get('params'), boundary_min=model_info['boundary_min'],
+                boundary_max=model_info['boundary_max'], name=model_info.get('name', 'expression model'))
+    timings['import'] = time.time() - begintime
+
+    engine = job.get('engine', 'direct')
+    if engine == 'auto':
+        timestamp = time.time()
+        project.autoTune(
+            job['qmin'], job['qmax'], tol=job.get('tol', 0.01), qnum=job.get('qnum', 200),
+            logq=job.get('logq', False), proc_num=proc_num, pool=pool, run=True)
+        timings['calcSas'] = time.time() - timestamp
+        timings['total'] = time.time() - begintime
+        return project, timings
+
+    timestamp = time.time()
+    project.genPoints(interval=job.get('interval'), grid_num=job.get('grid_num', 10000))
+    project.setupData()
+    timings['genPoints'] = time.time() - timestamp
+
+    timestamp = time.time()
+    backend = job.get('backend', 'process')
+    project.calcSas(
+        job['qmin'], job['qmax'], qnum=job.get('qnum', 200), logq=job.get('logq', False),
+        lmax=job.get('lmax', 50), adaptive=(engine == 'adaptive'),
+        coarse_grain=(engine == 'coarse'), proc_num=proc_num,
+        pool=pool if backend == 'process' else None,   # shared pool is a process pool
+        checkpoint=job.get('checkpoint'), backend=backend)
+    timings['calcSas'] = time.time() - timestamp
+    timings['total'] = time.time() - begintime
+    return project, timings
+
+
+def jsonSafe(obj):
+    ''' Convert nan/inf floats (e.g. error of unconverged autoTune) to None,
+    so that summary is strict json
+    '''
+    if isinstance(obj, dict):
+        return {key: jsonSafe(value) for key, value in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return [jsonSafe(value) for value in obj]
+    elif isinstance(obj, float) and not math.isfinite(obj):
+        return None
+    else:
+        return obj
+
+
+def runBatch(jobs, output_dir, proc_num=None, cpu_usage=0.6):
+    ''' Run jobs in order of priority through one shared process pool
+    A failed job is recorded in summary and does not stop the others.
+
+    Returns:
+        summary: list of dict
+    '''
+    if proc_num:
+        proc_num = int(proc_num)
+    else:
+        proc_num = max(1, round(cpu_usage*cpu_count()))
+    os.makedirs(output_dir, exist_ok=True)
+
+    queue = []
+    for order, job in enumerate(jobs):
+        heapq.heappush(queue, (job.get('priority', 0), order, job))
+
+    summary = []
+    summary_file = os.path.join(output_dir, 'summary.json')
+    with Pool(processes=proc_num) as pool:
+        while queue:
+            priority, order, job = heapq.heappop(queue)
+            record = {'name': job['name'], 'priority': priority}
+            print('run job {} (priority {})'.format(job['name'], priority))
+            try:
+                project, timings = runJob(job, pool=pool, proc_num=proc_num)
+                output = os.path.join(output_dir, '{}.npz'.format(job['name']))
+                FileIO.saveSasData(output, project.q, project.I, project.data.error)
+                record.update({'status': 'done', 'output': output, 'points': int(project.points_with_sld.shape[0]), 'qnum': int(project.q.size), 'timings': timings})
+                if hasattr(project, 'tuned_settings'):
+                    record['settings'] = project.tuned_settings
+            except Exception:
+                record.update({'status': 'failed', 'error': traceback.format_exc()})
+                print(record['error'])
+            summary.append(record)
+            # write summary after every job, so partial progress is visible
+            with open(summary_file, 'w') as f:
+                json.dump(jsonSafe(summary), f, indent=2, allow_nan=False)
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run Model2SAS calculation jobs without GUI')
+    parser.add_argument('jobfile', help='json job file')
+    parser.add_argument('-o', '--output', default='results', help='output directory')
+    parser.add_argument('--proc-num', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--cpu-usage', type=float, default=0.6, help='used if proc-num is not given')
+    args = parser.parse_args()
+
+    jobs = readJobFile(args.jobfile)
+    summary = runBatch(jobs, args.output, proc_num=args.proc_num, cpu_usage=args.cpu_usage)
+    n_failed = sum(record['status'] == 'failed' for record in summary)
+    for record in summary:
+        print('{:<20} {:<8} {}'.format(record['name'], record['status'], round(record.get('timings', {}).get('total', 0), 2)))
+    sys.exit(1 if n_failed else 0)
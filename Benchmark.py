@@ -0,0 +1,419 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Benchmark and accuracy suite with analytic reference shapes
+
+Sphere, core-shell sphere, cylinder and torus are built both as expression
+(math) models and as generated stl files. For every combination of
+grid_num (number of points), lmax and qnum, the voxelization and the SAS
+calculation are timed, peak memory is taken from Instrument, and the
+intensity is compared with the analytic orientation averaged form factor.
+
+Usage:
+    python Benchmark.py -o result.json                      # run and save
+    python Benchmark.py --quick --baseline baseline.json    # compare with baseline
+    python Benchmark.py --models sphere torus_stl --grid-num 5000 20000 --lmax 20 40
+    python Benchmark.py --quick --grid-num 2000 50000 --backends process thread serial
+
+A case is reported as regression if its time exceeds the baseline by more
+than --time-threshold (relative), or its error exceeds the baseline by more
+than --error-threshold (relative). Exit code is 1 if any regression is found.
+
+Startup check (for batch workers):
+    python Benchmark.py --import-time --import-budget 0.5
+imports Model2SAS in a fresh interpreter, and fails if it takes longer than
+the budget (sec) or pulls in plotting / GUI / heavy optional modules.
+
+Octree check:
+    python Benchmark.py --octree-check
+compares the total weight of octree points of a thin hollow sphere (shell
+thinner than the coarse octree cells) with the voxel number of the uniform
+grid, for octree_levels 1 to 3. Exit code is 1 if any differs by more
+than 1%.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from multiprocessing import Pool, cpu_count
+
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import numpy as np
+from scipy.special import jv
+from stl import mesh
+
+from Model2SAS import model2sas
+from Functions import sphereAmplitude
+import Instrument
+
+
+QMIN, QMAX = 0.01, 1.0
+
+
+########## analytic references ##########
+# all amplitudes are normalized to 1 at q=0
+
+def _gaussLegendre(n, a, b):
+    x, w = np.polynomial.legendre.leggauss(n)
+    return 0.5*(b-a)*x + 0.5*(b+a), 0.5*(b-a)*w
+
+
+def sphereReference(q, R):
+    return sphereAmplitude(q, R)**2
+
+
+def coreShellReference(q, R1, R2, rho1, rho2):
+    V1, V2 = 4/3*np.pi*R1**3, 4/3*np.pi*R2**3
+    F = (rho1-rho2)*V1*sphereAmplitude(q, R1) + rho2*V2*sphereAmplitude(q, R2)
+    F0 = (rho1-rho2)*V1 + rho2*V2
+    return (F/F0)**2
+
+
+def cylinderReference(q, R, L, n_angle=200):
+    ''' u = cos(alpha), alpha is the angle between q and cylinder axis '''
+    u, w = _gaussLegendre(n_angle, 0, 1)
+    q = np.asarray(q, dtype='float64').reshape(-1, 1)
+    x = q * R * np.sqrt(1 - u**2)
+    y = q * L * u / 2
+    x = np.where(x < 1e-8, 1e-8, x)
+    y = np.where(y < 1e-8, 1e-8, y)
+    F = 2*jv(1, x)/x * np.sin(y)/y
+    return np.sum(F**2 * w, axis=-1)
+
+
+def torusReference(q, R, a, n_angle=64, n_s=24, n_psi=48):
+    ''' Torus as a solid of revolution around z with circular cross-section
+    F(qr, qz) = integral of 2*pi*r*J0(qr*r)*cos(qz*z) over the cross-section,
+    the cross-section is integrated in polar coordinates (s, psi) around its
+    center, and the orientation average is taken over u = cos(alpha).
+    '''
+    u, wu = _gaussLegendre(n_angle, 0, 1)
+    s, ws = _gaussLegendre(n_s, 0, a)
+    psi = np.linspace(0, 2*np.pi, num=n_psi, endpoint=False)
+    s_ext, psi_ext = np.meshgrid(s, psi, indexing='ij')
+    r = (R + s_ext*np.cos(psi_ext)).reshape(-1)
+    z = (s_ext*np.sin(psi_ext)).reshape(-1)
+    weight = (2*np.pi * r * s_ext.reshape(-1) * np.repeat(ws, n_psi) * 2*np.pi/n_psi)
+    V = np.sum(weight)
+    P = np.zeros(np.size(q))
+    for i, qi in enumerate(np.asarray(q, dtype='float64').reshape(-1)):
+        qr = (qi * np.sqrt(1 - u**2)).reshape(-1, 1)
+        qz = (qi * u).reshape(-1, 1)
+        F = np.sum(weight * jv(0, qr*r) * np.cos(qz*z), axis=-1) / V
+        P[i] = np.sum(F**2 * wu)
+    return P
+
+
+########## generated stl ##########
+
+def revolutionMesh(profile_r, profile_z, n_phi=96):
+    ''' Triangle mesh of a surface of revolution around z axis
+    The profile is a polyline in (r, z) plane. Use a closed profile
+    (last point == first point) for a torus, and a profile ending on the
+    axis (r == 0) for sphere or cylinder.
+    '''
+    profile_r, profile_z = np.asarray(profile_r, dtype='float64'), np.asarray(profile_z, dtype='float64')
+    phi = np.linspace(0, 2*np.pi, num=n_phi+1)
+    r_grid, phi_grid = np.meshgrid(profile_r, phi, indexing='ij')
+    z_grid = np.meshgrid(profile_z, phi, indexing='ij')[0]
+    vertices = np.stack((r_grid*np.cos(phi_grid), r_grid*np.sin(phi_grid), z_grid), axis=-1)
+    v00, v01 = vertices[:-1, :-1], vertices[:-1, 1:]
+    v10, v11 = vertices[1:, :-1], vertices[1:, 1:]
+    triangles = np.vstack((
+        np.stack((v00, v10, v11), axis=-2).reshape(-1, 3, 3),
+        np.stack((v00, v11, v01), axis=-2).reshape(-1, 3, 3),
+    ))
+    stl_mesh = mesh.Mesh(np.zeros(triangles.shape[0], dtype=mesh.Mesh.dtype))
+    stl_mesh.vectors = triangles
+    return stl_mesh
+
+
+def sphereStl(filepath, R, n=64):
+    theta = np.linspace(np.pi, 0, num=n+1)
+    revolutionMesh(R*np.sin(theta), R*np.cos(theta), n_phi=2*n).save(filepath)
+
+
+def cylinderStl(filepath, R, L, n=96):
+    revolutionMesh([0, R, R, 0], [-L/2, -L/2, L/2, L/2], n_phi=n).save(filepath)
+
+
+def torusStl(filepath, R, a, n=48):
+    psi = np.linspace(0, 2*np.pi, num=n+1)
+    revolutionMesh(R + a*np.cos(psi), a*np.sin(psi), n_phi=2*n).save(filepath)
+
+
+########## models ##########
+
+SPHERE = {'R': 10}
+CORESHELL = {'R1': 6, 'R2': 10, 'rho1': 2, 'rho2': 1}
+CYLINDER = {'R': 5, 'L': 20}
+TORUS = {'R': 8, 'a': 3}
+
+
+def _buildSphere(project, stl_dir):
+    R = SPHERE['R']
+    project.importExpression('r <= R', '1', coord='sph', params=SPHERE, boundary_min=[-R]*3, boundary_max=[R]*3, name='sphere')
+
+def _buildCoreShell(project, stl_dir):
+    R2 = CORESHELL['R2']
+    project.importExpression('r <= R2', 'where(r <= R1, rho1, rho2)', coord='sph', params=CORESHELL, boundary_min=[-R2]*3, boundary_max=[R2]*3, name='coreshell')
+
+def _buildCylinder(project, stl_dir):
+    R, L = CYLINDER['R'], CYLINDER['L']
+    project.importExpression('(rho <= R) & (abs(z) <= L/2)', '1', coord='cyl', params=CYLINDER, boundary_min=[-R, -R, -L/2], boundary_max=[R, R, L/2], name='cylinder')
+
+def _buildTorus(project, stl_dir):
+    R, a = TORUS['R'], TORUS['a']
+    project.importExpression('(sqrt(x**2 + y**2) - R)**2 + z**2 <= a**2', '1', coord='xyz', params=TORUS, boundary_min=[-R-a, -R-a, -a], boundary_max=[R+a, R+a, a], name='torus')
+
+def _buildSphereStl(project, stl_dir):
+    filepath = os.path.join(stl_dir, 'sphere.stl')
+    sphereStl(filepath, SPHERE['R'])
+    project.importFile(filepath, sld=1)
+
+def _buildCoreShellStl(project, stl_dir):
+    # sld of overlapping sections is combined by maximum, so core wins if rho1 > rho2
+    core, shell = os.path.join(stl_dir, 'core.stl'), os.path.join(stl_dir, 'shell.stl')
+    sphereStl(core, CORESHELL['R1'])
+    sphereStl(shell, CORESHELL['R2'])
+    project.importFile(core, sld=CORESHELL['rho1'])
+    project.importFile(shell, sld=CORESHELL['rho2'])
+
+def _buildCylinderStl(project, stl_dir):
+    filepath = os.path.join(stl_dir, 'cylinder.stl')
+    cylinderStl(filepath, CYLINDER['R'], CYLINDER['L'])
+    project.importFile(filepath, sld=1)
+
+def _buildTorusStl(project, stl_dir):
+    filepath = os.path.join(stl_dir, 'torus.stl')
+    torusStl(filepath, TORUS['R'], TORUS['a'])
+    project.importFile(filepath, sld=1)
+
+
+# name: (build function, reference function)
+MODELS = {
+    'sphere': (_buildSphere, lambda q: sphereReference(q, **SPHERE)),
+    'coreshell': (_buildCoreShell, lambda q: coreShellReference(q, **CORESHELL)),
+    'cylinder': (_buildCylinder, lambda q: cylinderReference(q, **CYLINDER)),
+    'torus': (_buildTorus, lambda q: torusReference(q, **TORUS)),
+    'sphere_stl': (_buildSphereStl, lambda q: sphereReference(q, **SPHERE)),
+    'coreshell_stl': (_buildCoreShellStl, lambda q: coreShellReference(q, **CORESHELL)),
+    'cylinder_stl': (_buildCylinderStl, lambda q: cylinderReference(q, **CYLINDER)),
+    'torus_stl': (_buildTorusStl, lambda q: torusReference(q, **TORUS)),
+}
+
+
+########## run ##########
+
+def relativeError(I, I_ref):
+    ''' Median and 90th percentile of |I/I_ref - 1|
+    Percentiles are used since relative error is huge near the minima
+    of the form factor.
+    '''
+    relative = np.abs(I / I_ref - 1)
+    return float(np.median(relative)), float(np.percentile(relative, 90))
+
+
+def caseKey(case):
+    key = '{}|grid_num={}|lmax={}|qnum={}'.format(case['model'], case['grid_num'], case['lmax'], case['qnum'])
+    # default backend is left out, so that keys of older baselines still match
+    backend = case.get('backend', 'process')
+    return key if backend == 'process' else key + '|backend={}'.format(backend)
+
+
+def _peakRss(report):
+    values = [record['peak_rss'] for record in report['stages'].values() if record['peak_rss'] is not None]
+    for records in report['workers'].values():
+        values += [record['peak_rss'] for record in records.values() if record['peak_rss'] is not None]
+    return max(values, default=None)
+
+
+def runCase(model_name, grid_num, lmax, qnum, stl_dir, pool=None, proc_num=None, backend='process'):
+    ''' Run one benchmark case
+
+    Returns:
+        dict, with time of genPoints and calcSas (sec), peak_rss (MB),
+        points number and error (median and 90th percentile)
+    '''
+    build, reference = MODELS[model_name]
+    Instrument.enable()
+    Instrument.reset()
+
+    # the whole case is a stage too, so that the peak rss sampled
+    # also covers the work between the finer stages
+    with Instrument.stage('benchmark.case'):
+        project = model2sas(model_name)
+        build(project, stl_dir)
+        begintime = time.perf_counter()
+        project.genPoints(grid_num=grid_num)
+        project.setupData()
+        time_genPoints = time.perf_counter() - begintime
+
+        begintime = time.perf_counter()
+        project.calcSas(QMIN, QMAX, qnum=qnum, lmax=lmax, proc_num=proc_num, pool=pool if backend == 'process' else None, backend=backend)
+        time_calcSas = time.perf_counter() - begintime
+
+    # I(0) = 4*pi*(sum of sld)^2 in this program, so the reference is
+    # scaled by the sld sum of the points model itself
+    q = np.asarray(project.q, dtype='float64')
+    slds = project.points_with_sld[:, 3]
+    I_ref = 4*np.pi * np.sum(slds)**2 * reference(q)
+    error, error_p90 = relativeError(np.asarray(project.I, dtype='float64'), I_ref)
+
+    result = {
+        'model': model_name, 'grid_num': grid_num, 'lmax': lmax, 'qnum': qnum, 'backend': backend,
+        'points': int(project.points_with_sld.shape[0]),
+        'time_genPoints': time_genPoints,
+        'time_calcSas': time_calcSas,
+        'time': time_genPoints + time_calcSas,
+        'peak_rss': _peakRss(Instrument.report()),
+        'error': error,
+        'error_p90': error_p90,
+    }
+    Instrument.enable(False)
+    return result
+
+
+def runSuite(model_names, grid_num_list, lmax_list, qnum_list, proc_num=None, repeat=1, backend_list=('process',)):
+    ''' Run all combinations, time of each case is the minimum of repeats
+    The process backend uses one pool shared by all cases, so its time
+    includes pickling of points but not process startup.
+    '''
+    if not proc_num:
+        proc_num = max(1, round(0.6*cpu_count()))
+    results = []
+    with tempfile.TemporaryDirectory() as stl_dir, Pool(processes=proc_num) as pool:
+        for model_name in model_names:
+            for grid_num in grid_num_list:
+                for lmax in lmax_list:
+                    for qnum in qnum_list:
+                        for backend in backend_list:
+                            runs = [runCase(model_name, grid_num, lmax, qnum, stl_dir, pool=pool, proc_num=proc_num, backend=backend) for i in range(repeat)]
+                            result = min(runs, key=lambda run: run['time'])
+                            results.append(result)
+                            print('{:<75} points={:<7} time={:<8.3f} calcSas={:<8.3f} rss={:<8} error={:.4f}'.format(
+                                caseKey(result), result['points'], result['time'], result['time_calcSas'],
+                                'none' if result['peak_rss'] is None else round(result['peak_rss'], 1), result['error']))
+    return {
+        'environment': {
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpu_count': cpu_count(), 'proc_num': proc_num,
+        },
+        'results': results,
+    }
+
+
+def compareBaseline(suite, baseline, time_threshold=0.25, error_threshold=0.1, error_floor=1e-3):
+    ''' Compare results with a baseline run
+    error_floor is an absolute tolerance, so that tiny errors of an exact
+    model do not turn into large relative changes.
+
+    Returns:
+        list of str, description of every regression
+    '''
+    baseline_results = {caseKey(result): result for result in baseline['results']}
+    regressions = []
+    for result in suite['results']:
+        key = caseKey(result)
+        if key not in baseline_results:
+            continue
+        base = baseline_results[key]
+        if result['time'] > base['time'] * (1 + time_threshold):
+            regressions.append('{}: time {:.3f}s -> {:.3f}s'.format(key, base['time'], result['time']))
+        if result['error'] > base['error'] * (1 + error_threshold) + error_floor:
+            regressions.append('{}: error {:.4f} -> {:.4f}'.format(key, base['error'], result['error']))
+    return regressions
+
+
+########## startup ##########
+
+# not needed by headless calculation, imported only on first use
+HEAVY_MODULES = ('matplotlib', 'mpl_toolkits', 'stl', 'scipy', 'p_tqdm', 'pathos', 'Plot', 'PyQt5')
+
+
+def importTime(module='Model2SAS', repeat=5):
+    ''' Import time of module in a fresh interpreter
+
+    Returns:
+        seconds: float, minimum of repeats
+        heavy: list of str, modules in HEAVY_MODULES that were imported
+    '''
+    code = 'import sys, time; t = time.perf_counter(); import {}; print(time.perf_counter() - t); print(",".join(m for m in {} if m in sys.modules))'.format(module, HEAVY_MODULES)
+    seconds = []
+    for i in range(repeat):
+        output = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.split('\n')
+        seconds.append(float(output[0]))
+        heavy = [name for name in output[1].split(',') if name]
+    return min(seconds), heavy
+
+
+########## octree ##########
+
+def octreeCheck(levels_list=(1, 2, 3), interval=0.5, R1=9, R2=10):
+    ''' Thin features must not be lost by coarse octree cells
+
+    Returns:
+        list of (levels, total weight, relative difference to uniform grid)
+    '''
+    from Model2SAS import model2sas
+    project = model2sas('octree check')
+    project.importExpression('(r >= R1) & (r <= R2)', '1', coord='sph', params={'R1': R1, 'R2': R2}, boundary_min=[-R2]*3, boundary_max=[R2]*3)
+    project.genPoints(interval=interval)
+    reference = np.sum(project.points_with_sld[:, 3])
+    results = []
+    for levels in levels_list:
+        project.genPoints(interval=interval, octree=True, octree_levels=levels)
+        weight = np.sum(project.points_with_sld[:, 3])
+        results.append((levels, weight, abs(weight/reference - 1)))
+        print('octree_levels={}: total weight {:.0f}, uniform grid {:.0f}, difference {:.4f}'.format(levels, weight, reference, results[-1][2]))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark speed and accuracy of Model2SAS with analytic shapes')
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--grid-num', nargs='+', type=int, default=[5000, 20000])
+    parser.add_argument('--lmax', nargs='+', type=int, default=[20, 40])
+    parser.add_argument('--qnum', nargs='+', type=int, default=[100])
+    parser.add_argument('--quick', action='store_true', help='one small case for each model')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--proc-num', type=int, default=None, help='processes or threads')
+    parser.add_argument('--backends', nargs='+', default=['process'], choices=['process', 'thread', 'serial'])
+    parser.add_argument('-o', '--output', default=None, help='save results as json, e.g. to be used as baseline')
+    parser.add_argument('--baseline', default=None, help='json saved by a previous run')
+    parser.add_argument('--time-threshold', type=float, default=0.25)
+    parser.add_argument('--error-threshold', type=float, default=0.1)
+    parser.add_argument('--import-time', action='store_true', help='only check import time of Model2SAS')
+    parser.add_argument('--import-budget', type=float, default=0.5, help='sec')
+    parser.add_argument('--octree-check', action='store_true', help='only check octree points of a thin shell')
+    args = parser.parse_args()
+
+    if args.octree_check:
+        sys.exit(1 if any(difference > 0.01 for levels, weight, difference in octreeCheck()) else 0)
+
+    if args.import_time:
+        seconds, heavy = importTime()
+        print('import Model2SAS: {:.3f} s (budget {} s), heavy modules: {}'.format(seconds, args.import_budget, heavy or 'none'))
+        sys.exit(1 if seconds > args.import_budget or heavy else 0)
+
+    if args.quick:
+        args.grid_num, args.lmax, args.qnum = [3000], [15], [40]
+    suite = runSuite(args.models, args.grid_num, args.lmax, args.qnum, proc_num=args.proc_num, repeat=args.repeat, backend_list=args.backends)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(suite, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compareBaseline(suite, baseline, time_threshold=args.time_threshold, error_threshold=args.error_threshold)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        print('{} regression(s) against {}'.format(len(regressions), args.baseline))
+        sys.exit(1 if regressions else 0)
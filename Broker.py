@@ -0,0 +1,505 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Distribute q slices and voxelization chunks to workers on several nodes
+
+A broker is a small TCP server (multiprocessing.managers, authenticated by
+authkey) holding a queue of tasks. Worker processes on any node that has
+this program attach to it, take tasks one by one and send the results
+back. A task that fails is sent again up to max_retries times, and a task
+whose worker is lost (no heartbeat within lease seconds) is given to
+another worker. Results are merged in the order of the tasks.
+
+Large arguments that are the same object in all tasks of a call (points,
+sld, model section, lattice) are stored in the broker only once, and each
+worker fetches them once.
+
+Tasks are pickled callables, so anyone who can connect with the authkey
+can run code on the workers and read the data. Keep the broker on a
+trusted network: bind the address of the internal interface, not
+'0.0.0.0' on a public one. Without an authkey a random one is generated
+and printed when the broker starts.
+
+Usage:
+    # main node
+    import Broker
+    with Broker.broker(address=('10.0.0.1', 50000)) as b:     # prints the authkey
+        project.genPoints(pool_executor=executor('broker', pool=b))
+        project.setupData()
+        project.calcSas(0.01, 1, lmax=50, backend='broker', pool=b)
+
+    # every worker node, one worker process per core by default
+    MODEL2SAS_AUTHKEY=<authkey> python Broker.py worker --address 10.0.0.1:50000
+
+    # everything on one machine: broker, 4 local workers and a check
+    # against the local calculation, one worker fails and one is killed
+    python Broker.py test --workers 4
+
+Math models from .py files are imported again from their file path on the
+workers, so the file must be reachable there at the same path.
+'''
+
+import os
+import sys
+import time
+import uuid
+import socket
+import secrets
+import ipaddress
+import random
+import argparse
+import threading
+import traceback
+import collections
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+
+from Functions import executor
+
+
+########## broker side ##########
+
+class _taskboard:
+    ''' Task queue living in the broker server process
+    Task id is (job, i). All methods are called through proxies from the
+    main node and the workers, each connection in its own server thread.
+    '''
+
+    def __init__(self, lease=60, max_retries=3):
+        self.lease = lease
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.queue = collections.deque()    # waiting task ids
+        self.tasks = {}     # task id -> (func, args), until finished or given up
+        self.leases = {}    # task id -> (worker, deadline)
+        self.attempts = collections.Counter()
+        self.results = collections.defaultdict(dict)    # job -> {i: result}, until collected
+        self.errors = collections.defaultdict(list)     # job -> [str]
+        self.remaining = collections.Counter()          # job -> number of unfinished tasks
+        self.shared = {}    # key -> object
+        self.workers = {}   # worker name -> time last seen
+        self.closed = False
+
+    def submit(self, job, tasks, shared):
+        with self.lock:
+            self.shared.update(shared)
+            for i, (func, args) in enumerate(tasks):
+                self.tasks[(job, i)] = (func, args)
+                self.queue.append((job, i))
+            self.remaining[job] += len(tasks)
+
+    def getShared(self, key):
+        return self.shared[key]
+
+    def _expireLeases(self):
+        now = time.time()
+        for task_id, (worker, deadline) in list(self.leases.items()):
+            if deadline < now:
+                del self.leases[task_id]
+                self._retry(task_id, 'worker {} lost (no heartbeat in {} sec)'.format(worker, self.lease))
+
+    def _retry(self, task_id, error):
+        self.attempts[task_id] += 1
+        if self.attempts[task_id] <= self.max_retries:
+            # retried tasks go first, they hold back the ordered result
+            self.queue.appendleft(task_id)
+        else:
+            job, i = task_id
+            self.errors[job].append('task {} failed {} times, last error:\n{}'.format(i, self.attempts[task_id], error))
+            self._drop(task_id)
+
+    def _drop(self, task_id):
+        self.tasks.pop(task_id, None)
+        self.leases.pop(task_id, None)
+        self.remaining[task_id[0]] -= 1
+
+    def take(self, worker):
+        ''' Next task as (task_id, func, args), None if nothing to do '''
+        with self.lock:
+            self.workers[worker] = time.time()
+            self._expireLeases()
+            while self.queue:
+                task_id = self.queue.popleft()
+                if task_id in self.tasks and task_id not in self.leases:
+                    self.leases[task_id] = (worker, time.time() + self.lease)
+                    func, args = self.tasks[task_id]
+                    return task_id, func, args
+            return None
+
+    def heartbeat(self, worker, task_id):
+        with self.lock:
+            self.workers[worker] = time.time()
+            if task_id in self.leases:
+                self.leases[task_id] = (worker, time.time() + self.lease)
+
+    def finish(self, worker, task_id, result):
+        with self.lock:
+            self.workers[worker] = time.time()
+            # a task given to another worker after lease expiry may finish twice
+            if task_id in self.tasks:
+                self.results[task_id[0]][task_id[1]] = result
+                self._drop(task_id)
+
+    def fail(self, worker, task_id, error):
+        with self.lock:
+            self.workers[worker] = time.time()
+            if task_id in self.tasks:
+                self.leases.pop(task_id, None)
+                self._retry(task_id, error)
+
+    def collect(self, job):
+        ''' Results finished since last call, errors and number of unfinished tasks '''
+        with self.lock:
+            self._expireLeases()
+            results = self.results.pop(job, {})
+            return results, list(self.errors[job]), self.remaining[job]
+
+    def release(self, job):
+        ''' Forget a job, unfinished tasks of it are cancelled '''
+        with self.lock:
+            for task_id in [task_id for task_id in self.tasks if task_id[0] == job]:
+                self._drop(task_id)
+            for key in [key for key in self.shared if key.startswith(job)]:
+                del self.shared[key]
+            for table in (self.results, self.errors, self.remaining):
+                table.pop(job, None)
+
+    def leaseTime(self):
+        return self.lease
+
+    def stats(self):
+        with self.lock:
+            return {'queued': len(self.queue), 'running': len(self.leases), 'retries': sum(self.attempts.values()), 'workers': sorted(self.workers)}
+
+    def workerNum(self):
+        ''' Number of workers seen within one lease '''
+        with self.lock:
+            now = time.time()
+            return sum(1 for seen in self.workers.values() if now - seen < self.lease)
+
+    def close(self):
+        self.closed = True
+
+    def isClosed(self):
+        return self.closed
+
+
+_board = None
+
+def _initBoard(lease, max_retries):
+    global _board
+    _board = _taskboard(lease=lease, max_retries=max_retries)
+
+def _getBoard():
+    return _board
+
+
+class _manager(BaseManager):
+    pass
+
+_manager.register('board', callable=_getBoard)
+
+
+class _shared:
+    ''' Placeholder of an argument stored once in the broker '''
+    def __init__(self, key):
+        self.key = key
+
+
+def _isLoopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+class broker:
+    ''' Broker server and the client used on the main node
+
+    Args:
+        address: (host, port), port 0 picks a free port, see self.address.
+            Use the host address of a trusted network so that workers on
+            other nodes can connect, a warning is printed if it is not
+            a loopback address.
+        authkey: bytes, shared with the workers. Default is a random key
+            printed at start, see self.authkey.
+        lease: sec, a task is given to another worker if its worker sends
+            no heartbeat within lease
+        max_retries: times a failed task is sent again before the call
+            raises RuntimeError
+    '''
+
+    def __init__(self, address=('127.0.0.1', 0), authkey=None, lease=60, max_retries=3):
+        self.address = address
+        self.generated_authkey = authkey is None
+        self.authkey = secrets.token_hex(16).encode() if authkey is None else authkey
+        self.lease = lease
+        self.max_retries = max_retries
+        self.manager = None
+
+    def start(self):
+        self.manager = _manager(address=self.address, authkey=self.authkey)
+        self.manager.start(initializer=_initBoard, initargs=(self.lease, self.max_retries))
+        self.address = self.manager.address
+        self.board = self.manager.board()
+        print('broker listening on {}:{}'.format(*self.address))
+        if self.generated_authkey:
+            print('broker authkey: {}'.format(self.authkey.decode()))
+        if not _isLoopback(self.address[0]):
+            print('warning: broker is reachable from other hosts, tasks are pickled callables, only use it on a trusted network')
+        return self
+
+    def shutdown(self):
+        if self.manager is not None:
+            self.board.close()
+            # give idle workers one poll to notice
+            time.sleep(0.5)
+            self.manager.shutdown()
+            self.manager = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.shutdown()
+        return False
+
+    def workerNum(self):
+        return self.board.workerNum()
+
+    def stats(self):
+        ''' dict, queued and running task number, retries so far and names of workers '''
+        return self.board.stats()
+
+    def _submit(self, func, args_list):
+        ''' Put tasks in the queue, arguments that are the same object in
+        more than one task are stored once as shared
+        '''
+        job = uuid.uuid4().hex
+        count = collections.Counter(id(arg) for args in args_list for arg in args)
+        shared, keys = {}, {}
+        for args in args_list:
+            for arg in args:
+                if count[id(arg)] > 1 and not np.isscalar(arg) and id(arg) not in keys:
+                    keys[id(arg)] = '{}.{}'.format(job, len(keys))
+                    shared[keys[id(arg)]] = arg
+        tasks = [(func, tuple(_shared(keys[id(arg)]) if id(arg) in keys else arg for arg in args)) for args in args_list]
+        self.board.submit(job, tasks, shared)
+        return job
+
+    def imapUnordered(self, func, args_list, cancel=None, poll_interval=0.2):
+        ''' Generator of func(*args) in order of completion, same as
+        Functions.executor.imapUnordered. Unfinished tasks are cancelled
+        when the generator is closed.
+        '''
+        args_list = list(args_list)
+        job = self._submit(func, args_list)
+        try:
+            remaining = len(args_list)
+            while remaining > 0:
+                if cancel is not None and cancel.is_set():
+                    return
+                results, errors, remaining = self.board.collect(job)
+                if errors:
+                    raise RuntimeError('\n'.join(errors))
+                for i, result in results.items():
+                    yield result
+                if remaining > 0 and not results:
+                    time.sleep(poll_interval)
+        finally:
+            self.board.release(job)
+
+    def starmap(self, func, args_list, cancel=None, poll_interval=0.2):
+        ''' [func(*args) for args in args_list] calculated by the workers,
+        results are merged in order
+        '''
+        args_list = list(args_list)
+        job = self._submit(func, args_list)
+        merged = {}
+        try:
+            while len(merged) < len(args_list):
+                results, errors, remaining = self.board.collect(job)
+                if errors:
+                    raise RuntimeError('\n'.join(errors))
+                merged.update(results)
+                if not results:
+                    time.sleep(poll_interval)
+        finally:
+            self.board.release(job)
+        return [merged[i] for i in range(len(args_list))]
+
+
+########## worker side ##########
+
+def _resolve(board, args, cache, cache_size=8):
+    resolved = []
+    for arg in args:
+        if isinstance(arg, _shared):
+            if arg.key not in cache:
+                cache[arg.key] = board.getShared(arg.key)
+                while len(cache) > cache_size:
+                    cache.popitem(last=False)
+            cache.move_to_end(arg.key)
+            arg = cache[arg.key]
+        resolved.append(arg)
+    return resolved
+
+
+def worker(address, authkey, name=None, poll_interval=0.2, fail_rate=0.0):
+    ''' Take tasks from a broker until it is shut down
+
+    Args:
+        name: shown in broker errors, default is host:pid
+        fail_rate: probability of a task to raise on purpose, for testing retries
+
+    Returns:
+        int, number of tasks done
+    '''
+    if name is None:
+        name = '{}:{}'.format(socket.gethostname(), os.getpid())
+    manager = _manager(address=address, authkey=authkey)
+    manager.connect()
+    board = manager.board()
+    cache = collections.OrderedDict()
+
+    # keep the lease of the running task, the proxy opens its own
+    # connection in this thread
+    current = {'task_id': None}
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(board.leaseTime() / 3):
+            task_id = current['task_id']
+            if task_id is not None:
+                try:
+                    board.heartbeat(name, task_id)
+                except Exception:
+                    return
+    heartbeat = threading.Thread(target=beat, daemon=True)
+    heartbeat.start()
+
+    done = 0
+    try:
+        while True:
+            try:
+                task = board.take(name)
+                if task is None:
+                    if board.isClosed():
+                        break
+                    time.sleep(poll_interval)
+                    continue
+            except (EOFError, ConnectionError):
+                break
+            task_id, func, args = task
+            current['task_id'] = task_id
+            try:
+                if random.random() < fail_rate:
+                    raise RuntimeError('failure for test (fail_rate={})'.format(fail_rate))
+                result = func(*_resolve(board, args, cache))
+            except Exception:
+                board.fail(name, task_id, traceback.format_exc())
+                continue
+            finally:
+                current['task_id'] = None
+            board.finish(name, task_id, result)
+            done += 1
+    finally:
+        stop.set()
+    print('worker {}: {} tasks done'.format(name, done))
+    return done
+
+
+def startWorkers(address, authkey, worker_num=None, fail_rate=0.0):
+    ''' Start worker_num (default cpu_count()) worker processes on this node
+
+    Returns:
+        list of subprocess.Popen
+    '''
+    worker_num = worker_num or cpu_count()
+    command = [sys.executable, os.path.abspath(__file__), 'worker',
+               '--address', '{}:{}'.format(*address),
+               '--worker-num', '0', '--fail-rate', str(fail_rate)]
+    # authkey in the environment, not visible in the process list
+    env = dict(os.environ, MODEL2SAS_AUTHKEY=authkey.decode())
+    return [subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env) for i in range(worker_num)]
+
+
+########## local test ##########
+
+def selfTest(worker_num=4, lease=5):
+    ''' Broker with local workers standing in for nodes. One worker fails
+    now and then, and one is killed during the calculation, results must
+    still equal the local calculation.
+    '''
+    from Model2SAS import model2sas
+    from Functions import intensity_parallel
+
+    project = model2sas('broker test')
+    project.importExpression('(r >= R1) & (r <= R2)', '1 + 0.05*r', coord='sph', params={'R1': 6, 'R2': 12}, boundary_min=[-12]*3, boundary_max=[12]*3)
+    q = np.linspace(0.01, 1, 80).astype('float32')
+
+    processes = []
+    try:
+        with broker(lease=lease) as b:
+            processes += startWorkers(b.address, b.authkey, worker_num=worker_num-1)
+            processes += startWorkers(b.address, b.authkey, worker_num=1, fail_rate=0.3)
+            begintime = time.time()
+            project.genPoints(grid_num=10000, pool_executor=executor('broker', proc_num=worker_num, pool=b))
+            points_with_sld = project.points_with_sld
+            print('genPoints on broker: {} points, {:.2f} sec'.format(points_with_sld.shape[0], time.time()-begintime))
+            project.genPoints(grid_num=10000)
+            voxel_match = np.array_equal(points_with_sld, project.points_with_sld)
+            print('same points as local genPoints: {}'.format(voxel_match))
+
+            points, f = points_with_sld[:, :3], points_with_sld[:, 3]
+            I_local = intensity_parallel(q, points, f, 15, backend='serial')
+            # kill one worker while slices are running, its slice is retried after lease
+            killer = threading.Timer(1.0, processes[0].kill)
+            killer.start()
+            begintime = time.time()
+            I_broker = intensity_parallel(q, points, f, 15, proc_num=worker_num, pool=b, backend='broker')
+            killer.cancel()
+            error = np.max(np.abs(I_broker / I_local - 1))
+            print('intensity on broker: {:.2f} sec, max relative difference to local {:.2e}'.format(time.time()-begintime, error))
+            print('tasks retried: {}'.format(b.stats()['retries']))
+    finally:
+        # workers leave by themselves when the broker is shut down
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.terminate()
+    return voxel_match and error < 1e-5
+
+
+if __name__ == '__main__':
+    # use the classes of module Broker, not of __main__, so that objects
+    # pickled here and in an importing main node are the same
+    import Broker
+
+    parser = argparse.ArgumentParser(description='Broker and workers for distributed Model2SAS calculation')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    parser_worker = subparsers.add_parser('worker', help='attach workers of this node to a broker')
+    parser_worker.add_argument('--address', required=True, help='host:port of the broker')
+    parser_worker.add_argument('--authkey', default=os.environ.get('MODEL2SAS_AUTHKEY'), help='printed by the broker, default from environment variable MODEL2SAS_AUTHKEY')
+    parser_worker.add_argument('--worker-num', type=int, default=None, help='worker processes, default cpu count, 0 runs in this process')
+    parser_worker.add_argument('--fail-rate', type=float, default=0.0, help='for testing retries')
+    parser_test = subparsers.add_parser('test', help='broker with local workers, compared with local calculation')
+    parser_test.add_argument('--workers', type=int, default=4)
+    parser_test.add_argument('--lease', type=float, default=5)
+    args = parser.parse_args()
+
+    if args.command == 'worker':
+        if not args.authkey:
+            parser_worker.error('authkey is required, use --authkey or MODEL2SAS_AUTHKEY')
+        host, port = args.address.rsplit(':', 1)
+        address, authkey = (host, int(port)), args.authkey.encode()
+        if args.worker_num == 0:
+            Broker.worker(address, authkey, fail_rate=args.fail_rate)
+        else:
+            for process in Broker.startWorkers(address, authkey, worker_num=args.worker_num, fail_rate=args.fail_rate):
+                process.wait()
+    else:
+        sys.exit(0 if Broker.selfTest(worker_num=args.workers, lease=args.lease) else 1)
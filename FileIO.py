@@ -0,0 +1,245 @@
+# -*- coding: UTF-8 -*-
+
+import os
+import json
+import hashlib
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+'''
+Save and load points_with_sld, occupancy grids and SAS data.
+File type is decided by extension:
+  - '.npy'        |binary, can be memory mapped when loading
+  - '.npz'        |binary, several arrays in one file
+  - '.h5' '.hdf5' |chunked HDF5, needs h5py
+  - others        |text, same as np.savetxt, read by readTxtStream
+'''
+
+
+def _filetype(filename):
+    ext = os.path.splitext(filename)[-1].lower()
+    if ext in ('.npy', '.npz'):
+        return ext[1:]
+    elif ext in ('.h5', '.hdf5'):
+        if h5py is None:
+            raise ImportError('h5py is needed for HDF5 file: {}'.format(filename))
+        return 'h5'
+    else:
+        return 'txt'
+
+
+def readTxtStream(filename, chunk_rows=100000, dtype='float64'):
+    ''' Read a text table (e.g. saved by np.savetxt) chunk by chunk
+    Lines starting with # are skipped. Only chunk_rows lines are parsed
+    at a time, so reading large legacy files does not build huge lists.
+
+    Returns:
+        ndarray, shape == (n, columns)
+    '''
+    chunk_list = []
+    with open(filename, 'r') as f:
+        lines = []
+        for line in f:
+            if line.startswith('#') or line.strip() == '':
+                continue
+            lines.append(line)
+            if len(lines) >= chunk_rows:
+                chunk_list.append(np.loadtxt(lines, dtype=dtype, ndmin=2))
+                lines = []
+        if len(lines) > 0:
+            chunk_list.append(np.loadtxt(lines, dtype=dtype, ndmin=2))
+    if len(chunk_list) == 0:
+        return np.zeros((0, 0), dtype=dtype)
+    return np.vstack(chunk_list)
+
+
+def savePointsWithSld(filename, points_with_sld, interval=None):
+    filetype = _filetype(filename)
+    if filetype == 'npy':
+        np.save(filename, points_with_sld)
+    elif filetype == 'npz':
+        np.savez(filename, points_with_sld=points_with_sld, interval=np.nan if interval is None else interval)
+    elif filetype == 'h5':
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('points_with_sld', data=points_with_sld, chunks=True, compression='gzip')
+            if interval is not None:
+                f.attrs['interval'] = interval
+    else:
+        header = 'x\ty\tz\tsld'
+        np.savetxt(filename, points_with_sld, header=header)
+
+
+def loadPointsWithSld(filename, mmap=True):
+    ''' Load points_with_sld saved by savePointsWithSld
+
+    Args:
+        mmap: bool, memory map .npy file instead of reading it
+
+    Returns:
+        points_with_sld: ndarray, shape == (n, 4)
+        interval: float or None, lattice interval if it is saved
+    '''
+    filetype = _filetype(filename)
+    interval = None
+    if filetype == 'npy':
+        points_with_sld = np.load(filename, mmap_mode='r' if mmap else None)
+    elif filetype == 'npz':
+        with np.load(filename) as f:
+            points_with_sld = f['points_with_sld']
+            if 'interval' in f and not np.isnan(f['interval']):
+                interval = float(f['interval'])
+    elif filetype == 'h5':
+        with h5py.File(filename, 'r') as f:
+            points_with_sld = f['points_with_sld'][()]
+            interval = f.attrs.get('interval', None)
+    else:
+        points_with_sld = readTxtStream(filename)
+    return points_with_sld, interval
+
+
+def gridTo3d(lattice, sld_grid_index):
+    ''' sld grid in shape (nx, ny, nz)
+    sld_grid_index may be flat (in order of latticePoints) or already 3d
+    '''
+    nx, ny, nz = lattice[0].size, lattice[1].size, lattice[2].size
+    if sld_grid_index.ndim == 3:
+        return sld_grid_index
+    return sld_grid_index.reshape((ny, nx, nz)).transpose(1, 0, 2)
+
+
+def saveGrid(filename, lattice, sld_grid_index):
+    ''' Save occupancy grid, sld is saved in shape (nx, ny, nz)
+    '''
+    filetype = _filetype(filename)
+    sld_grid = gridTo3d(lattice, sld_grid_index)
+    xscale, yscale, zscale = lattice
+    if filetype == 'h5':
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('sld_grid', data=sld_grid, chunks=True, compression='gzip')
+            f.create_dataset('xscale', data=xscale)
+            f.create_dataset('yscale', data=yscale)
+            f.create_dataset('zscale', data=zscale)
+    elif filetype == 'npz':
+        np.savez_compressed(filename, sld_grid=sld_grid, xscale=xscale, yscale=yscale, zscale=zscale)
+    else:
+        raise ValueError('occupancy grid can only be saved as .npz or .h5 file')
+
+
+def loadGrid(filename):
+    '''
+    Returns:
+        lattice: tuple of 1darray, (xscale, yscale, zscale)
+        sld_grid: ndarray, shape == (nx, ny, nz)
+    '''
+    filetype = _filetype(filename)
+    if filetype == 'h5':
+        with h5py.File(filename, 'r') as f:
+            lattice = (f['xscale'][()], f['yscale'][()], f['zscale'][()])
+            sld_grid = f['sld_grid'][()]
+    else:
+        with np.load(filename) as f:
+            lattice = (f['xscale'], f['yscale'], f['zscale'])
+            sld_grid = f['sld_grid']
+    return lattice, sld_grid
+
+
+def saveSasData(filename, q, I, error):
+    filetype = _filetype(filename)
+    if filetype == 'npy':
+        np.save(filename, np.vstack((q, I, error)).T)
+    elif filetype == 'npz':
+        np.savez(filename, q=q, I=I, error=error)
+    elif filetype == 'h5':
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('q', data=q)
+            f.create_dataset('I', data=I)
+            f.create_dataset('error', data=error)
+    else:
+        header = 'q\tI\tpseudo error(I/1000)'
+        data = np.vstack((q, I, error)).T
+        np.savetxt(filename, data, header=header)
+
+
+def loadSasData(filename, mmap=True):
+    '''
+    Returns:
+        q, I, error: 1darray
+    '''
+    filetype = _filetype(filename)
+    if filetype == 'npz':
+        with np.load(filename) as f:
+            return f['q'], f['I'], f['error']
+    elif filetype == 'h5':
+        with h5py.File(filename, 'r') as f:
+            return f['q'][()], f['I'][()], f['error'][()]
+    elif filetype == 'npy':
+        data = np.load(filename, mmap_mode='r' if mmap else None)
+    else:
+        data = readTxtStream(filename)
+    return data[:,0], data[:,1], data[:,2]
+
+
+def fileHash(filepath, block_size=2**20):
+    ''' sha256 of file content '''
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class projectfile:
+    ''' Project container, a directory with a json manifest and .npy arrays
+
+    dirpath/
+        project.json    |manifest, any json serializable dict
+        arrays/*.npy    |each array in one file, loaded only when needed
+
+    Arrays are memory mapped when loaded, so opening a project costs
+    nothing until an array is actually used. Boolean arrays are saved as
+    packed bits (8 times smaller).
+    '''
+    manifest_name = 'project.json'
+
+    def __init__(self, dirpath):
+        self.dirpath = os.path.abspath(dirpath)
+        self.array_dir = os.path.join(self.dirpath, 'arrays')
+        manifest_path = os.path.join(self.dirpath, self.manifest_name)
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'arrays': {}}
+
+    def saveManifest(self):
+        os.makedirs(self.dirpath, exist_ok=True)
+        manifest_path = os.path.join(self.dirpath, self.manifest_name)
+        temp_path = manifest_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(temp_path, manifest_path)
+
+    def saveArray(self, name, array):
+        os.makedirs(self.array_dir, exist_ok=True)
+        array = np.asarray(array)
+        info = {'shape': list(array.shape), 'packed': bool(array.dtype == bool)}
+        if info['packed']:
+            array = np.packbits(array.reshape(array.size))
+        np.save(os.path.join(self.array_dir, '{}.npy'.format(name)), array)
+        self.manifest['arrays'][name] = info
+
+    def loadArray(self, name, mmap=True):
+        info = self.manifest['arrays'][name]
+        array = np.load(os.path.join(self.array_dir, '{}.npy'.format(name)), mmap_mode='r' if mmap else None)
+        if info['packed']:
+            size = int(np.prod(info['shape']))
+            array = np.unpackbits(array, count=size).astype(bool).reshape(info['shape'])
+        return array
+
+    def __contains__(self, name):
+        return name in self.manifest['arrays']
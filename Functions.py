@@ -1,9 +1,20 @@
 # -*- coding: UTF-8 -*-
 
+import os, time, json, hashlib
 import numpy as np
-from scipy.special import sph_harm, spherical_jn, jv
-from multiprocessing import cpu_count
-from p_tqdm import p_map
+from multiprocessing import cpu_count, Pool, TimeoutError as PoolTimeoutError
+
+import Instrument
+from Instrument import stage
+
+
+# scipy.special and p_tqdm are imported on first use, so that importing
+# this module (e.g. in batch workers) stays fast
+
+def p_map(*args, **kwargs):
+    ''' p_tqdm.p_map, imported on first use '''
+    from p_tqdm import p_map
+    return p_map(*args, **kwargs)
 
 
 def printTime(last_timestamp, item):
@@ -14,6 +25,7 @@ def printTime(last_timestamp, item):
 
 
 def intensity(q, points, f, lmax):
+    from scipy.special import sph_harm, spherical_jn
 
     def jl(q, r, l):
         r_ext1 = np.stack([r]*n_l, axis=-1)  # (r,) -> (r, l)
@@ -36,9 +48,7 @@ def intensity(q, points, f, lmax):
 
     def Sigma(f_ext3, jl_ext3, Ylm_ext1):
         Ylm_ext3 = np.stack([Ylm_ext1]*n_q, axis=-1)  #(r, m) -> (r, m, q)
-        #timestamp1 = printTime(timestamp, 'Ylm_ext3')
         Sigma1 = f_ext3 * jl_ext3 * Ylm_ext3  # (r, m, q)
-        #timestamp1 = printTime(timestamp1, 'f_ext3')
         return np.sum(Sigma1, axis=0)  # (m, q)
 
 
@@ -56,8 +66,6 @@ def intensity(q, points, f, lmax):
     # _ext means extended
     # TIPS: use np.stack() to expand the dimension of array
 
-    #timestamp0 = time.time()
-
     lmax = int(lmax)
     l = np.linspace(0, lmax, num=lmax+1, endpoint=True, dtype='int16')  # (l,)
     l_ext, m = [], []
@@ -67,36 +75,34 @@ def intensity(q, points, f, lmax):
             m.append(mi)
     l_ext = np.array(l_ext, dtype='int16')  # (m,)
     m = np.array(m, dtype='int16')  # (m,)
-    #timestamp = printTime(timestamp0, 'l&l_ext&m')
 
     n_r, n_l, n_m, n_q = r.size, l.size, m.size, q.size
 
-    jl_ext1 = jl(q, r, l)  # (r, l, q)
-    #timestamp = printTime(timestamp, 'jl_ext1')
+    with stage('intensity.jl'):
+        jl_ext1 = jl(q, r, l)  # (r, l, q)
 
-    Ylm_ext1 = Ylm(l_ext, m, theta, phi)  # (r, m)
-    #timestamp = printTime(timestamp, 'Ylm_ext1')
+    with stage('intensity.Ylm'):
+        Ylm_ext1 = Ylm(l_ext, m, theta, phi)  # (r, m)
 
     # 接下来把各个部分都扩展成 shape=(r, m, q)
     # 尽量避免使用python循环嵌套，太慢了！！
 
-    # 这一步使用一个循环比使用np.dot快得多
-    f_ext3 = np.stack([f]*n_m, axis=-1)  # (r,) -> (r, m)
-    f_ext3 = np.stack([f_ext3]*n_q, axis=-1)  # (r, m) -> (r, m, q)
-    #timestamp = printTime(timestamp, 'f_ext3')
+    with stage('intensity.expand'):
+        # 这一步使用一个循环比使用np.dot快得多
+        f_ext3 = np.stack([f]*n_m, axis=-1)  # (r,) -> (r, m)
+        f_ext3 = np.stack([f_ext3]*n_q, axis=-1)  # (r, m) -> (r, m, q)
 
-    # (r, l, q) -> (r, m, q)
-    jl_ext3 = []
-    for i in range(n_r):
-        temp = []
-        for j in range(n_l):
-            temp += [ jl_ext1[i,j,:] ]*(2*j+1)  # (m, q)
-        jl_ext3.append(temp)
-    jl_ext3 = np.array(jl_ext3, dtype='float32')  # (r, m, q)
-    #timestamp = printTime(timestamp, 'jl_ext3')
+        # (r, l, q) -> (r, m, q)
+        jl_ext3 = []
+        for i in range(n_r):
+            temp = []
+            for j in range(n_l):
+                temp += [ jl_ext1[i,j,:] ]*(2*j+1)  # (m, q)
+            jl_ext3.append(temp)
+        jl_ext3 = np.array(jl_ext3, dtype='float32')  # (r, m, q)
 
-    Sigma1 = Sigma(f_ext3, jl_ext3, Ylm_ext1)
-    #timestamp = printTime(timestamp, 'Sigma1')
+    with stage('intensity.Sigma'):
+        Sigma1 = Sigma(f_ext3, jl_ext3, Ylm_ext1)
 
     il = complex(0,1)**l  # (l,)
     il_ext4 = []
@@ -104,46 +110,718 @@ def intensity(q, points, f, lmax):
         il_ext4 += [il[i]]*(2*i+1)
     # il_ext4.shape == (m,)
     il_ext5 = np.array([il_ext4_i*np.ones_like(q) for il_ext4_i in il_ext4], dtype='complex64')  # (m, q)
-    #timestamp = printTime(timestamp, 'il_ext5')
 
-    Alm = il_ext5 * Sigma1  # (m, q)
-    #timestamp = printTime(timestamp, 'Alm3')
-    I = 16 * np.pi**2 * np.sum(np.absolute(Alm)**2, axis=0)  # (q,)
-    #timestamp = printTime(timestamp, 'I')
+    with stage('intensity.I'):
+        Alm = il_ext5 * Sigma1  # (m, q)
+        I = 16 * np.pi**2 * np.sum(np.absolute(Alm)**2, axis=0)  # (q,)
 
     return I
 
 
-def intensity_parallel(q, points, f, lmax, cpu_usage=0.6, proc_num=None):
+class executor:
+    ''' Runs calls of one function on a backend
+    'process': worker processes (p_map, or an external multiprocessing.Pool),
+        arguments are pickled and sent to every worker
+    'thread': threads of this process (concurrent.futures), arguments such
+        as points and basis arrays are shared without copying, calls run in
+        parallel where numpy/BLAS release the GIL
+    'serial': one by one in this process
+    'broker': workers attached to a Broker.broker (pool), possibly on
+        other nodes, see Broker.py
+
+    pool is an external pool to reuse, multiprocessing.Pool for 'process'
+    or concurrent.futures.ThreadPoolExecutor for 'thread'. It is required
+    for 'broker'. Without pool, every call starts its own pool, unless
+    the executor is used in a with block, which keeps one pool for all
+    the calls in the block:
+        with executor('process', proc_num) as pool_executor:
+            ...
+    '''
+    backends = ('process', 'thread', 'serial', 'broker')
+
+    def __init__(self, backend='process', proc_num=1, pool=None):
+        if backend not in self.backends:
+            raise ValueError('unknown backend {}, should be one of {}'.format(backend, self.backends))
+        if backend == 'broker' and pool is None:
+            raise ValueError('broker backend needs a Broker.broker as pool')
+        self.backend = backend
+        self.proc_num = max(1, int(proc_num))
+        self.pool = None if backend == 'serial' else pool
+        self.own_pool = False
+
+    def __enter__(self):
+        if self.pool is None and self.backend in ('process', 'thread'):
+            if self.backend == 'process':
+                self.pool = Pool(processes=self.proc_num)
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(max_workers=self.proc_num)
+            self.own_pool = True
+        return self
+
+    def __exit__(self, error_type, *args):
+        if self.own_pool:
+            if self.backend == 'process':
+                if error_type is None:
+                    self.pool.close()
+                else:
+                    self.pool.terminate()
+                self.pool.join()
+            else:
+                self.pool.shutdown(wait=error_type is None, cancel_futures=True)
+            self.pool = None
+            self.own_pool = False
+        return False
+
+    def starmap(self, func, args_list):
+        ''' [func(*args) for args in args_list], calculated on the backend '''
+        args_list = list(args_list)
+        if len(args_list) == 0:
+            return []
+        if self.backend == 'serial':
+            return [func(*args) for args in args_list]
+        if self.backend == 'broker':
+            return self.pool.starmap(func, args_list)
+        if self.backend == 'thread':
+            if self.pool is not None:
+                return list(self.pool.map(func, *zip(*args_list)))
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=self.proc_num) as pool:
+                return list(pool.map(func, *zip(*args_list)))
+        if self.pool is not None:
+            # 使用外部共享的进程池，避免每次计算都重新建立进程
+            return self.pool.starmap(func, args_list)
+        #这里使用p_tqdm库来实现多进程下的进度条
+        return p_map(func, *zip(*args_list), num_cpus=self.proc_num)
+
+    def imapUnordered(self, func, args_list, cancel=None, poll_interval=0.2):
+        ''' Generator of func(*args) in order of completion
+        It stops when cancel (e.g. threading.Event) is set. A pool created
+        here is stopped at once (processes are terminated, threads finish
+        their running call only). Calls already sent to an external pool
+        can not be stopped, their results are discarded.
+        '''
+        args_list = list(args_list)
+        isCancelled = lambda: cancel is not None and cancel.is_set()
+        if self.backend == 'serial':
+            for args in args_list:
+                if isCancelled():
+                    return
+                yield func(*args)
+        elif self.backend == 'broker':
+            yield from self.pool.imapUnordered(func, args_list, cancel=cancel, poll_interval=poll_interval)
+        elif self.backend == 'thread':
+            from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+            pool = self.pool if self.pool is not None else ThreadPoolExecutor(max_workers=self.proc_num)
+            pending = {pool.submit(func, *args) for args in args_list}
+            try:
+                while pending:
+                    # wait with timeout, so that cancel is noticed while calls run
+                    done, pending = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+                    if isCancelled():
+                        return
+            finally:
+                for future in pending:
+                    future.cancel()
+                if self.pool is None:
+                    pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            pool = self.pool if self.pool is not None else Pool(processes=self.proc_num)
+            results = pool.imap_unordered(_starCall, [(func, args) for args in args_list])
+            finished = False
+            try:
+                for i in range(len(args_list)):
+                    while True:
+                        try:
+                            result = results.next(timeout=poll_interval)
+                            break
+                        except PoolTimeoutError:
+                            if isCancelled():
+                                return
+                    yield result
+                finished = True
+            finally:
+                if self.pool is None:
+                    if finished:
+                        pool.close()
+                    else:
+                        pool.terminate()
+                    pool.join()
+
+
+def resolveExecutor(pool=None, backend='process', proc_num=None, cpu_usage=0.6):
+    ''' executor for the pool, backend and proc_num arguments of
+    intensity_parallel and the like
+    An executor given as pool is returned as it is. Otherwise proc_num
+    defaults to the workers of a broker pool, or to cpu_usage of the cpus,
+    and is 1 for 'serial'.
+    '''
+    if isinstance(pool, executor):
+        return pool
+    if backend == 'serial':
+        proc_num = 1
+    elif proc_num:
+        proc_num = int(proc_num)
+    elif backend == 'broker' and pool is not None:
+        # slices are shared by the workers attached to the broker
+        proc_num = max(1, pool.workerNum())
+    else:
+        proc_num = max(1, round(cpu_usage*cpu_count()))
+    return executor(backend, proc_num, pool)
+
+
+def _starCall(func_args):
+    func, args = func_args
+    return func(*args)
+
+
+def intensity_parallel(q, points, f, lmax, cpu_usage=0.6, proc_num=None, pool=None, checkpoint=None, callback=None, cancel=None, backend='process'):
+    ''' Intensity calculated by q slices in parallel
+    backend is 'process', 'thread', 'serial' or 'broker', see executor.
+    proc_num (or cpu_usage) gives the number of processes or threads, and
+    pool an external pool of the same backend. For 'broker', pool is a
+    Broker.broker and proc_num defaults to the number of its workers.
+    pool may also be an executor, which is used as it is (backend and
+    proc_num are taken from it), e.g. one shared by requests of AsyncService.
+
+    If callback or cancel is given, slices are streamed (see
+    _intensityStreaming): callback(index, I_slice) is called in the calling
+    process as soon as a slice is finished, and cancel (e.g.
+    threading.Event) stops the calculation, leaving nan in I for the q
+    not finished yet. They are not used together with checkpoint.
+    '''
     # 本来是每一个q一个进程，但是在这里我希望把q切的不那么细，这样的话就不至于在建立进程上开销太大
     # 目前想的策略是切成并行进程数的4倍左右，但是每一个切片内q的数目在10~20比较好吧大概
     # 太大了会占用太多内存，太小了又会在建立进程上开销太大
     # 具体的值还得再试试
 
     # 确定proc_num
-    if proc_num:
-        proc_num = int(proc_num)
+    pool_executor = resolveExecutor(pool, backend, proc_num, cpu_usage)
+    backend, proc_num = pool_executor.backend, pool_executor.proc_num
+    if checkpoint:
+        with stage('intensity_parallel'):
+            return _intensityWithCheckpoint(q, points, f, lmax, pool_executor, checkpoint)
+    if callback is not None or cancel is not None:
+        if proc_num == 1 and pool is None:
+            # 单进程时直接在本进程中逐个计算切片，省去建立进程
+            pool_executor = executor('serial')
+        with stage('intensity_parallel'):
+            return _intensityStreaming(q, points, f, lmax, pool_executor, callback, cancel)
+    q_list = sliceQ(q, proc_num)
+    slice_num = len(q_list)
+    # 开启instrument时，各worker进程把自己的记录和结果一起返回，在这里汇总
+    # 线程和本进程中的记录直接写入同一个Instrument，不需要汇总
+    worker_instrument = Instrument.enabled and backend == 'process'
+    if worker_instrument:
+        func, args = Instrument.instrumented, zip([intensity]*slice_num, q_list, [points]*slice_num, [f]*slice_num, [lmax]*slice_num)
     else:
-        proc_num = round(cpu_usage*cpu_count())
-    # 确定切片的数目
-    slice_length = 10
-    k = round(q.size/slice_length/proc_num)
-    slice_num = k * proc_num
-    slice_length = np.ceil(q.size/slice_num)
-    
-    slice_num, slice_length = int(slice_num), int(slice_length)
-    slice_index_begin = [i*slice_length for i in range(slice_num)]
-    slice_index_end = [(i+1)*slice_length for i in range(slice_num)]
-    q_list = []
-    for i in range(slice_num):
-        q_list.append(q[slice_index_begin[i]:slice_index_end[i]])
-    #这里使用p_tqdm库来实现多进程下的进度条
-    I_list= p_map(intensity, q_list, [points]*slice_num, [f]*slice_num, [lmax]*slice_num, num_cpus=proc_num)
-    I = np.array(I_list, dtype='float32')
-    I = I.reshape(I.size)
+        func, args = intensity, zip(q_list, [points]*slice_num, [f]*slice_num, [lmax]*slice_num)
+    with stage('intensity_parallel'):
+        I_list = pool_executor.starmap(func, args)
+    if worker_instrument:
+        for I_slice, pid, records in I_list:
+            Instrument.mergeWorker(pid, records)
+        I_list = [I_slice for I_slice, pid, records in I_list]
+    # 各切片长度不一定相同，所以直接拼接
+    I = np.hstack(I_list).astype('float32')
+    return I
+
+
+def inputHash(q, points, f, lmax):
+    ''' Hash of the inputs of an intensity calculation, used as checkpoint key
+    '''
+    sha256 = hashlib.sha256()
+    for array in (q, points, f):
+        sha256.update(np.ascontiguousarray(array, dtype='float32').tobytes())
+    sha256.update(str(int(lmax)).encode())
+    return sha256.hexdigest()[:16]
+
+
+def _intensityToCheckpoint(q, index, points, f, lmax, path):
+    ''' Calculate one q slice and write it atomically into checkpoint
+    It is done in the worker, so a finished slice is kept even if the
+    main process is killed.
+    '''
+    I = intensity(q, points, f, lmax)
+    filename = os.path.join(path, 'slice_{}_{}.npz'.format(index[0], index.size))
+    temp_filename = filename + '.tmp.npz'
+    np.savez(temp_filename, index=index, I=I)
+    os.replace(temp_filename, filename)
+    return I
+
+
+def readCheckpoint(path):
+    ''' Read (partial) results in a checkpoint directory
+    Can be used while the calculation is still running.
+
+    Returns:
+        q: 1darray
+        I: 1darray, nan for q not finished yet
+        done: 1darray of bool
+    '''
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    q = np.array(meta['q'], dtype='float32')
+    I = np.full(q.size, np.nan, dtype='float32')
+    done = np.zeros(q.size, dtype=bool)
+    for filename in os.listdir(path):
+        if filename.startswith('slice_') and not filename.endswith('.tmp.npz'):
+            with np.load(os.path.join(path, filename)) as slice_file:
+                I[slice_file['index']] = slice_file['I']
+                done[slice_file['index']] = True
+    return q, I, done
+
+
+def _intensityWithCheckpoint(q, points, f, lmax, pool_executor, checkpoint):
+    ''' intensity_parallel that keeps each finished q slice in
+    checkpoint/<input hash>/, and only calculates missing slices
+    '''
+    q = q.reshape(q.size)
+    path = os.path.join(checkpoint, inputHash(q, points, f, lmax))
+    os.makedirs(path, exist_ok=True)
+    meta_filename = os.path.join(path, 'meta.json')
+    if not os.path.exists(meta_filename):
+        with open(meta_filename + '.tmp', 'w') as meta_file:
+            json.dump({'q': q.tolist(), 'lmax': int(lmax), 'n_points': int(points.shape[0])}, meta_file)
+        os.replace(meta_filename + '.tmp', meta_filename)
+
+    _, _, done = readCheckpoint(path)
+    missing = np.where(~done)[0]
+    if missing.size < q.size:
+        print('checkpoint {}: {}/{} q finished'.format(path, q.size-missing.size, q.size))
+    if missing.size > 0:
+        slice_num = len(sliceQ(q[missing], pool_executor.proc_num))
+        index_list = [index for index in np.array_split(missing, slice_num) if index.size > 0]
+        args = [(q[index], index, points, f, lmax, path) for index in index_list]
+        pool_executor.starmap(_intensityToCheckpoint, args)
+    _, I, _ = readCheckpoint(path)
+    return I
+
+
+def _intensitySlice(index, q, points, f, lmax, instrument=False):
+    ''' One q slice for _intensityStreaming, index is returned together
+    with I, since slices come back in order of completion
+    '''
+    if instrument:
+        I, pid, records = Instrument.instrumented(intensity, q, points, f, lmax)
+        return index, I, pid, records
+    return index, intensity(q, points, f, lmax), None, None
+
+
+def _intensityStreaming(q, points, f, lmax, pool_executor, callback, cancel, poll_interval=0.2):
+    ''' intensity_parallel that hands over each finished slice at once
+    Slices are calculated with pool_executor.imapUnordered, see executor
+    for what is stopped when cancelled.
+
+    Returns:
+        I: 1darray, nan for q not finished when cancelled
+    '''
+    q = q.reshape(q.size)
+    q_list = sliceQ(q, pool_executor.proc_num)
+    begin_list = np.cumsum([0] + [q_slice.size for q_slice in q_list])
+    worker_instrument = Instrument.enabled and pool_executor.backend == 'process'
+    args = [(np.arange(begin_list[i], begin_list[i+1]), q_slice, points, f, lmax, worker_instrument) for i, q_slice in enumerate(q_list)]
+    I = np.full(q.size, np.nan, dtype='float32')
+
+    results = pool_executor.imapUnordered(_intensitySlice, args, cancel=cancel, poll_interval=poll_interval)
+    try:
+        for index, I_slice, pid, records in results:
+            if records is not None:
+                Instrument.mergeWorker(pid, records)
+            I[index] = I_slice
+            if callback is not None:
+                callback(index, I_slice)
+            if cancel is not None and cancel.is_set():
+                break
+    finally:
+        results.close()
+    if cancel is not None and cancel.is_set():
+        print('calculation cancelled, {}/{} q finished'.format(np.sum(~np.isnan(I)), q.size))
     return I
 
 
+def basisTable(q, points, lmax):
+    ''' q independent and q dependent parts of the multipole basis
+    Alm(q) = i**l * sum_r f(r) * jl(q*r) * Ylm(r), this function gives
+    the tables that only depend on points, so that they can be reused
+    for any f.
+
+    Returns:
+        jl_table: ndarray, shape == (r, m, q), float32
+        Ylm_table: ndarray, shape == (r, m), complex64, already multiplied by i**l
+    '''
+    from scipy.special import sph_harm, spherical_jn
+    q = q.astype('float32').reshape(q.size)
+    points_sph = xyz2sph(points)
+    r, theta, phi = points_sph[:,0], points_sph[:,1], points_sph[:,2]
+    lmax = int(lmax)
+    l = np.arange(lmax+1)
+    l_ext = np.repeat(l, 2*l+1)  # (m,)
+    m = np.hstack([np.arange(-li, li+1) for li in l])  # (m,)
+    jl_table = spherical_jn(l[None,:,None], (r[:,None]*q[None,:])[:,None,:]).astype('float32')  # (r, l, q)
+    jl_table = jl_table[:, l_ext, :]  # (r, m, q)
+    Ylm_table = sph_harm(m[None,:], l_ext[None,:], theta[:,None], phi[:,None])  # (r, m)
+    Ylm_table = (Ylm_table * (1j)**l_ext[None,:]).astype('complex64')
+    return jl_table, Ylm_table
+
+
+def intensity_batch(q, points, F, lmax, chunk_size=2000):
+    ''' Intensity of many sld distributions on the same points
+    Basis tables are calculated once for each chunk of points and shared by
+    all the rows of F, so the cost for each extra row is only a matrix product.
+
+    Args:
+        q: 1darray
+        points: ndarray, shape == (r, 3)
+        F: ndarray, shape == (P, r), sld of each point for each of P models
+        lmax: int
+
+    Returns:
+        I: ndarray, shape == (P, q)
+    '''
+    q = q.reshape(q.size)
+    F = np.asarray(F, dtype='float32').reshape(-1, points.shape[0])
+    n_m = (int(lmax)+1)**2
+    Alm = np.zeros((F.shape[0], n_m, q.size), dtype='complex64')
+    for begin in range(0, points.shape[0], chunk_size):
+        end = begin + chunk_size
+        jl_table, Ylm_table = basisTable(q, points[begin:end], lmax)
+        basis = jl_table * Ylm_table[:,:,None]  # (r, m, q)
+        Alm += np.tensordot(F[:, begin:end], basis, axes=(1, 0))  # (P, m, q)
+    I = 16 * np.pi**2 * np.sum(np.absolute(Alm)**2, axis=1)  # (P, q)
+    return I.astype('float32')
+
+
+########## oriented 2D patterns ##########
+# Particle rotated by R scatters F(q) = sum_r f(r) * exp(i*q.(R r)), which is
+# F of the unrotated points at R^T q, so all orientations are calculated
+# on the same points with rotated q vectors.
+
+def eulerRotation(alpha, beta, gamma):
+    ''' Rotation matrices of ZYZ Euler angles (rad), R = Rz(alpha) Ry(beta) Rz(gamma)
+
+    Returns:
+        ndarray, shape == (n, 3, 3), n is the broadcast size of the angles
+    '''
+    alpha, beta, gamma = np.broadcast_arrays(*[np.atleast_1d(np.asarray(angle, dtype='float64')) for angle in (alpha, beta, gamma)])
+    def rz(angle):
+        R = np.zeros((angle.size, 3, 3))
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)
+        R[:, 2, 2] = 1
+        return R
+    Ry = np.zeros((beta.size, 3, 3))
+    Ry[:, 0, 0], Ry[:, 0, 2], Ry[:, 2, 0], Ry[:, 2, 2] = np.cos(beta), np.sin(beta), -np.sin(beta), np.cos(beta)
+    Ry[:, 1, 1] = 1
+    return rz(alpha) @ Ry @ rz(gamma)
+
+
+def orientationSamples(n, axis=None, spread=None, seed=0):
+    ''' Rotation matrices sampled from an orientation distribution
+
+    Args:
+        axis: None for isotropic (uniformly random) orientations, otherwise
+            lab direction (3,) of the model z axis, e.g. the flow direction
+        spread: rad, with axis, the model z axis is tilted from axis by
+            |normal(0, spread)| in a random azimuth, and the model spins
+            freely around it. None or 0 is perfect alignment.
+
+    Returns:
+        ndarray, shape == (n, 3, 3)
+    '''
+    rng = np.random.default_rng(seed)
+    alpha = rng.uniform(0, 2*np.pi, n)
+    gamma = rng.uniform(0, 2*np.pi, n)
+    if axis is None:
+        beta = np.arccos(rng.uniform(-1, 1, n))
+        return eulerRotation(alpha, beta, gamma)
+    beta = np.abs(rng.normal(0, spread, n)) if spread else np.zeros(n)
+    rotations = eulerRotation(alpha, beta, gamma)
+    # rotate lab z to axis (Rodrigues)
+    axis = np.asarray(axis, dtype='float64') / np.linalg.norm(axis)
+    v, c = np.cross([0, 0, 1], axis), axis[2]
+    if np.linalg.norm(v) < 1e-12:
+        A = np.eye(3) if c > 0 else np.diag([1., -1., -1.])
+    else:
+        vx = np.array([[0, -v[2], v[1]], [v[2], 0, -v[0]], [-v[1], v[0], 0]])
+        A = np.eye(3) + vx + vx @ vx / (1 + c)
+    return A @ rotations
+
+
+def detectorQ(qx, qy, wavelength=None):
+    ''' q vectors of detector pixels, beam along lab z
+
+    Args:
+        qx, qy: 1darray of pixel q coordinates in detector plane, or 2darray
+            of the same shape (e.g. from np.meshgrid)
+        wavelength: if given, q lies on the Ewald sphere of k = 2*pi/wavelength,
+            qz = sqrt(k**2 - qx**2 - qy**2) - k. Otherwise qz = 0 (small angle).
+
+    Returns:
+        ndarray, shape == (ny, nx, 3)
+    '''
+    qx, qy = np.asarray(qx, dtype='float64'), np.asarray(qy, dtype='float64')
+    if qx.ndim == 1:
+        qx, qy = np.meshgrid(qx, qy)
+    if wavelength:
+        k = 2*np.pi / wavelength
+        qz = np.sqrt(np.maximum(k**2 - qx**2 - qy**2, 0)) - k
+    else:
+        qz = np.zeros_like(qx)
+    return np.stack((qx, qy, qz), axis=-1)
+
+
+def _amplitudeDirect(q, points, f, block_size=2**22):
+    ''' F(q) = sum f*exp(i*q.r), blocked so that the phase matrix of one
+    block has at most block_size elements, products are done by BLAS
+    '''
+    points = points.astype('float32')
+    f = f.astype('float32')
+    q = q.astype('float32')
+    point_block = min(points.shape[0], block_size)
+    q_block = max(1, block_size // point_block)
+    F = np.zeros(q.shape[0], dtype='complex64')
+    for i in range(0, q.shape[0], q_block):
+        for j in range(0, points.shape[0], point_block):
+            phase = q[i:i+q_block] @ points[j:j+point_block].T     # (q, r)
+            F[i:i+q_block] += np.cos(phase) @ f[j:j+point_block] + 1j * (np.sin(phase) @ f[j:j+point_block])
+    return F
+
+
+def _amplitudeFft(q, points, f, spacing, origin=None, oversample=2):
+    ''' F(q) from FFT of the voxel grid, interpolated at q by cubic spline
+    points must be on the lattice origin + ijk*spacing, spacing is a float
+    or one value per axis. The grid is zero padded to oversample times the
+    model size, which sets the spacing of the FFT grid in reciprocal space.
+    Points on a lattice give a periodic F (period 2*pi/spacing), so q wraps
+    around.
+    '''
+    from scipy.ndimage import map_coordinates
+    from scipy.fft import next_fast_len
+    spacing = np.broadcast_to(np.asarray(spacing, dtype='float64'), (3,))
+    origin = np.zeros(3) if origin is None else np.asarray(origin, dtype='float64')
+    position = (points - origin) / spacing
+    ijk = np.round(position).astype('int64')
+    if np.max(np.abs(position - ijk), initial=0) > 1e-3:
+        raise ValueError('points are not on the lattice of spacing {} and origin {}, fft method needs lattice points'.format(spacing, origin))
+    # model is centered at grid index 0 (negative index wraps around), so that
+    # F has no fast phase ramp of the translation and interpolates smoothly
+    ijk -= np.round((ijk.min(axis=0) + ijk.max(axis=0)) / 2).astype('int64')
+    size = [next_fast_len(int(np.ceil(oversample*(n+1)))) for n in ijk.max(axis=0) - ijk.min(axis=0)]
+    grid = np.zeros(size, dtype='float32')
+    np.add.at(grid, tuple((ijk % size).T), f)
+    # |F|^2 does not depend on the translation,
+    # and np.fft sign convention only conjugates F
+    grid_F = np.fft.fftn(grid)
+    coords = (q * np.asarray(size) * spacing / (2*np.pi)).T    # (3, q), in units of FFT grid
+    F_real = map_coordinates(grid_F.real, coords, order=3, mode='grid-wrap')
+    F_imag = map_coordinates(grid_F.imag, coords, order=3, mode='grid-wrap')
+    return (F_real + 1j*F_imag).astype('complex64')
+
+
+def pattern2d(q, points, f, rotations=None, weights=None, method='direct', interval=None, origin=None, block_size=2**22, oversample=2):
+    ''' 2D scattering pattern |F(q)|^2 of oriented particles
+
+    Args:
+        q: ndarray, shape == (..., 3), e.g. from detectorQ
+        points, f: points model and sld of each point
+        rotations: ndarray, shape == (3, 3) or (n, 3, 3), orientations of
+            the particle (see eulerRotation, orientationSamples), all of them
+            are calculated in one batched run. None is no rotation.
+        weights: 1darray, shape == (n,), if given, the weighted average over
+            orientations is returned, e.g. for an orientation distribution
+        method: 'direct' | 'fft'
+            'direct': blocked sum over points, exact, cost ~ points * q * n
+            'fft': FFT of the voxel grid once, then interpolation for all q
+                and orientations, needs points on the lattice
+                origin + ijk*interval (interval may be one value per axis),
+                otherwise ValueError is raised. Faster for many pixels and
+                orientations, accuracy grows with oversample.
+
+    Returns:
+        I: ndarray, shape == (n,) + q.shape[:-1], or q.shape[:-1] with
+            weights or a single (3, 3) rotation. I(0) = (sum of f)^2, so 4*pi
+            times the isotropic average equals intensity().
+    '''
+    q = np.asarray(q, dtype='float64')
+    q_shape = q.shape[:-1]
+    q = q.reshape(-1, 3)
+    single = rotations is None or np.ndim(rotations) == 2
+    rotations = np.eye(3)[None] if rotations is None else np.asarray(rotations, dtype='float64').reshape(-1, 3, 3)
+    # q in model frame of each orientation, (q R) for row vectors
+    q_model = np.einsum('qi,nij->nqj', q, rotations).reshape(-1, 3)
+    with stage('pattern2d.{}'.format(method)):
+        if method == 'direct':
+            F = _amplitudeDirect(q_model, points, f, block_size=block_size)
+        elif method == 'fft':
+            if interval is None:
+                raise ValueError('interval of the lattice is needed for fft method')
+            F = _amplitudeFft(q_model, points, f, interval, origin=origin, oversample=oversample)
+        else:
+            raise ValueError('method should be direct or fft')
+    I = (np.absolute(F)**2).reshape((rotations.shape[0],) + q_shape).astype('float32')
+    if weights is not None:
+        weights = np.asarray(weights, dtype='float64')
+        return np.tensordot(weights / weights.sum(), I, axes=(0, 0)).astype('float32')
+    return I[0] if single else I
+
+
+def genQ(qmin, qmax, qnum=200, logq=False):
+    if logq:
+        q = np.logspace(np.log10(qmin), np.log10(qmax), num=qnum, base=10, dtype='float32')
+    else:
+        q = np.linspace(qmin, qmax, num=qnum, dtype='float32')
+    return q
+
+
+def sliceQ(q, proc_num, slice_length=10):
+    ''' Cut q into slices for parallel calculation
+    slice number is about a multiple of proc_num, and each slice
+    contains about slice_length q values. Short q arrays (e.g. refinement
+    rounds of adaptive q sampling) still give at least one slice.
+
+    Returns:
+        list of 1darray, concatenation of them is q
+    '''
+    q = q.reshape(q.size)
+    k = max(1, round(q.size/slice_length/proc_num))
+    slice_num = min(k * proc_num, q.size)
+    slice_num = max(1, slice_num)
+    slice_length = int(np.ceil(q.size/slice_num))
+    q_list = [q[i*slice_length:(i+1)*slice_length] for i in range(slice_num)]
+    q_list = [q_slice for q_slice in q_list if q_slice.size > 0]
+    return q_list
+
+
+def refineQ(q, I, tol=0.05, max_new=None, logq=True):
+    ''' Choose new q values where the curve is not well resolved
+    Curve is treated in log(I)-log(q) space (or log(I)-q space for linear q).
+    Error of linear interpolation in each interval is estimated by
+    |y''| * dx**2 / 8, where y'' comes from slope change of neighbouring
+    intervals. Midpoints of intervals with estimated error larger than tol
+    (roughly a relative error of I) are returned, worst first.
+
+    Args:
+        q: 1darray, sorted
+        I: 1darray, same size as q
+        tol: float, tolerance of estimated relative interpolation error
+        max_new: int, max number of new q values, None means no limit
+
+    Returns:
+        q_new: 1darray, sorted, may be empty
+        err: 1darray, estimated error of each interval, shape == (q.size-1,)
+    '''
+    q, I = np.asarray(q, dtype='float64'), np.asarray(I, dtype='float64')
+    x = np.log(q) if logq else q
+    y = np.log(np.maximum(I, np.finfo(np.float32).tiny))
+    dx = np.diff(x)
+    slope = np.diff(y) / dx
+    # second derivative at interior points
+    d2y = np.zeros(q.size)
+    d2y[1:-1] = 2 * np.abs(np.diff(slope)) / (x[2:] - x[:-2])
+    # each interval uses the larger curvature of its two ends
+    err = np.maximum(d2y[:-1], d2y[1:]) * dx**2 / 8
+    # too narrow intervals are not refined anymore, in case of endless refinement at deep minima
+    resolvable = dx > 1e-6 * (x[-1] - x[0])
+    candidate = np.where((err > tol) & resolvable)[0]
+    candidate = candidate[np.argsort(err[candidate])[::-1]]
+    if max_new is not None:
+        candidate = candidate[:max(0, int(max_new))]
+    x_new = (x[candidate] + x[candidate+1]) / 2
+    q_new = np.exp(x_new) if logq else x_new
+    return np.sort(q_new).astype(q.dtype), err
+
+
+def relativeChange(I, I_ref):
+    ''' Median of |I/I_ref - 1|, used as error estimate between two curves
+    Median is used since relative change is huge near the minima of a curve.
+    '''
+    I, I_ref = np.asarray(I, dtype='float64'), np.asarray(I_ref, dtype='float64')
+    I_ref = np.maximum(np.abs(I_ref), np.finfo(np.float32).tiny)
+    return float(np.median(np.abs(I / I_ref - 1)))
+
+
+
+def coarseGrain(points, f, interval, block):
+    ''' Merge blocks of block**3 lattice voxels into weighted beads
+    Points are binned into cubic blocks with side block*interval. Each bead
+    sits at the geometric centre of its occupied voxels and carries the sum
+    of their scattering length (f).
+
+    Args:
+        points: ndarray, shape == (n, 3), lattice points
+        f: ndarray, shape == (n,), sld of each point
+        interval: float, lattice interval of points
+        block: int, number of voxels along each edge of a block
+
+    Returns:
+        beads: ndarray, shape == (k, 3)
+        weights: ndarray, shape == (k,)
+    '''
+    f = f.reshape(f.size)
+    if block <= 1:
+        return points, f
+    block_index = np.floor((points - points.min(axis=0)) / (block*interval) + 1e-6).astype('int64')
+    _, inverse = np.unique(block_index, axis=0, return_inverse=True)
+    inverse = inverse.reshape(inverse.size)
+    counts = np.bincount(inverse)
+    weights = np.bincount(inverse, weights=f)
+    beads = np.vstack([np.bincount(inverse, weights=points[:,i]) / counts for i in range(3)]).T
+    return beads, weights
+
+
+def sphereAmplitude(q, R):
+    ''' Normalized form factor amplitude of a sphere, 3(sin(qR)-qRcos(qR))/(qR)^3
+    '''
+    x = np.asarray(q, dtype='float64') * R
+    x = np.where(x < 1e-6, 1e-6, x)
+    return 3 * (np.sin(x) - x*np.cos(x)) / x**3
+
+
+def beadCorrection(q, interval, block):
+    ''' Intensity correction for beads that merge block**3 voxels
+    A bead is treated as a sphere with the same volume as its block, and an
+    original voxel as a sphere with the volume of one voxel. The ratio of
+    their squared amplitudes corrects the bead intensity towards that of the
+    full lattice at low q.
+    '''
+    R_voxel = (3/(4*np.pi))**(1/3) * interval
+    R_bead = block * R_voxel
+    return (sphereAmplitude(q, R_bead) / sphereAmplitude(q, R_voxel))**2
+
+
+def latticePoints(lattice, index):
+    ''' Coordinates of lattice points from their flat index
+    Flat index follows the order of np.meshgrid(xscale, yscale, zscale)
+    which is flattened, i.e. the grid generated by model._genGrid.
+
+    Args:
+        lattice: tuple of 1darray, (xscale, yscale, zscale)
+        index: 1darray of int
+
+    Returns:
+        ndarray, shape == (index.size, 3)
+    '''
+    xscale, yscale, zscale = lattice
+    nx, nz = xscale.size, zscale.size
+    iy, rest = np.divmod(index, nx*nz)
+    ix, iz = np.divmod(rest, nz)
+    return np.column_stack((xscale[ix], yscale[iy], zscale[iz]))
+
+
+def latticeChunks(lattice, chunk_size=2**18):
+    ''' Generate coordinates of lattice points chunk by chunk
+    so that the whole grid never needs to be in memory.
+
+    Yields:
+        begin, end, points: points is ndarray with shape == (end-begin, 3)
+    '''
+    n = lattice[0].size * lattice[1].size * lattice[2].size
+    for begin in range(0, n, chunk_size):
+        end = min(begin+chunk_size, n)
+        yield begin, end, latticePoints(lattice, np.arange(begin, end))
+
 
 def xyz2sph(points_xyz):
     ''' Transfer points coordinates from cartesian coordinate to spherical coordinate
@@ -0,0 +1,192 @@
+# -*- coding: UTF-8 -*-
+
+'''
+Stage-level timing and memory instrumentation
+
+Usage:
+    import Instrument
+    Instrument.enable()
+    project.genPoints()
+    project.calcSas(0.01, 1)
+    print(Instrument.reportJson())
+
+Code to be measured is wrapped as
+    with Instrument.stage('intensity.jl'):
+        ...
+When disabled (default), stage() returns a shared empty context, so
+instrumented code costs almost nothing.
+Set environment variable MODEL2SAS_INSTRUMENT=1 to enable at import.
+'''
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+enabled = bool(int(os.environ.get('MODEL2SAS_INSTRUMENT', '0') or 0))
+_records = {}   # stage name -> record
+_workers = {}   # worker pid -> {stage name -> record}
+_lock = threading.Lock()   # stages may also end in threads of this process
+_active = set()     # stages running now, their peak rss is sampled
+_sampler = None     # thread sampling rss while any stage runs
+SAMPLE_INTERVAL = 0.01  # sec
+
+
+def currentRss():
+    ''' Resident memory of this process in MB, None if unknown
+    '''
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 1024**2
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # peak rss, in KB on linux and in bytes on mac
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss / 1024**2 if sys.platform == 'darwin' else maxrss / 1024
+    except ImportError:
+        return None
+
+
+def _sample():
+    global _sampler
+    while True:
+        rss = currentRss()
+        with _lock:
+            if not _active:
+                _sampler = None
+                return
+            for running in _active:
+                if rss is not None:
+                    running.peak_rss = max(running.peak_rss, rss)
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def _afterFork():
+    # the sampler thread is not copied into a forked worker
+    global _lock, _sampler
+    _lock = threading.Lock()
+    _active.clear()
+    _sampler = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_afterFork)
+
+
+class _nullstage:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        return False
+
+_NULL_STAGE = _nullstage()
+
+
+class _stage:
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        global _sampler
+        self.rss_begin = currentRss()
+        self.peak_rss = self.rss_begin
+        if self.rss_begin is not None:
+            with _lock:
+                _active.add(self)
+                if _sampler is None:
+                    _sampler = threading.Thread(target=_sample, name='Instrument.sampler', daemon=True)
+                    _sampler.start()
+        self.begintime = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        seconds = time.perf_counter() - self.begintime
+        rss_end = currentRss()
+        with _lock:
+            _active.discard(self)
+            _addRecord(_records, self.name, {
+                'count': 1,
+                'time': seconds,
+                'peak_rss': max(filter(None, (self.peak_rss, rss_end)), default=None),
+                'rss_increase': None if rss_end is None or self.rss_begin is None else rss_end - self.rss_begin,
+            })
+        return False
+
+
+def _addRecord(records, name, record):
+    if name not in records:
+        records[name] = dict(record)
+        return
+    old = records[name]
+    old['count'] += record['count']
+    old['time'] += record['time']
+    for key in ('peak_rss', 'rss_increase'):
+        values = [value for value in (old.get(key), record.get(key)) if value is not None]
+        old[key] = max(values) if values else None
+
+
+def stage(name):
+    ''' Context manager that records time and memory of a named stage
+    peak_rss is sampled every SAMPLE_INTERVAL by a background thread
+    while the stage runs.
+    '''
+    if not enabled:
+        return _NULL_STAGE
+    return _stage(name)
+
+
+def enable(flag=True):
+    global enabled
+    enabled = bool(flag)
+
+
+def reset():
+    _records.clear()
+    _workers.clear()
+
+
+def snapshot():
+    ''' Records of this process, e.g. to be returned from a worker '''
+    return {name: dict(record) for name, record in _records.items()}
+
+
+def mergeWorker(pid, records):
+    ''' Merge records returned by a worker process
+    They are kept per worker, and also summed into the overall stages.
+    '''
+    with _lock:
+        worker_records = _workers.setdefault(str(pid), {})
+        for name, record in records.items():
+            _addRecord(worker_records, name, record)
+            _addRecord(_records, name, record)
+
+
+def report():
+    '''
+    Returns:
+        dict, {'stages': {name: record}, 'workers': {pid: {name: record}}}
+        record has count, time (sec), peak_rss and rss_increase (MB)
+    '''
+    return {'stages': snapshot(), 'workers': {pid: dict(records) for pid, records in _workers.items()}}
+
+
+def reportJson(indent=2):
+    return json.dumps(report(), indent=indent)
+
+
+def instrumented(func, *args):
+    ''' Run func in a worker with instrumentation on,
+    and return its result together with the records of this worker
+
+    Returns:
+        (result, pid, records)
+    '''
+    enable(True)
+    reset()
+    result = func(*args)
+    return result, os.getpid(), snapshot()
@@ -1,6 +1,8 @@
 # -*- coding: UTF-8 -*-
 
 import os
+import time
+import threading
 import numpy as np
 from stl import mesh
 from mpl_toolkits import mplot3d
@@ -8,7 +10,7 @@ import matplotlib.pyplot as plt
 
 from Model2SAS import *
 from Plot import *
-from Functions import intensity_parallel, intensity
+import Instrument
 
 # 以下均为GUI相关的导入
 import sys
@@ -82,27 +84,101 @@ class EmittingStream(QtCore.QObject):
     def write(self, text):
         self.textWritten.emit(str(text))  
 
-class Thread_calcSas(QThread):
-    # 线程结束的signal，并且带有一个列表参数
-    threadEnd = pyqtSignal(list)
-    def __init__(self, q, points, sld, lmax, parallel, cpu_usage, proc_num):
+class Thread_task(QThread):
+    '''后台任务线程的基类
+    传入 func(thread)，或由子类重写 task()；其中用 thread.reportProgress 报告进度，
+    用 thread.partial 信号发出中间结果，并定期检查 thread.cancel_event (传给计算函数的 cancel 参数)。
+    返回值由 threadEnd 信号发出。
+    '''
+    # 进度信号: 已完成数目, 总数目, 预计剩余时间(秒, 未知时为 -1)
+    progress = pyqtSignal(int, int, float)
+    # 中间结果信号
+    partial = pyqtSignal(object)
+    # 线程结束的signal，带有计算结果
+    threadEnd = pyqtSignal(object)
+    def __init__(self, func=None):
+        super(Thread_task, self).__init__()
+        if func is None and type(self).task is Thread_task.task:
+            raise TypeError('Thread_task needs a func or a task() override')
+        self.func = func
+        self.cancel_event = threading.Event()
+        self.begintime = time.time()
+    def cancel(self):
+        self.cancel_event.set()
+    def isCancelled(self):
+        return self.cancel_event.is_set()
+    def reportProgress(self, done, total):
+        elapsed = time.time() - self.begintime
+        eta = elapsed / done * (total - done) if done > 0 else -1
+        self.progress.emit(done, total, eta)
+    def task(self):
+        return self.func(self)
+    def run(self):
+        # 线程所需要执行的代码
+        self.begintime = time.time()
+        result = self.task()
+        self.threadEnd.emit(result)
+
+class Thread_calcSas(Thread_task):
+    '''计算SAS曲线，每算完一个q切片就通过 partial 发出 (index, I_slice)
+    '''
+    def __init__(self, data, q, lmax, parallel, cpu_usage, proc_num):
         super(Thread_calcSas, self).__init__()
+        self.data = data
         self.q = q
-        self.points = points
-        self.sld = sld
         self.lmax = lmax
         self.parallel = parallel
         self.cpu_usage = cpu_usage
-    def run(self):
-        # 线程所需要执行的代码
+        self.proc_num = proc_num
+        self.done = 0
+    def sliceFinished(self, index, I_slice):
+        self.done += index.size
+        self.partial.emit((index, I_slice))
+        self.reportProgress(self.done, self.q.size)
+    def task(self):
         print('doing thread')
-        if self.parallel:
-            I = intensity_parallel(self.q, self.points, self.sld, self.lmax, cpu_usage=self.cpu_usage, proc_num=self.proc_num)
-        else:
-            #I = intensity_parallel(self.q, self.points, self.sld, self.lmax, proc_num=1)
-            I = intensity(self.q, self.points, self.sld, self.lmax)
-            I = I.tolist()
-        self.threadEnd.emit(I)
+        self.data.calcSas(self.q, lmax=self.lmax, parallel=self.parallel, cpu_usage=self.cpu_usage, proc_num=self.proc_num, callback=self.sliceFinished, cancel=self.cancel_event)
+        return self.data.I
+
+
+
+class Thread_previewSas(Thread_task):
+    '''逐级计算SAS曲线：先用粗粒化模型、小lmax、少量q快速出图，再逐步细化，
+    每完成一级就通过 partial 发出 (q, I, stage)
+    '''
+    def __init__(self, data, qmin, qmax, qnum, lmax, parallel, cpu_usage, proc_num):
+        super(Thread_previewSas, self).__init__()
+        self.data = data
+        self.qmin, self.qmax, self.qnum, self.lmax = qmin, qmax, qnum, lmax
+        self.parallel = parallel
+        self.cpu_usage = cpu_usage
+        self.proc_num = proc_num
+    def stageFinished(self, i, n, q, I, stage_info):
+        self.partial.emit((q, I, stage_info))
+        self.reportProgress(i+1, n)
+    def task(self):
+        self.data.calcSasProgressive(self.qmin, self.qmax, qnum=self.qnum, lmax=self.lmax, parallel=self.parallel, cpu_usage=self.cpu_usage, proc_num=self.proc_num, callback=self.stageFinished, cancel=self.cancel_event)
+        return self.data.I
+
+class Thread_genPoints(Thread_task):
+    '''生成点模型，先用 partial 发出一个粗网格的预览 (points_with_sld, interval)，
+    再按模型分块计算细网格，并报告每个模型、每个分块的进度
+    '''
+    def __init__(self, project, interval, grid_num, preview_grid_num=2000):
+        super(Thread_genPoints, self).__init__()
+        self.project = project
+        self.interval = interval
+        self.grid_num = grid_num
+        self.preview_grid_num = preview_grid_num
+    def sectionProgress(self, name, i, n, done, total):
+        # 总进度 = (已完成模型数 + 当前模型完成比例) / 模型数
+        self.reportProgress(int(1000 * (i + done/total) / n), 1000)
+    def task(self):
+        if self.interval or self.grid_num > self.preview_grid_num:
+            self.partial.emit(self.project.model.genPreviewPoints(grid_num=self.preview_grid_num))
+        if self.isCancelled():
+            return False
+        return self.project.genPoints(interval=self.interval, grid_num=self.grid_num, incremental=True, progress=self.sectionProgress, cancel=self.cancel_event)
 
 
 
@@ -153,6 +229,8 @@ class mainwindowFunction:
         controlPanel = ControlPanelWindow()
         controlPanel.pushButton_genPoints.clicked.connect(self.genPoints)
         controlPanel.pushButton_calcSas.clicked.connect(self.calcSas)
+        controlPanel.pushButton_preview.clicked.connect(self.previewSas)
+        controlPanel.pushButton_cancel.clicked.connect(self.cancelTask)
         self.controlPanel = controlPanel
         self.ui.mdiArea.addSubWindow(self.controlPanel)
         self.controlPanel.show()
@@ -227,6 +305,8 @@ class mainwindowFunction:
             self.tableModel_stlmodels.setItem(i, 0, item1)
             item2 = QStandardItem(str(stlmodel.sld))
             self.tableModel_stlmodels.setItem(i, 1, item2)
+        # 修改sld后只标记该section，genPoints时不必重新计算
+        self.tableModel_stlmodels.itemChanged.connect(self.editStlmodelSld)
 
         self.tableModel_mathmodels = QStandardItemModel(n_mathmodels, 1)
         self.tableModel_mathmodels.setHorizontalHeaderLabels(['model'])
@@ -240,6 +320,16 @@ class mainwindowFunction:
             self.tableModel_mathmodels.setItem(i, 0, item1)
         
 
+    def editStlmodelSld(self, item):
+        if item.column() != 1:
+            return
+        stlmodel = self.project.model.stlmodel_list[item.row()]
+        try:
+            stlmodel.sld = float(item.text())
+        except ValueError:
+            print('invalid sld: {}'.format(item.text()))
+            item.setText(str(stlmodel.sld))
+
     # 仍然不显示legend！！！
     def showStlModels(self):
         indexes = self.ui.tableView_stlmodels.selectionModel().selectedRows()
@@ -273,52 +363,79 @@ class mainwindowFunction:
         mathmodelView.graphicsView.setScene(graphicScene)
         self.ui.mdiArea.addSubWindow(mathmodelView)
         mathmodelView.show()
-    def showPointsWithSld(self):
+    def showPointsWithSld(self, points_with_sld=None, interval=None, title=None):
+        if points_with_sld is None:
+            points_with_sld, interval = self.project.points_with_sld, self.project.model.interval
         canvas = Figure_Canvas(figsize=(5,4))
-        plotPointsWithSld(self.project.points_with_sld, show=False, figure=canvas.figure)
+        plotPointsWithSld(points_with_sld, show=False, figure=canvas.figure, interval=interval)
         graphicScene = QtWidgets.QGraphicsScene()
         graphicScene.addWidget(canvas)
         pointsWithSldView = pointsWithSldViewWindow()
         pointsWithSldView.graphicsView.setScene(graphicScene)
-        interval = self.project.model.interval
         pointsWithSldView.label_interval.setText('interval = {:.4f}'.format(interval))
+        if title is not None:
+            pointsWithSldView.setWindowTitle(title)
         self.ui.mdiArea.addSubWindow(pointsWithSldView)
         pointsWithSldView.show()
+        return pointsWithSldView
     def showSasCurve(self):
         canvas = Figure_Canvas(figsize=(5,4))
-        plotSasCurve(self.project.data.q, self.project.data.I, show=False, figure=canvas.figure)
+        self.sasCanvas = canvas
+        self.refreshSasCurve()
         graphicScene = QtWidgets.QGraphicsScene()
         graphicScene.addWidget(canvas)
         sasdataView = sasdataViewWindow()
         sasdataView.graphicsView.setScene(graphicScene)
         self.ui.mdiArea.addSubWindow(sasdataView)
         sasdataView.show()
+    def refreshSasCurve(self, q=None, I=None):
+        # 只画已经算完的q，用于计算过程中逐步更新曲线
+        if q is None:
+            q, I = self.project.data.q, self.project.data.I
+        q, I = np.asarray(q), np.asarray(I)
+        finished = ~np.isnan(I)
+        self.sasCanvas.figure.clear()
+        plotSasCurve(q[finished], I[finished], show=False, figure=self.sasCanvas.figure)
+        self.sasCanvas.draw()
 
 
 
     def genPoints(self):
+        if self.isTaskRunning():
+            return
         thisControlPanel = self.controlPanel
         grid_num = thisControlPanel.lineEdit_gridPointsNum.text()
         interval = thisControlPanel.lineEdit_interval.text()
         if interval != '':
             interval = float(interval)
-            self.project.genPoints(interval=interval)
+            grid_num = 10000
         else:
+            interval = None
             grid_num = int(grid_num)
-            self.project.genPoints(grid_num=grid_num)
-        self.showPointsWithSld()
-
-    # 目前这里异步还会报错，还未解决！
-    def calcSas(self):
-        self.project.setupData()
+        # 在后台线程中生成点模型，避免界面卡住
+        thread_genPoints = Thread_genPoints(self.project, interval, grid_num)
+        thread_genPoints.partial.connect(self.processGenPointsPreview)
+        thread_genPoints.threadEnd.connect(self.processGenPointsThreadOutput)
+        self.startTask(thread_genPoints)
+    def processGenPointsPreview(self, preview):
+        points_with_sld, interval = preview
+        self.previewView = self.showPointsWithSld(points_with_sld, interval, title='points model preview')
+    def processGenPointsThreadOutput(self, finished):
+        self.endTask()
+        if finished:
+            # 细网格算完后关闭预览窗口
+            preview_view = getattr(self, 'previewView', None)
+            if preview_view is not None:
+                preview_view.parentWidget().close()
+                self.previewView = None
+            self.showPointsWithSld()
+
+    def readCalcSasSettings(self):
         thisControlPanel = self.controlPanel
         qmin = float(thisControlPanel.lineEdit_qmin.text())
         qmax = float(thisControlPanel.lineEdit_qmax.text())
         qnum = int(thisControlPanel.lineEdit_qnum.text())
         lmax = int(thisControlPanel.lineEdit_lmax.text())
-        q = self.project.data.genQ(qmin, qmax, qnum=qnum)
-        self.project.data.q = q
-        self.project.data.lmax = lmax
         parallel = thisControlPanel.checkBox_parallel.isChecked()
         cpu_usage = float(thisControlPanel.lineEdit_cpuUsage.text())
         proc_num = thisControlPanel.lineEdit_processNum.text()
@@ -326,18 +443,89 @@ class mainwindowFunction:
             proc_num = int(proc_num)
         else:
             proc_num = None
-        # 异步线程计算SAS
-        points = self.project.data.points
-        sld = self.project.data.slds
-        thread_calcSas = Thread_calcSas(q, points, sld, lmax, parallel, cpu_usage, proc_num)
+        return qmin, qmax, qnum, lmax, parallel, cpu_usage, proc_num
+    def calcSas(self):
+        if self.isTaskRunning():
+            return
+        self.project.setupData()
+        qmin, qmax, qnum, lmax, parallel, cpu_usage, proc_num = self.readCalcSasSettings()
+        q = self.project.data.genQ(qmin, qmax, qnum=qnum)
+        self.project.data.q = q
+        self.project.data.lmax = lmax
+        # 先显示一条空曲线，计算过程中每完成一个q切片就更新一次
+        self.project.data.I = np.full(q.size, np.nan, dtype='float32')
+        self.showSasCurve()
+        # 异步线程计算SAS，线程对象要保存下来，否则会被回收
+        thread_calcSas = Thread_calcSas(self.project.data, q, lmax, parallel, cpu_usage, proc_num)
+        thread_calcSas.partial.connect(self.processCalcSasPartial)
         thread_calcSas.threadEnd.connect(self.processCalcSasThreadOutput)
-        thread_calcSas.start()
+        self.startTask(thread_calcSas)
+    def processCalcSasPartial(self, partial):
+        index, I_slice = partial
+        I = np.array(self.project.data.I)
+        I[index] = I_slice
+        self.project.data.I = I
+        self.refreshSasCurve()
     def processCalcSasThreadOutput(self, I):
         self.project.data.I = I
         self.project.data.error = 0.001 * I  # 默认生成千分之一的误差，主要用于写文件的占位
-        self.showSasCurve()
+        self.refreshSasCurve()
+        self.endTask()
+        # 开启instrument时把各阶段的耗时和内存报告输出到console
+        if Instrument.enabled:
+            print(Instrument.reportJson())
+
+    def previewSas(self):
+        '''快速预览：不到一秒先出一条粗略曲线，然后在后台逐级细化直到设定的精度'''
+        if self.isTaskRunning():
+            return
+        self.project.setupData()
+        qmin, qmax, qnum, lmax, parallel, cpu_usage, proc_num = self.readCalcSasSettings()
+        self.previewSasCanvas = None
+        thread_previewSas = Thread_previewSas(self.project.data, qmin, qmax, qnum, lmax, parallel, cpu_usage, proc_num)
+        thread_previewSas.partial.connect(self.processPreviewSasStage)
+        thread_previewSas.threadEnd.connect(self.processPreviewSasThreadOutput)
+        self.startTask(thread_previewSas)
+    def processPreviewSasStage(self, partial):
+        q, I, stage = partial
+        # 第一级出来时打开曲线窗口，之后每一级替换曲线
+        if self.previewSasCanvas is None:
+            self.showSasCurve()
+            self.previewSasCanvas = self.sasCanvas
+        self.sasCanvas = self.previewSasCanvas
+        self.refreshSasCurve(q, I)
+    def processPreviewSasThreadOutput(self, I):
+        self.endTask()
+
+    def isTaskRunning(self):
+        '''同一时间只运行一个后台任务'''
+        if getattr(self, 'thread_task', None) is not None and self.thread_task.isRunning():
+            print('another task is running, please wait or cancel it')
+            return True
+        return False
+    def startTask(self, thread_task):
+        self.thread_task = thread_task
+        thread_task.progress.connect(self.showProgress)
+        self.controlPanel.progressBar.setValue(0)
+        self.controlPanel.progressBar.setFormat('%p%')
+        self.controlPanel.pushButton_cancel.setEnabled(True)
+        thread_task.start()
+    def endTask(self):
+        self.controlPanel.pushButton_cancel.setEnabled(False)
+        if self.thread_task.isCancelled():
+            self.controlPanel.progressBar.setFormat('%p% (cancelled)')
+        else:
+            self.controlPanel.progressBar.setValue(100)
+            self.controlPanel.progressBar.setFormat('%p%')
+    def showProgress(self, done, total, eta):
+        self.controlPanel.progressBar.setValue(int(100 * done / max(total, 1)))
+        if eta >= 0:
+            self.controlPanel.progressBar.setFormat('%p%  ETA {:.0f} s'.format(eta))
+    def cancelTask(self):
+        if getattr(self, 'thread_task', None) is not None and self.thread_task.isRunning():
+            print('cancelling...')
+            self.thread_task.cancel()
 
-        
     def deleteModels(self):
         print(self.controlPanel)
 
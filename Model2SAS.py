@@ -1,15 +1,18 @@
 # -*- coding: UTF-8 -*-
 
 import os
+import json
+import time
+import itertools
 import numpy as np
-from stl import mesh
-from mpl_toolkits import mplot3d
-import matplotlib.pyplot as plt
-from shutil import copyfile
+from multiprocessing import cpu_count
 
-from ModelSection import stlmodel, mathmodel
-from Functions import intensity, xyz2sph, intensity_parallel
-from Plot import *
+from ModelSection import stlmodel, mathmodel, expressionmodel
+from Functions import intensity_parallel, refineQ, coarseGrain, beadCorrection, latticePoints, latticeChunks, intensity_batch, sliceQ, genQ, relativeChange, resolveExecutor, pattern2d, detectorQ
+from Instrument import stage
+import FileIO
+# plotting (matplotlib) is not imported here, import Plot where it is needed,
+# so that headless use (e.g. Batch.py) starts fast
 
 
 class model2sas:
@@ -54,36 +57,465 @@ class model2sas:
             self.model.importStlFile(filepath, sld)
         elif filetype == 'py':
             self.model.importMathFile(filepath)
+        elif filetype in ('txt', 'dat', 'npy', 'npz', 'h5', 'hdf5'):
+            self.model.importPointsFile(filepath)
+            self.points_with_sld = self.model.points_with_sld
 
-    def genPoints(self, interval=None, grid_num=10000):
-        self.model.genPoints(interval=interval, grid_num=grid_num)
-        self.points_with_sld = self.model.points_with_sld
+    def importExpression(self, shape, sld, coord='xyz', params=None, boundary_min=None, boundary_max=None, name='expression model'):
+        self.model.importExpressionModel(shape, sld, coord=coord, params=params, boundary_min=boundary_min, boundary_max=boundary_max, name=name)
+
+    def genPoints(self, interval=None, grid_num=10000, octree=False, octree_levels=3, incremental=False, progress=None, cancel=None, pool_executor=None):
+        finished = self.model.genPoints(interval=interval, grid_num=grid_num, octree=octree, octree_levels=octree_levels, incremental=incremental, progress=progress, cancel=cancel, pool_executor=pool_executor)
+        if finished:
+            self.points_with_sld = self.model.points_with_sld
+        return finished
 
     def savePointsWithSld(self, filename):
-        header = 'x\ty\tz\tsld'
-        np.savetxt(filename, self.points_with_sld, header=header)
+        '''File type is decided by extension, see FileIO'''
+        FileIO.savePointsWithSld(filename, self.points_with_sld, interval=self.model.interval)
+
+    def saveGrid(self, filename):
+        '''Save occupancy (sld) grid as .npz or .h5 file'''
+        FileIO.saveGrid(filename, self.model.lattice, self.model.sld_grid_index)
 
     def setupData(self):
-        self.data = data(self.model.points_with_sld)
+        self.data = data(self.model.points_with_sld, interval=self.model.interval, lattice=self.model.lattice)
 
-    def calcSas(self, qmin, qmax, qnum=200, logq=False, lmax=50, parallel=True, cpu_usage=0.6):
-        q = self.data.genQ(qmin, qmax, qnum=qnum, logq=logq)
-        self.data.calcSas(q, lmax=lmax, parallel=parallel, cpu_usage=cpu_usage)
+    def calcSas(self, qmin, qmax, qnum=200, logq=False, lmax=50, parallel=True, cpu_usage=0.6, adaptive=False, qnum_max=None, tol=0.05, coarse_grain=False, proc_num=None, pool=None, checkpoint=None, callback=None, cancel=None, backend='process'):
+        if adaptive:
+            # qnum is the number of initial coarse q values in adaptive mode
+            self.data.calcSasAdaptive(qmin, qmax, qnum=qnum, qnum_max=qnum_max, tol=tol, logq=logq, lmax=lmax, parallel=parallel, cpu_usage=cpu_usage, proc_num=proc_num, pool=pool, backend=backend)
+        else:
+            q = self.data.genQ(qmin, qmax, qnum=qnum, logq=logq)
+            self.data.calcSas(q, lmax=lmax, parallel=parallel, cpu_usage=cpu_usage, coarse_grain=coarse_grain, proc_num=proc_num, pool=pool, checkpoint=checkpoint, callback=callback, cancel=cancel, backend=backend)
         self.q = self.data.q
         self.I = self.data.I
         #self.saveSasData()
 
+    def calcPattern2d(self, qx, qy, rotations=None, weights=None, method='direct', wavelength=None, oversample=2):
+        '''2D scattering pattern of oriented particles on a detector grid
+        qx, qy and wavelength give the q vectors of pixels, see
+        Functions.detectorQ. rotations (and weights of an orientation
+        distribution) are e.g. from Functions.orientationSamples, see
+        Functions.pattern2d for methods.
+
+        Returns:
+            I2d: ndarray, shape == (ny, nx), or (n, ny, nx) for n rotations without weights
+        '''
+        q = detectorQ(qx, qy, wavelength=wavelength)
+        self.data.calcPattern2d(q, rotations=rotations, weights=weights, method=method, oversample=oversample)
+        self.q2d = self.data.q2d
+        self.I2d = self.data.I2d
+        return self.I2d
+
+    def autoTune(self, qmin, qmax, tol=0.01, qnum=200, logq=False, pilot_qnum=16, grid_num_list=(2000, 4000, 8000, 16000, 32000, 64000, 128000), lmax_list=(10, 15, 20, 30, 40, 50, 60, 80, 100), cpu_usage=0.6, proc_num=None, pool=None, run=False):
+        '''Choose the cheapest grid_num and lmax that meet an error target
+        Pilot calculations are done with only pilot_qnum q values in the
+        same q range. lmax is increased until the curve changes less than
+        tol/2 (on the smallest grid), then grid_num is increased (with the
+        chosen lmax) until the curve changes less than tol/2. Change of the
+        curve is measured by relativeChange, and the changes of the chosen
+        settings are used as error estimates.
+
+        Runtime of the full calculation is predicted from the pilot runs,
+        with calcSas time proportional to points * (lmax+1)**2 * qnum.
+
+        Args:
+            tol: float, target of relative error of I
+            run: bool, also run genPoints and calcSas with the chosen settings
+
+        Returns:
+            dict, chosen grid_num, interval, lmax, estimated error and
+            predicted time (sec) of genPoints and calcSas. converged_lmax
+            and converged_grid are False if the largest value of the list
+            is used without converging, its error is then nan.
+        '''
+        q_pilot = genQ(qmin, qmax, qnum=pilot_qnum, logq=logq)
+        pilot_runs = []
+
+        def pilot(grid_num, lmax):
+            begintime = time.perf_counter()
+            self.genPoints(grid_num=grid_num)
+            self.setupData()
+            time_genPoints = time.perf_counter() - begintime
+            begintime = time.perf_counter()
+            self.data.calcSas(q_pilot, lmax=lmax, cpu_usage=cpu_usage, proc_num=proc_num, pool=pool)
+            time_calcSas = time.perf_counter() - begintime
+            pilot_runs.append({
+                'grid_num': grid_num, 'lmax': lmax, 'points': self.points_with_sld.shape[0],
+                'interval': self.model.interval, 'time_genPoints': time_genPoints, 'time_calcSas': time_calcSas,
+            })
+            # I(0) = 4*pi*(sum of sld)**2 depends on points number,
+            # so I is normalized to compare curves of different grids
+            return np.array(self.data.I, dtype='float64') / np.sum(self.points_with_sld[:, 3])**2
+
+        def converge(values, calc):
+            ''' first value whose curve changes less than tol/2 at the next value
+            Returns (value, error, converged), if none converges the largest
+            value is used and its error is unknown (nan).
+            '''
+            I_last = calc(values[0])
+            change = np.inf
+            for value, next_value in zip(values[:-1], values[1:]):
+                I_next = calc(next_value)
+                change = relativeChange(I_last, I_next)
+                print('pilot {} -> {}: change {:.4f}'.format(value, next_value, change))
+                if change < tol/2:
+                    return value, change, True
+                I_last = I_next
+            print('not converged (last change {:.4f}), use the largest value: {}'.format(change, values[-1]))
+            return values[-1], np.nan, False
+
+        print('auto tune lmax')
+        lmax, error_lmax, converged_lmax = converge(list(lmax_list), lambda lmax: pilot(grid_num_list[0], lmax))
+        print('auto tune grid_num')
+        grid_num, error_grid, converged_grid = converge(list(grid_num_list), lambda grid_num: pilot(grid_num, lmax))
+
+        chosen = [run for run in pilot_runs if run['grid_num'] == grid_num and run['lmax'] == lmax][0]
+        # the largest pilot gives the least overhead-dominated rate
+        largest = max(pilot_runs, key=lambda run: run['points'] * (run['lmax']+1)**2)
+        rate = largest['time_calcSas'] / (largest['points'] * (largest['lmax']+1)**2 * pilot_qnum)
+        settings = {
+            'grid_num': grid_num,
+            'interval': chosen['interval'],
+            'lmax': lmax,
+            'qnum': qnum,
+            'points': chosen['points'],
+            'error_lmax': error_lmax,
+            'error_grid': error_grid,
+            'error': error_lmax + error_grid,
+            'converged_lmax': converged_lmax,
+            'converged_grid': converged_grid,
+            'converged': converged_lmax and converged_grid,
+            'time_genPoints': chosen['time_genPoints'],
+            'time_calcSas': rate * chosen['points'] * (lmax+1)**2 * qnum,
+            'time_pilot': sum(run['time_genPoints'] + run['time_calcSas'] for run in pilot_runs),
+        }
+        settings['time'] = settings['time_genPoints'] + settings['time_calcSas']
+        print('auto tune: grid_num={grid_num} (interval {interval:.4g}, {points} points), lmax={lmax}, estimated error {error:.4f}, predicted time {time:.1f} sec'.format(**settings))
+        if not settings['converged']:
+            print('auto tune: not converged for {}, error target {} may not be met'.format(
+                ' and '.join(name for name, flag in (('lmax', converged_lmax), ('grid_num', converged_grid)) if not flag), tol))
+        self.tuned_settings = settings
+
+        if run:
+            self.genPoints(grid_num=grid_num)
+            self.setupData()
+            self.calcSas(qmin, qmax, qnum=qnum, logq=logq, lmax=lmax, cpu_usage=cpu_usage, proc_num=proc_num, pool=pool)
+        return settings
+
+    def sweepParams(self, param_grid, qmin, qmax, qnum=200, logq=False, lmax=50, mathmodel_index=0, interval=None, grid_num=10000, batch_size=64, cpu_usage=0.6, proc_num=None, pool=None, backend='process', output=None):
+        '''Calculate SAS curves over a parameter grid of one math model
+        Lattice and other model sections are set up only once. For each batch
+        of parameter sets, the swept math model is evaluated on the same
+        lattice, and all the sld distributions of the batch share the same
+        basis tables (see intensity_batch). q slices of all batches are sent
+        to one pool, pool and backend are as in intensity_parallel.
+
+        The boundary of the math model is not changed by params, so please
+        set params that give the largest model before sweep.
+
+        Args:
+            param_grid: dict, {param_name: list of values}, all combinations are calculated
+            output: .npy filename, if given, I is streamed into this file
+                (as memory map) batch by batch
+
+        Returns:
+            param_list: list of dict, params of each row of I
+            q: 1darray
+            I: ndarray, shape == (len(param_list), q.size)
+        '''
+        names = list(param_grid.keys())
+        param_list = [dict(zip(names, values)) for values in itertools.product(*[param_grid[name] for name in names])]
+        swept = self.model.mathmodel_list[mathmodel_index]
+        default_params = dict(swept.specific_mathmodel.params)
+
+        # lattice and sld of all the other sections, only once
+        lattice, interval = self.model._lattice(interval, grid_num)
+        n = lattice[0].size * lattice[1].size * lattice[2].size
+        base_sld = np.zeros(n)
+        for section in self.model.stlmodel_list + self.model.mathmodel_list:
+            section.importLattice(lattice)
+            if section is not swept:
+                section.calcInModelGridIndex(sld_buffer=base_sld)
+
+        q = genQ(qmin, qmax, qnum=qnum, logq=logq)
+        pool_executor = resolveExecutor(pool, backend, proc_num, cpu_usage)
+        q_list = sliceQ(q, pool_executor.proc_num)
+        if output:
+            I = np.lib.format.open_memmap(output, mode='w+', dtype='float32', shape=(len(param_list), q.size))
+        else:
+            I = np.zeros((len(param_list), q.size), dtype='float32')
+
+        try:
+            with pool_executor:
+                for begin in range(0, len(param_list), batch_size):
+                    batch = param_list[begin:begin+batch_size]
+                    sld_list = []
+                    for params in batch:
+                        swept.specific_mathmodel.params.update(params)
+                        sld = base_sld.copy()
+                        swept.calcInModelGridIndex(sld_buffer=sld)
+                        sld_list.append(sld)
+                    sld_stack = np.vstack(sld_list)
+                    # only points occupied in any model of this batch
+                    index = np.where(np.any(sld_stack != 0, axis=0))[0]
+                    points = latticePoints(lattice, index)
+                    F = sld_stack[:, index]
+                    del sld_list, sld_stack
+                    I_list = pool_executor.starmap(intensity_batch, [(q_slice, points, F, lmax) for q_slice in q_list])
+                    I[begin:begin+len(batch)] = np.hstack(I_list)
+                    if output:
+                        I.flush()
+                    print('{}/{} parameter sets finished'.format(begin+len(batch), len(param_list)))
+        finally:
+            swept.specific_mathmodel.params.update(default_params)
+        return param_list, q, I
+
+    def calcSeries(self, filepath_list, qmin, qmax, sld=1, qnum=200, logq=False, lmax=50, interval=None, grid_num=10000, batch_size=16, cpu_usage=0.6, proc_num=None, pool=None, backend='process', output=None):
+        '''Calculate SAS curves of a series of stl files (frames of the same object)
+        All the frames use one lattice (covering all frames) and one q grid.
+        Frames are voxelized in parallel batch by batch, and all the frames
+        of a batch share the same basis tables (see intensity_batch).
+        Boundaries, voxelization and intensity of all batches run on one
+        pool, pool and backend are as in intensity_parallel.
+
+        If output (.npy) is given, I is streamed into it, and progress is
+        recorded in output+'.json'. Running again with the same frames, q and
+        lmax only calculates the frames not finished yet.
+
+        Returns:
+            q: 1darray
+            I: ndarray, shape == (len(filepath_list), q.size), I[i] is the curve of frame i
+        '''
+        filepath_list = [os.path.abspath(filepath) for filepath in filepath_list]
+        q = genQ(qmin, qmax, qnum=qnum, logq=logq)
+        with resolveExecutor(pool, backend, proc_num, cpu_usage) as pool_executor:
+            q_list = sliceQ(q, pool_executor.proc_num)
+
+            # one lattice for all frames
+            boundary_list = pool_executor.starmap(_frameBoundary, [(filepath,) for filepath in filepath_list])
+            boundary_min = np.min(np.vstack([boundary[0] for boundary in boundary_list]), axis=0)
+            boundary_max = np.max(np.vstack([boundary[1] for boundary in boundary_list]), axis=0)
+            if not interval:
+                scale = boundary_max - boundary_min
+                interval = (scale[0]*scale[1]*scale[2] / grid_num)**(1/3)
+            lattice = self.model._genLattice(boundary_min, boundary_max, interval)
+
+            # resume from output file if it is the same calculation
+            status = {'files': filepath_list, 'q': q.tolist(), 'lmax': int(lmax), 'interval': float(interval), 'done': [False]*len(filepath_list)}
+            status_file = '{}.json'.format(output)
+            I = None
+            if output and os.path.exists(output) and os.path.exists(status_file):
+                with open(status_file, 'r') as f:
+                    old_status = json.load(f)
+                if all(old_status[key] == status[key] for key in ('files', 'q', 'lmax', 'interval')):
+                    status = old_status
+                    I = np.load(output, mmap_mode='r+')
+                    print('resume from {}: {}/{} frames finished'.format(output, sum(status['done']), len(filepath_list)))
+            if I is None:
+                if output:
+                    I = np.lib.format.open_memmap(output, mode='w+', dtype='float32', shape=(len(filepath_list), q.size))
+                else:
+                    I = np.zeros((len(filepath_list), q.size), dtype='float32')
+
+            todo = [i for i in range(len(filepath_list)) if not status['done'][i]]
+            for begin in range(0, len(todo), batch_size):
+                batch = todo[begin:begin+batch_size]
+                index_list = pool_executor.starmap(_voxelizeFrame, [(filepath_list[i], lattice) for i in batch])
+                # only points occupied in any frame of this batch
+                index = np.unique(np.hstack(index_list))
+                points = latticePoints(lattice, index)
+                F = sld * np.vstack([np.isin(index, frame_index) for frame_index in index_list]).astype('float32')
+                I_list = pool_executor.starmap(intensity_batch, [(q_slice, points, F, lmax) for q_slice in q_list])
+                I[batch] = np.hstack(I_list)
+                if output:
+                    I.flush()
+                    for i in batch:
+                        status['done'][i] = True
+                    with open(status_file, 'w') as f:
+                        json.dump(status, f)
+                print('{}/{} frames finished'.format(len(filepath_list)-len(todo)+begin+len(batch), len(filepath_list)))
+
+        return q, I
+
+    def saveProject(self, dirpath):
+        '''Save the project into a directory, see FileIO.projectfile
+        Saved: model files (path and content hash), sld and params, section
+        occupancy on the stable lattice (from incremental genPoints), points
+        model, and calculated q, I and error. Open it by openProject.
+        '''
+        store = FileIO.projectfile(dirpath)
+        store.manifest = {'arrays': {}, 'name': self.name, 'version': 1}
+        model = self.model
+
+        models = []
+        for i, section in enumerate(model.stlmodel_list + model.mathmodel_list):
+            info = {'name': section.name}
+            if isinstance(section, expressionmodel):
+                expression = section.specific_mathmodel
+                info.update({
+                    'type': 'expression',
+                    'shape': expression.shape_expression,
+                    'sld': expression.sld_expression,
+                    'coord': expression.coord,
+                    'params': _jsonParams(expression.params),
+                    'boundary_min': expression.boundary_min.tolist(),
+                    'boundary_max': expression.boundary_max.tolist(),
+                })
+            else:
+                info.update({'path': section.filepath, 'stat': _fileStat(section.filepath), 'sha256': FileIO.fileHash(section.filepath)})
+                if isinstance(section, stlmodel):
+                    info.update({'type': 'stl', 'sld': section.sld})
+                else:
+                    info.update({'type': 'math', 'params': _jsonParams(section.specific_mathmodel.params)})
+            if getattr(section, 'box', None) is not None:
+                section.ensureBox()
+                info['box'] = [section.box[0].tolist(), section.box[1].tolist()]
+                info['box_interval'] = section.box_interval
+                store.saveArray('box_in_model_{}'.format(i), section.box_in_model != 0)
+                if not isinstance(section, stlmodel):
+                    store.saveArray('box_sld_{}'.format(i), section.box_sld)
+            models.append(info)
+        store.manifest['models'] = models
+
+        model_info = {'interval': getattr(model, 'interval', None)}
+        state = getattr(model, 'incremental_state', None)
+        if state is not None:
+            model_info['incremental'] = {key: (value.tolist() if hasattr(value, 'tolist') else value) for key, value in state.items() if key != 'combined'}
+            store.saveArray('combined', state['combined'])
+        if getattr(model, 'points_with_sld', None) is not None:
+            store.saveArray('points_with_sld', model.points_with_sld)
+        store.manifest['model'] = model_info
+
+        data = getattr(self, 'data', None)
+        if data is not None and getattr(data, 'I', None) is not None:
+            store.saveArray('q', data.q)
+            store.saveArray('I', np.asarray(data.I))
+            store.saveArray('error', np.asarray(data.error))
+            store.manifest['calc'] = {'lmax': data.lmax}
+        store.saveManifest()
+        self.store = store
+
     def saveSasData(self, filename):
-        header = 'q\tI\tpseudo error(I/1000)'
-        data = np.vstack((self.q, self.I, self.data.error)).T
-        np.savetxt(filename, data, header=header)
+        '''File type is decided by extension, see FileIO'''
+        FileIO.saveSasData(filename, self.q, self.I, self.data.error)
 
 
 
 
+def _jsonParams(params):
+    return {key: (value.tolist() if hasattr(value, 'tolist') else value) for key, value in params.items()}
+
+
+def _fileStat(filepath):
+    stat = os.stat(filepath)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def _modelFileChanged(info):
+    '''Whether a model file is changed since it was saved in project
+    Hash is only calculated when size or mtime differs.
+    '''
+    if _fileStat(info['path']) == info['stat']:
+        return False
+    return FileIO.fileHash(info['path']) != info['sha256']
+
+
+def openProject(dirpath):
+    '''Open a project saved by model2sas.saveProject
+    Model files are imported again (and checked by content hash), other
+    arrays are memory mapped or loaded only when they are used, so opening
+    is fast even for a large project.
+
+    Returns:
+        model2sas object
+    '''
+    store = FileIO.projectfile(dirpath)
+    manifest = store.manifest
+    project = model2sas(manifest['name'])
+    project.store = store
+    model = project.model
+
+    for i, info in enumerate(manifest['models']):
+        if info['type'] == 'expression':
+            model.importExpressionModel(info['shape'], info['sld'], coord=info['coord'], params=info['params'], boundary_min=info['boundary_min'], boundary_max=info['boundary_max'], name=info['name'])
+            section = model.mathmodel_list[-1]
+        elif info['type'] == 'stl':
+            model.importStlFile(info['path'], info['sld'])
+            section = model.stlmodel_list[-1]
+        else:
+            model.importMathFile(info['path'])
+            section = model.mathmodel_list[-1]
+            section.specific_mathmodel.params.update(info['params'])
+        changed = 'path' in info and _modelFileChanged(info)
+        if changed:
+            print('{} changed since project was saved, it will be recalculated'.format(info['path']))
+        if 'box' in info and not changed:
+            section.box = (np.array(info['box'][0]), np.array(info['box'][1]))
+            section.box_interval = info['box_interval']
+            section.dirty, section.sld_dirty = False, False
+            if info['type'] != 'stl':
+                section.box_params = dict(section.specific_mathmodel.params)
+            section.box_loader = _boxLoader(store, i, section, info['type'] == 'stl')
+        elif 'box' in info:
+            # the saved combined grid still holds the old voxels of this section
+            model.removed_boxes.append((np.array(info['box'][0]), np.array(info['box'][1])))
+
+    model_info = manifest.get('model', {})
+    model.interval = model_info.get('interval')
+    if 'points_with_sld' in store:
+        model.points_with_sld = store.loadArray('points_with_sld')
+        model.points = model.points_with_sld[:,:3]
+        project.points_with_sld = model.points_with_sld
+    if 'incremental' in model_info and 'combined' in store:
+        state = dict(model_info['incremental'])
+        state['kmin'], state['kmax'] = np.array(state['kmin']), np.array(state['kmax'])
+        state['combined'] = store.loadArray('combined')
+        model.incremental_state = state
+    if 'I' in store:
+        project.setupData()
+        project.data.q, project.data.I = store.loadArray('q'), store.loadArray('I')
+        project.data.error = store.loadArray('error')
+        project.data.lmax = manifest.get('calc', {}).get('lmax')
+        project.q, project.I = project.data.q, project.data.I
+    return project
+
+
+def _sectionProgress(progress, section, i, n):
+    '''progress(done, total) of one section -> progress(name, i, n, done, total)'''
+    if progress is None:
+        return None
+    return lambda done, total: progress(section.name, i, n, done, total)
+
+
+def _boxLoader(store, i, section, is_stl):
+    def load():
+        box_in_model = store.loadArray('box_in_model_{}'.format(i)).astype('int8')
+        if is_stl:
+            box_sld = section.sld * box_in_model
+        else:
+            box_sld = store.loadArray('box_sld_{}'.format(i))
+        return box_in_model, box_sld
+    return load
+
+
+def _frameBoundary(filepath):
+    return stlmodel(filepath, 1).getBoundaryPoints()
+
+
+def _voxelizeFrame(filepath, lattice):
+    '''Flat lattice index of the points inside one stl frame
+    '''
+    frame = stlmodel(filepath, 1)
+    frame.importLattice(lattice)
+    frame.calcInModelGridIndex(keep_arrays=True)
+    return np.where(frame.in_model_grid_index != 0)[0]
+
+
 class model:
     ''' a 3d model
-    A points model from stl file (.stl) or math description (.py) or saved numpy txt (.txt) file
+    A points model from stl file (.stl) or math description (.py) or saved points file (.txt .npy .npz .h5)
 
     Attributes:
 
@@ -96,11 +528,14 @@ class model:
         self.name = name
         self.stlmodel_list = []
         self.mathmodel_list = []
+        self.removed_boxes = []
 
     def importStlFile(self, filepath, sld):
         filepath = os.path.abspath(filepath)
         sld = float(sld)
         this_stlmodel = stlmodel(filepath, sld)
+        load_info = this_stlmodel.mesh.load_info
+        print('load {}: {} facets, {:.3f} sec, rss {} MB'.format(this_stlmodel.name, load_info['facets'], load_info['time'], None if load_info['rss'] is None else round(load_info['rss'], 1)))
         self.stlmodel_list.append(this_stlmodel)
     
     def importMathFile(self, filepath):
@@ -108,8 +543,36 @@ class model:
         this_mathmodel = mathmodel(filepath)
         self.mathmodel_list.append(this_mathmodel)
 
+    def importPointsFile(self, filepath):
+        '''Use saved points_with_sld directly (.txt .npy .npz .h5)
+        .npy file is memory mapped, so large points model is loaded instantly
+        '''
+        filepath = os.path.abspath(filepath)
+        points_with_sld, interval = FileIO.loadPointsWithSld(filepath)
+        self.grid = None
+        self.lattice = None
+        self.sld_grid_index = None
+        self.interval = interval
+        self.points = points_with_sld[:,:3]
+        self.points_with_sld = points_with_sld
+
+    def importExpressionModel(self, shape, sld, coord='xyz', params=None, boundary_min=None, boundary_max=None, name='expression model'):
+        '''Import a math model defined by expression strings, see expressionmodel
+        '''
+        this_mathmodel = expressionmodel(shape, sld, coord=coord, params=params, boundary_min=boundary_min, boundary_max=boundary_max, name=name)
+        self.mathmodel_list.append(this_mathmodel)
+
+
+    def removeSection(self, section):
+        '''Remove a stlmodel or mathmodel from this model'''
+        if section in self.stlmodel_list:
+            self.stlmodel_list.remove(section)
+        else:
+            self.mathmodel_list.remove(section)
+        if getattr(section, 'box', None) is not None:
+            self.removed_boxes.append(section.box)
 
-    def genPoints(self, interval=None, grid_num=10000):
+    def genPoints(self, interval=None, grid_num=10000, octree=False, octree_levels=3, incremental=False, progress=None, cancel=None, pool_executor=None):
         '''Generate points model from configured several models
         In case of translating or rotating model sections, importing file part
         and generating points model parts are separated.
@@ -117,68 +580,275 @@ class model:
 
         Also, stl model and math model can be used in the same project.
         So in this method, points are generated for all the model section.
+
+        With octree=True, points are generated by _genOctreePoints, and the sld
+        column of points_with_sld is weighted by cell volume (in unit of interval**3).
+
+        With incremental=True, points are generated by _genPointsIncremental
+        on a stable lattice, and only changed sections are recalculated.
+
+        progress(name, i, n, done, total) is called after each block of
+        section i (of n sections) is evaluated. If cancel (e.g.
+        threading.Event) is set, it stops after the current block, and the
+        points model of last run is kept.
+
+        pool_executor (Functions.executor) evaluates the lattice chunks of
+        each section on its workers, e.g. on the nodes of a Broker.
+
+        Returns:
+            bool, False if cancelled
         '''
+        if incremental:
+            with stage('genPoints.incremental'):
+                return self._genPointsIncremental(interval=interval, grid_num=grid_num, progress=progress, cancel=cancel, pool_executor=pool_executor)
+
         # determine the overall boundary first
         stlmodel_list = self.stlmodel_list
         mathmodel_list = self.mathmodel_list
-        min_boundary_points_list, max_boundary_points_list = [], []
-        for stlmodel in stlmodel_list:
-            min_point, max_point = stlmodel.getBoundaryPoints()
-            min_boundary_points_list.append(min_point)
-            max_boundary_points_list.append(max_point)
-        for mathmodel in mathmodel_list:
-            min_point, max_point = mathmodel.getBoundaryPoints()
-            min_boundary_points_list.append(min_point)
-            max_boundary_points_list.append(max_point)
-        min_boundary_points = np.vstack(min_boundary_points_list)
-        max_boundary_points = np.vstack(max_boundary_points_list)
-        boundary_min = np.min(min_boundary_points, axis=0)
-        boundary_max = np.max(max_boundary_points, axis=0)
-
-        # determine interval
-        if interval:
-            interval = interval
-        else:
-            scale = boundary_max - boundary_min
-            # grid_num defauld is 10000
-            interval = (scale[0]*scale[1]*scale[2] / grid_num)**(1/3)
+        boundary_min, boundary_max = self._boundary()
+        interval = self._interval(boundary_min, boundary_max, interval, grid_num)
+
+        if octree:
+            with stage('genPoints.octree'):
+                points_with_sld = self._genOctreePoints(boundary_min, boundary_max, interval, levels=octree_levels)
+            self.grid = None
+            self.lattice = None
+            self.interval = interval
+            self.sld_grid_index = None
+            self.points = points_with_sld[:,:3]
+            self.points_with_sld = points_with_sld
+            return True
+
+        # generate lattice instead of full grid,
+        # model sections are evaluated on generated coordinates chunk by chunk
+        lattice = self._genLattice(boundary_min, boundary_max, interval)
+        # each section only combines into this buffer, no full-size arrays of its own
+        n = lattice[0].size * lattice[1].size * lattice[2].size
 
-        # generate grid
-        grid = self._genGrid(boundary_min, boundary_max, interval)   # shape == (n, 3)
-        
         # calculate in model index for each stlmodel and mathmodel
-        for stlmodel in stlmodel_list:
-            stlmodel.importGrid(grid)
-            stlmodel.calcInModelGridIndex()
-        for mathmodel in mathmodel_list:
-            mathmodel.importGrid(grid)
-            mathmodel.calcInModelGridIndex()
-
-        # combine all the model sections
+        # and combine all the model sections in the same buffer
         # !! ATTENTION !!
         # I choose to use the higher sld value for the overlapped point
-        sld_grid_index_list = []
-        for stlmodel in stlmodel_list:
-            sld_grid_index_list.append(stlmodel.sld_grid_index)
-        for mathmodel in mathmodel_list:
-            sld_grid_index_list.append(mathmodel.sld_grid_index)
-        sld_grid_index_stack = np.vstack(sld_grid_index_list)
-        sld_grid_index = np.max(sld_grid_index_stack, axis=0)
-
-        points = grid[np.where(sld_grid_index!=0)]
-        slds = sld_grid_index[np.where(sld_grid_index!=0)]
-        slds = slds.reshape((slds.size,1))
-        points_with_sld = np.hstack((points, slds))
-
-        self.grid = grid
+        sld_grid_index = np.zeros(n)
+        section_list = stlmodel_list + mathmodel_list
+        for i, section in enumerate(section_list):
+            with stage('genPoints.section.{}'.format(section.name)):
+                section.importLattice(lattice)
+                if section.calcInModelGridIndex(sld_buffer=sld_grid_index, progress=_sectionProgress(progress, section, i, len(section_list)), cancel=cancel, pool_executor=pool_executor) is None:
+                    print('generating points cancelled')
+                    return False
+
+        with stage('genPoints.points'):
+            index = np.where(sld_grid_index!=0)[0]
+            points = latticePoints(lattice, index)
+            slds = sld_grid_index[index]
+            slds = slds.reshape((slds.size,1))
+            points_with_sld = np.hstack((points, slds))
+
+        self.grid = None
+        self.lattice = lattice
         self.interval = interval
         self.sld_grid_index = sld_grid_index
         self.stlmodel_list = stlmodel_list
         self.points = points
         self.points_with_sld = points_with_sld # shape==(n, 4) 前三列是坐标，最后一列是相应的sld
+        return True
 
-    def _genGrid(self, boundary_min, boundary_max, interval):
-        '''Generate grid points
+    def _interval(self, boundary_min, boundary_max, interval=None, grid_num=10000):
+        if interval:
+            return interval
+        scale = boundary_max - boundary_min
+        # grid_num defauld is 10000
+        return (scale[0]*scale[1]*scale[2] / grid_num)**(1/3)
+
+    def _lattice(self, interval=None, grid_num=10000):
+        '''lattice of genPoints (not incremental), and its interval'''
+        boundary_min, boundary_max = self._boundary()
+        interval = self._interval(boundary_min, boundary_max, interval, grid_num)
+        return self._genLattice(boundary_min, boundary_max, interval), interval
+
+    def _boundary(self):
+        '''Overall boundary of all the model sections'''
+        min_list, max_list = zip(*[section.getBoundaryPoints() for section in self.stlmodel_list + self.mathmodel_list])
+        boundary_min = np.min(np.vstack(min_list), axis=0)
+        boundary_max = np.max(np.vstack(max_list), axis=0)
+        return boundary_min, boundary_max
+
+    def genPreviewPoints(self, grid_num=2000):
+        '''A coarse points model for preview
+        Sections are evaluated on a coarse lattice without changing any
+        state of the model or the sections, so it can be shown while the
+        fine points model is being generated.
+
+        Returns:
+            points_with_sld: ndarray, shape == (n, 4)
+            interval: float
+        '''
+        boundary_min, boundary_max = self._boundary()
+        scale = boundary_max - boundary_min
+        interval = (scale[0]*scale[1]*scale[2] / grid_num)**(1/3)
+        lattice = self._genLattice(boundary_min, boundary_max, interval)
+        sld_grid_index = np.zeros(lattice[0].size * lattice[1].size * lattice[2].size)
+        for section in self.stlmodel_list + self.mathmodel_list:
+            for begin, end, chunk in latticeChunks(lattice):
+                sld = section.calcInModel(chunk)[1]
+                np.maximum(sld_grid_index[begin:end], sld, out=sld_grid_index[begin:end])
+        index = np.where(sld_grid_index != 0)[0]
+        points_with_sld = np.hstack((latticePoints(lattice, index), sld_grid_index[index].reshape(-1, 1)))
+        return points_with_sld, interval
+
+    def _genPointsIncremental(self, interval=None, grid_num=10000, progress=None, cancel=None, pool_executor=None):
+        '''Generate points model, only recalculating the changed sections
+        Each section keeps its sld on its own box of a lattice anchored at
+        origin (see modelsection.calcInModelBox). A section is recalculated
+        only if it is new, marked dirty, or its params changed; sld change of
+        stl model only rescales its box. The combined sld grid is kept, and
+        only the regions of changed sections are combined again. When the
+        overall boundary grows, the combined grid is extended, not rebuilt.
+
+        If interval is not given, the interval of last run is kept as long
+        as grid_num is the same, so that the lattice stays stable.
+        '''
+        section_list = self.stlmodel_list + self.mathmodel_list
+        last = getattr(self, 'incremental_state', None)
+        if not interval:
+            if last is not None and last['grid_num'] == grid_num and last['interval_given'] is None:
+                interval = last['interval']
+            else:
+                min_list, max_list = zip(*[section.getBoundaryPoints() for section in section_list])
+                scale = np.max(np.vstack(max_list), axis=0) - np.min(np.vstack(min_list), axis=0)
+                interval = (scale[0]*scale[1]*scale[2] / grid_num)**(1/3)
+            interval_given = None
+        else:
+            interval_given = interval
+        if last is not None and last['interval'] != interval:
+            last = None
+
+        # recalculate changed sections
+        changed_boxes = list(self.removed_boxes)
+        self.removed_boxes = []
+        for i, section in enumerate(section_list):
+            section.ensureBox()
+            if section.isDirty(interval):
+                old_box = getattr(section, 'box', None)
+                print('recalculate {}'.format(section.name))
+                with stage('genPoints.section.{}'.format(section.name)):
+                    finished = section.calcInModelBox(interval, progress=_sectionProgress(progress, section, i, len(section_list)), cancel=cancel, pool_executor=pool_executor)
+                if not finished:
+                    # regions recalculated so far are combined in next run
+                    self.removed_boxes = changed_boxes + self.removed_boxes
+                    print('generating points cancelled')
+                    return False
+                if old_box is not None:
+                    changed_boxes.append(old_box)
+                changed_boxes.append(section.box)
+            elif section.sld_dirty:
+                section.refreshBoxSld()
+                changed_boxes.append(section.box)
+
+        kmin = np.min(np.vstack([section.box[0] for section in section_list]), axis=0)
+        kmax = np.max(np.vstack([section.box[1] for section in section_list]), axis=0)
+
+        # extend the combined grid, or start a new one
+        if last is not None and np.all(kmin <= last['kmin']) and np.all(kmax >= last['kmax']):
+            combined = np.zeros(kmax-kmin+1)
+            old_kmin, old_kmax = last['kmin'] - kmin, last['kmax'] - kmin
+            combined[old_kmin[0]:old_kmax[0]+1, old_kmin[1]:old_kmax[1]+1, old_kmin[2]:old_kmax[2]+1] = last['combined']
+        else:
+            combined = np.zeros(kmax-kmin+1)
+            changed_boxes = [(kmin, kmax)]
+
+        # combine again only in changed regions
+        # !! ATTENTION !!
+        # I choose to use the higher sld value for the overlapped point
+        for box_min, box_max in changed_boxes:
+            region_min = np.maximum(box_min, kmin)
+            region_max = np.minimum(box_max, kmax)
+            if np.any(region_min > region_max):
+                continue
+            region = tuple(slice(region_min[i]-kmin[i], region_max[i]-kmin[i]+1) for i in range(3))
+            combined[region] = 0
+            for section in section_list:
+                overlap_min = np.maximum(section.box[0], region_min)
+                overlap_max = np.minimum(section.box[1], region_max)
+                if np.any(overlap_min > overlap_max):
+                    continue
+                target = tuple(slice(overlap_min[i]-kmin[i], overlap_max[i]-kmin[i]+1) for i in range(3))
+                source = tuple(slice(overlap_min[i]-section.box[0][i], overlap_max[i]-section.box[0][i]+1) for i in range(3))
+                np.maximum(combined[target], section.box_sld[source], out=combined[target])
+
+        index = np.nonzero(combined)
+        points = (np.vstack(index).T + kmin) * interval
+        slds = combined[index].reshape(-1, 1)
+
+        self.incremental_state = {'interval': interval, 'interval_given': interval_given, 'grid_num': grid_num, 'kmin': kmin, 'kmax': kmax, 'combined': combined}
+        self.grid = None
+        self.lattice = tuple(np.arange(kmin[i], kmax[i]+1)*interval for i in range(3))
+        self.interval = interval
+        self.sld_grid_index = combined
+        self.points = points
+        self.points_with_sld = np.hstack((points, slds))
+        return True
+
+    def _combinedSld(self, points):
+        '''sld of arbitrary points combining all model sections,
+        the higher sld value is used for the overlapped point, same as genPoints
+        '''
+        sld_list = []
+        for section in self.stlmodel_list + self.mathmodel_list:
+            sld_list.append(section.calcInModel(points)[1])
+        return np.max(np.vstack(sld_list), axis=0)
+
+    def _genOctreePoints(self, boundary_min, boundary_max, interval, levels=3):
+        '''Generate weighted points by an octree that only refines at surfaces
+        Coarse cells with edge interval*2**levels cover the boundary. A cell is
+        uniform if the combined sld at its 8 corners and centre are all the
+        same, no stl surface crosses it and the sld of math models is the
+        same at all its sub cells of edge interval (see calcCrossedCells). A uniform cell becomes one point
+        at its centre, with sld weighted by cell volume / interval**3. Other
+        cells are split into 8 children down to edge interval, where the sld
+        at cell centre is used, just like the uniform grid.
+
+        Returns:
+            points_with_sld: ndarray, shape == (n, 4), last column is weighted sld
+        '''
+        section_list = self.stlmodel_list + self.mathmodel_list
+        cell_size = interval * 2**int(levels)
+        n_cells = np.maximum(np.ceil((boundary_max-boundary_min)/cell_size), 1).astype('int64')
+        index = np.indices(n_cells).reshape(3, -1).T
+        centers = boundary_min + (index+0.5)*cell_size
+        # corners of a cell with unit edge, relative to cell centre
+        offsets = np.array([[i, j, k] for i in (-0.5, 0.5) for j in (-0.5, 0.5) for k in (-0.5, 0.5)])
+
+        points_list, sld_list = [], []
+        while centers.shape[0] > 0:
+            weight = (cell_size/interval)**3
+            if cell_size <= interval*(1+1e-6):
+                # finest level
+                sld = self._combinedSld(centers)
+                points_list.append(centers[sld!=0])
+                sld_list.append(sld[sld!=0])
+                break
+            samples = np.concatenate((centers[:,None,:] + offsets[None,:,:]*cell_size, centers[:,None,:]), axis=1)  # (n, 9, 3)
+            sld = self._combinedSld(samples.reshape(-1, 3)).reshape(-1, 9)
+            uniform = np.all(sld == sld[:,-1:], axis=1)
+            for section in section_list:
+                uniform[uniform] &= ~section.calcCrossedCells(centers[uniform], cell_size, interval)
+            keep = uniform & (sld[:,-1] != 0)
+            points_list.append(centers[keep])
+            sld_list.append(weight * sld[keep,-1])
+            print('octree cell size {:.4f}: {} uniform cells, {} split'.format(cell_size, np.sum(keep), np.sum(~uniform)))
+            # split boundary cells
+            split = centers[~uniform]
+            cell_size = cell_size / 2
+            centers = (split[:,None,:] + offsets[None,:,:]*cell_size).reshape(-1, 3)
+
+        points = np.vstack(points_list)
+        slds = np.hstack(sld_list).reshape(-1, 1)
+        return np.hstack((points, slds))   # shape == (n, 4)
+
+    def _genLattice(self, boundary_min, boundary_max, interval):
+        '''Generate lattice scales (xscale, yscale, zscale) of grid
         boundary_min = np.array([xmin, ymin, zmin])
         boundary_max = np.array([xmax, ymax, zmax])
         '''
@@ -187,6 +857,14 @@ class model:
         xscale = np.linspace(xmin, xmax, num=int((xmax-xmin)/interval+1))
         yscale = np.linspace(ymin, ymax, num=int((ymax-ymin)/interval+1))
         zscale = np.linspace(zmin, zmax, num=int((zmax-zmin)/interval+1))
+        return xscale, yscale, zscale
+
+    def _genGrid(self, boundary_min, boundary_max, interval):
+        '''Generate grid points
+        boundary_min = np.array([xmin, ymin, zmin])
+        boundary_max = np.array([xmax, ymax, zmax])
+        '''
+        xscale, yscale, zscale = self._genLattice(boundary_min, boundary_max, interval)
         x, y, z = np.meshgrid(xscale, yscale, zscale)
         x, y, z = x.reshape(x.size,1), y.reshape(y.size,1), z.reshape(z.size,1)
         grid = np.hstack((x, y, z))
@@ -195,33 +873,238 @@ class model:
 
 class data:
 
-    def __init__(self, points_with_sld):
+    def __init__(self, points_with_sld, interval=None, lattice=None):
         self.points_with_sld = points_with_sld
         self.points = points_with_sld[:,:3]
         self.slds = points_with_sld[:,-1]
+        if interval is None:
+            interval = self._guessInterval()
+        self.interval = interval
+        self.lattice = lattice  # (xscale, yscale, zscale) of the points, if known
+        self.bead_levels = {}  # block -> (beads, weights), cached coarse-grained models
+
+    def _guessInterval(self):
+        '''Lattice interval from the smallest spacing of x coordinates
+        '''
+        x = np.unique(self.points[:,0])
+        dx = np.diff(x)
+        dx = dx[dx > 0]
+        if dx.size == 0:
+            return 1.
+        return float(dx.min())
+
+    def genBeads(self, block):
+        '''Coarse-grained bead model that merges block**3 voxels
+        '''
+        if block not in self.bead_levels:
+            self.bead_levels[block] = coarseGrain(self.points, self.slds, self.interval, block)
+        return self.bead_levels[block]
+
+    def chooseBlocks(self, q, qd_max=1.0, min_beads=50):
+        '''Choose the coarsest valid block size for each q
+        A bead representation is valid when q*block*interval <= qd_max.
+        Blocks are powers of 2, and too coarse levels (less than min_beads
+        beads) are not used.
+
+        Returns:
+            1darray of int, block size for each q
+        '''
+        blocks = [1]
+        block = 2
+        while block*self.interval*np.min(q) <= qd_max:
+            if self.genBeads(block)[1].size < min_beads:
+                break
+            blocks.append(block)
+            block *= 2
+        q_blocks = np.ones(q.size, dtype='int64')
+        for block in blocks:
+            q_blocks[q*block*self.interval <= qd_max] = block
+        return q_blocks
 
     def genQ(self, qmin, qmax, qnum=200, logq=False):
-        if logq:
-            q = np.logspace(np.log10(qmin), np.log10(qmax), num=qnum, base=10, dtype='float32')
-        else:
-            q = np.linspace(qmin, qmax, num=qnum, dtype='float32')
-        return q
-
-    def calcSas(self, q, lmax=50, parallel=True, cpu_usage=0.6):
-        points = self.points
-        slds = self.slds
-        if parallel:
-            I = intensity_parallel(q, points, slds, lmax, cpu_usage=cpu_usage)
+        return genQ(qmin, qmax, qnum=qnum, logq=logq)
+
+    def calcSas(self, q, lmax=50, parallel=True, cpu_usage=0.6, coarse_grain=False, qd_max=1.0, proc_num=None, pool=None, checkpoint=None, callback=None, cancel=None, backend='process'):
+        '''Calculate SAS curve
+        With coarse_grain=True, each q range is calculated from the coarsest
+        bead model that is still valid there (see chooseBlocks), and the
+        pieces are stitched into one curve. Low q then needs far fewer points.
+
+        If checkpoint (a directory) is given, each finished q slice is saved
+        there, and running again with the same inputs only calculates the
+        missing slices. See Functions.readCheckpoint for partial results.
+
+        callback(index, I_slice) is called whenever a q slice is finished,
+        index is the index in q. cancel (e.g. threading.Event) stops the
+        calculation, and I is nan where q is not finished.
+
+        backend: 'process' | 'thread' | 'serial', how q slices are run, see
+        Functions.executor. Threads share points with this process instead of
+        pickling them to each worker, which pays off for small models and
+        short calculations. proc_num (or cpu_usage) is the number of
+        processes or threads, pool an external pool of the same backend.
+        '''
+        if not parallel:
+            proc_num = 1
+            backend = 'serial'
+        if coarse_grain:
+            q_blocks = self.chooseBlocks(q, qd_max=qd_max)
         else:
-            I = intensity_parallel(q, points, slds, lmax, proc_num=1)
+            q_blocks = np.ones(q.size, dtype='int64')
+        I = np.full(q.size, np.nan, dtype='float32')
+        for block in np.unique(q_blocks):
+            if cancel is not None and cancel.is_set():
+                break
+            index = np.where(q_blocks == block)[0]
+            points, slds = self.genBeads(block)
+            correction = beadCorrection(q[index], self.interval, block) if block > 1 else np.ones(index.size)
+            block_callback = None
+            if callback is not None:
+                # slice index in this block -> index in q
+                block_callback = lambda slice_index, I_slice, index=index, correction=correction: callback(index[slice_index], I_slice * correction[slice_index])
+            I_block = intensity_parallel(q[index], points, slds, lmax, cpu_usage=cpu_usage, proc_num=proc_num, pool=pool, checkpoint=checkpoint, callback=block_callback, cancel=cancel, backend=backend)
+            if block > 1:
+                print('q {:.4f}~{:.4f}: {} beads (block={})'.format(q[index].min(), q[index].max(), slds.size, block))
+            I[index] = I_block * correction
 
         self.q = q
         self.I = I
         self.error = 0.001 * I   # 默认生成千分之一的误差，主要用于写文件的占位
         self.lmax = lmax
 
+    def calcPattern2d(self, q, rotations=None, weights=None, method='direct', oversample=2):
+        '''Oriented 2D scattering pattern |F(q)|^2, see Functions.pattern2d
+        q is ndarray with shape == (..., 3), e.g. detector pixels from
+        Functions.detectorQ. 'fft' method uses the spacing and origin of
+        self.lattice, or self.interval and origin 0 without lattice, so it
+        is not for octree points.
+
+        Attributes set:
+            q2d, I2d
+        '''
+        spacing, origin = self.interval, None
+        if self.lattice is not None:
+            # linspace of genPoints stretches the spacing of each axis a bit
+            spacing = np.array([(scale[-1]-scale[0])/(scale.size-1) if scale.size > 1 else self.interval for scale in self.lattice])
+            origin = np.array([scale[0] for scale in self.lattice])
+        self.q2d = q
+        self.I2d = pattern2d(q, self.points, self.slds, rotations=rotations, weights=weights, method=method, interval=spacing, origin=origin, oversample=oversample)
+        return self.I2d
+
+    def previewStages(self, qnum=200, lmax=50, preview_beads=1000):
+        '''Stages of calcSasProgressive, from a fast preview to the full calculation
+        First stage uses the finest bead model with at most preview_beads
+        beads, small lmax and few q, and is calculated in this process (no
+        process startup). Following stages halve the block size and raise
+        lmax and qnum down to block 2, the last one is the full calculation.
+
+        Returns:
+            list of dict, with block, lmax, qnum and parallel of each stage
+        '''
+        block = 1
+        while self.genBeads(block)[1].size > preview_beads and block < 64:
+            block *= 2
+        stages = [{'block': block, 'lmax': min(lmax, 8), 'qnum': min(qnum, 20), 'parallel': False}]
+        # intermediate stages stay on beads, full points are used only once
+        while block > 2:
+            block //= 2
+            stage_info = {'block': block, 'lmax': min(lmax, 2*stages[-1]['lmax']), 'qnum': min(qnum, 2*stages[-1]['qnum']), 'parallel': True}
+            stages.append(stage_info)
+        stages.append({'block': 1, 'lmax': lmax, 'qnum': qnum, 'parallel': True})
+        # remove repeated stages, e.g. when the model is already small
+        unique_stages = []
+        for stage_info in stages:
+            if stage_info not in unique_stages:
+                unique_stages.append(stage_info)
+        return unique_stages
+
+    def calcSasProgressive(self, qmin, qmax, qnum=200, logq=False, lmax=50, preview_beads=1000, stages=None, parallel=True, cpu_usage=0.6, proc_num=None, pool=None, callback=None, cancel=None, backend='process'):
+        '''Calculate SAS curve in stages of increasing resolution, see previewStages
+        Curves of coarse stages use bead models (with beadCorrection), and
+        are less accurate at high q, they are meant for interactive preview.
+
+        callback(i, n, q, I, stage_info) is called when stage i (of n) is finished.
+        If cancel (e.g. threading.Event) is set, it stops, and q, I of the
+        last finished stage are kept.
+        '''
+        if stages is None:
+            stages = self.previewStages(qnum=qnum, lmax=lmax, preview_beads=preview_beads)
+        for i, stage_info in enumerate(stages):
+            if cancel is not None and cancel.is_set():
+                break
+            q = genQ(qmin, qmax, qnum=stage_info['qnum'], logq=logq)
+            points, slds = self.genBeads(stage_info['block'])
+            if parallel and stage_info['parallel']:
+                I = intensity_parallel(q, points, slds, stage_info['lmax'], cpu_usage=cpu_usage, proc_num=proc_num, pool=pool, cancel=cancel, backend=backend)
+            else:
+                I = intensity_parallel(q, points, slds, stage_info['lmax'], cancel=cancel, backend='serial')
+            if np.any(np.isnan(I)):
+                break
+            if stage_info['block'] > 1:
+                I = I * beadCorrection(q, self.interval, stage_info['block'])
+            print('stage {}/{}: {} points, lmax={}, qnum={}'.format(i+1, len(stages), slds.size, stage_info['lmax'], stage_info['qnum']))
+            self.q, self.I, self.lmax = q, I, stage_info['lmax']
+            self.error = 0.001 * I   # 默认生成千分之一的误差，主要用于写文件的占位
+            if callback is not None:
+                callback(i, len(stages), q, I, stage_info)
+
+    def calcSasAdaptive(self, qmin, qmax, qnum=50, qnum_max=None, tol=0.05, logq=True, lmax=50, parallel=True, cpu_usage=0.6, proc_num=None, max_round=20, pool=None, backend='process'):
+        '''Calculate SAS curve with adaptive q sampling
+        Start from a coarse q set, then only refine where the curve changes
+        sharply (e.g. form factor minima). New q values of each round are
+        sent to the worker pool together. Stop when estimated interpolation
+        error of all intervals is below tol, or q number reaches qnum_max.
+
+        Attributes set:
+            q, I: irregular q array and its intensity
+            interpolant: callable, interpolant(q) gives I at any q in [qmin, qmax]
+        '''
+        from scipy.interpolate import PchipInterpolator
+
+        if qnum_max is None:
+            qnum_max = 8 * qnum
+        if not parallel:
+            proc_num = 1
+            backend = 'serial'
+        if proc_num is None:
+            proc_num = max(1, round(cpu_usage*cpu_count()))
+
+        def calc(q):
+            return intensity_parallel(q, self.points, self.slds, lmax, cpu_usage=cpu_usage, proc_num=proc_num, pool=pool, backend=backend)
+
+        q = self.genQ(qmin, qmax, qnum=qnum, logq=logq)
+        I = calc(q)
+        for i in range(max_round):
+            if q.size < 2:
+                # no interval to refine
+                break
+            q_new, err = refineQ(q, I, tol=tol, max_new=max(0, qnum_max-q.size), logq=logq)
+            print('round {}: {} q values, max estimated error {:.4f}'.format(i, q.size, err.max()))
+            if q_new.size == 0:
+                break
+            I_new = calc(q_new)
+            q, I = np.hstack((q, q_new)), np.hstack((I, I_new))
+            order = np.argsort(q)
+            q, I = q[order], I[order]
+
+        if q.size < 2:
+            interpolant = lambda q_interp: np.full(np.shape(q_interp), I[0] if I.size else np.nan)
+        elif logq:
+            log_interp = PchipInterpolator(np.log(q), np.log(np.maximum(I, np.finfo(np.float32).tiny)))
+            interpolant = lambda q_interp: np.exp(log_interp(np.log(q_interp)))
+        else:
+            interpolant = PchipInterpolator(q, I)
+
+        self.q = q
+        self.I = I
+        self.error = 0.001 * I
+        self.lmax = lmax
+        self.interpolant = interpolant
+
 
 if __name__ == "__main__":
+    import matplotlib.pyplot as plt
+    from Plot import *
     test = model2sas('test_torus')
     test.importFile('models\\torus.STL', sld=1)
     test.importFile('D:\Research\My_program\Model2SAS\models\SAXSholder.stl', sld=8)
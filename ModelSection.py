@@ -1,46 +1,238 @@
 # -*- coding: UTF-8 -*-
 
 import numpy as np
-from stl import mesh
-import os, sys
+import os, sys, time, inspect
+from multiprocessing import cpu_count
+from concurrent.futures import ThreadPoolExecutor
 
-from Functions import coordConvert
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
 
+from Functions import coordConvert, latticeChunks, latticePoints
+from Instrument import currentRss
 
-class stlmodel:
+
+class modelsection:
+    '''Common grid methods of stlmodel and mathmodel
+    Subclasses provide calcInModel(points) -> (in_model, sld)
+    '''
+    # results of the last calcInModelGridIndex / calcInModelBox, they are
+    # not needed to evaluate the model, so not pickled (e.g. into every
+    # chunk task sent to workers)
+    result_attributes = ('grid', 'in_model_grid_index', 'sld_grid_index', 'points', 'box_in_model', 'box_sld', 'box_loader', '_sample_points', '_sample_points_with_sld')
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        for key in self.result_attributes:
+            state.pop(key, None)
+        return state
+
+    def importGrid(self, grid):
+        self.grid = grid
+        self.lattice = None
+
+    def importLattice(self, lattice):
+        '''Use lattice (xscale, yscale, zscale) instead of a full grid,
+        then calcInModelGridIndex evaluates the model chunk by chunk
+        '''
+        self.lattice = lattice
+        self.grid = None
+
+    def calcInModelGridIndex(self, chunk_size=2**18, sld_buffer=None, keep_arrays=None, progress=None, cancel=None, pool_executor=None):
+        '''Calculate in model index for the grid or lattice
+        For lattice, coordinates are generated and evaluated chunk by chunk,
+        so peak memory of shape() and sld() does not grow with the grid.
+        If sld_buffer is given, the sld of each chunk is combined into it
+        in place, using the higher sld value for overlapped points.
+
+        keep_arrays: whether full-size in_model_grid_index, sld_grid_index
+            and points of this section are kept as attributes. Default is
+            True without sld_buffer and False with it, then nothing of the
+            grid size is allocated besides sld_buffer, and these attributes
+            are set to None.
+
+        With pool_executor (Functions.executor, e.g. of a Broker), chunks
+        of lattice are evaluated by its workers, which get this section and
+        the lattice and generate the coordinates themselves.
+
+        progress(done, total) is called after each chunk. If cancel (e.g.
+        threading.Event) is set, it stops before the next chunk and returns
+        None, attributes of this section are not changed then.
+
+        Returns:
+            in_model_grid_index, or sld_buffer if arrays are not kept,
+            None if cancelled
+        '''
+        if keep_arrays is None:
+            keep_arrays = sld_buffer is None
+        if self.lattice is None:
+            grid = self.grid
+            in_model_grid_index, sld_grid_index = self.calcInModel(grid)
+            points = grid[np.where(in_model_grid_index != 0)] # screen points in model
+            if sld_buffer is not None:
+                np.maximum(sld_buffer, sld_grid_index, out=sld_buffer)
+            if progress is not None:
+                progress(1, 1)
+        else:
+            n = self.lattice[0].size * self.lattice[1].size * self.lattice[2].size
+            chunk_num = int(np.ceil(n / chunk_size))
+            if keep_arrays:
+                in_model_grid_index = np.zeros(n, dtype='int8')
+                sld_grid_index = np.zeros(n)
+            if pool_executor is None:
+                chunks = self._calcInModelChunks(chunk_size, cancel)
+            else:
+                args = [(self, self.lattice, begin, min(begin+chunk_size, n)) for begin in range(0, n, chunk_size)]
+                chunks = pool_executor.imapUnordered(_calcInModelRange, args, cancel=cancel)
+            done = 0
+            for begin, end, in_model, sld in chunks:
+                if keep_arrays:
+                    in_model_grid_index[begin:end] = in_model
+                    sld_grid_index[begin:end] = sld
+                if sld_buffer is not None:
+                    np.maximum(sld_buffer[begin:end], sld, out=sld_buffer[begin:end])
+                done += 1
+                if progress is not None:
+                    progress(done, chunk_num)
+            if done < chunk_num:
+                return None
+            if keep_arrays:
+                points = latticePoints(self.lattice, np.where(in_model_grid_index != 0)[0])
+
+        if not keep_arrays:
+            # also release the arrays of an earlier run
+            self.in_model_grid_index = self.sld_grid_index = self.points = None
+            return sld_buffer
+        self.in_model_grid_index = in_model_grid_index
+        self.sld_grid_index = sld_grid_index
+        self.points = points
+        return in_model_grid_index  # shape == (n,)
+
+    def _calcInModelChunks(self, chunk_size, cancel=None):
+        for begin, end, chunk in latticeChunks(self.lattice, chunk_size=chunk_size):
+            if cancel is not None and cancel.is_set():
+                return
+            in_model, sld = self.calcInModel(chunk)
+            yield begin, end, in_model, sld
+
+    def calcInModelBox(self, interval, progress=None, cancel=None, pool_executor=None):
+        '''Calculate sld on the part of a stable lattice that covers this section
+        The stable lattice is anchored at origin, point (i, j, k) is at
+        (i, j, k)*interval, so results of different sections and of different
+        runs can be combined without regenerating the others.
+
+        Attributes set:
+            box: (kmin, kmax), lattice index range of this section, both included
+            box_in_model: ndarray, shape == kmax-kmin+1
+            box_sld: ndarray, shape == kmax-kmin+1
+
+        Returns:
+            bool, False if cancelled (see calcInModelGridIndex), the box is
+            not changed then
+        '''
+        boundary_min, boundary_max = self.getBoundaryPoints()
+        kmin = np.floor(np.asarray(boundary_min)/interval).astype('int64')
+        kmax = np.ceil(np.asarray(boundary_max)/interval).astype('int64')
+        lattice = tuple(np.arange(kmin[i], kmax[i]+1)*interval for i in range(3))
+        self.importLattice(lattice)
+        if self.calcInModelGridIndex(keep_arrays=True, progress=progress, cancel=cancel, pool_executor=pool_executor) is None:
+            return False
+        # flat index of lattice is in (y, x, z) order, see latticePoints
+        nx, ny, nz = kmax - kmin + 1
+        self.box = (kmin, kmax)
+        self.box_interval = interval
+        self.box_in_model = self.in_model_grid_index.reshape((ny, nx, nz)).transpose(1, 0, 2)
+        self.box_sld = self.sld_grid_index.reshape((ny, nx, nz)).transpose(1, 0, 2)
+        self.dirty = False
+        self.sld_dirty = False
+        return True
+
+    def isDirty(self, interval):
+        '''Whether box occupancy must be recalculated'''
+        return getattr(self, 'box', None) is None or self.dirty or self.box_interval != interval
+
+    def ensureBox(self):
+        '''Load box arrays saved in project file on first use'''
+        box_loader = getattr(self, 'box_loader', None)
+        if box_loader is not None:
+            self.box_in_model, self.box_sld = box_loader()
+            self.box_loader = None
+
+    def refreshBoxSld(self):
+        '''Update box_sld when only sld changed, subclasses may override'''
+        self.sld_dirty = False
+
+
+def _calcInModelRange(section, lattice, begin, end):
+    '''calcInModel of lattice points begin:end, for workers of calcInModelGridIndex'''
+    in_model, sld = section.calcInModel(latticePoints(lattice, np.arange(begin, end)))
+    return begin, end, np.asarray(in_model, dtype='int8'), np.asarray(sld, dtype='float64')
+
+
+class stlmodel(modelsection):
 
     def __init__(self, filepath, sld):
         self.filepath = os.path.abspath(filepath)
         self.name = os.path.basename(filepath)
         self.sld = sld
-        self.mesh = mesh.Mesh.from_file(filepath)
+        self.mesh = indexedmesh(filepath)
+        self.dirty = True
+
+    @property
+    def sld(self):
+        return self._sld
+
+    @sld.setter
+    def sld(self, sld):
+        # occupancy does not depend on sld, so only mark sld as changed
+        self._sld = float(sld)
+        self.sld_dirty = True
+
+    def refreshBoxSld(self):
+        self.box_sld = self.sld * self.box_in_model
+        self.sld_dirty = False
 
     def getBoundaryPoints(self):
-        vectors = self.mesh.vectors
-        xmin, xmax, ymin, ymax, zmin, zmax = np.min(vectors[:,:,0]), np.max(vectors[:,:,0]), np.min(vectors[:,:,1]), np.max(vectors[:,:,1]), np.min(vectors[:,:,2]), np.max(vectors[:,:,2])
-        return np.array([xmin, ymin, zmin]), np.array([xmax, ymax, zmax])
+        return self.mesh.boundary
 
-    def importGrid(self, grid):
-        self.grid = grid
+    def calcInModel(self, points):
+        '''Determine whether arbitrary points are inside the model
 
-    def calcInModelGridIndex(self):
-        grid = self.grid
+        Returns:
+            in_model: 1darray, shape == (n,), 1 is in, 0 is out
+            sld: 1darray, shape == (n,), sld of each point
+        '''
         vectors = self.mesh.vectors
-
         # determine whether points inside the model
         ray = np.random.rand(3) + 0.01     # in case that all coordinates are 0, which is almost impossible
-        intersect_count = np.zeros(grid.shape[0])
+        intersect_count = np.zeros(points.shape[0])
         for triangle in vectors:
-            intersect_count += self._isIntersect(grid, ray, triangle)
-        in_model_grid_index = intersect_count % 2   # 1 is in, 0 is out
-        sld_grid_index = self.sld * in_model_grid_index # the sld for each point in grid
-        points = grid[np.where(in_model_grid_index != 0)] # screen points in model
-        
-        self.in_model_grid_index = in_model_grid_index
-        self.sld_grid_index = sld_grid_index
-        self.points = points
-        return in_model_grid_index  # shape == (n,)
+            intersect_count += self._isIntersect(points, ray, triangle)
+        in_model = intersect_count % 2   # 1 is in, 0 is out
+        sld = self.sld * in_model # the sld for each point
+        return in_model, sld
+
+    def calcCrossedCells(self, cell_centers, cell_size, interval=None):
+        '''Find the cubic cells that may be crossed by model surface
+        A cell is marked when it overlaps the bounding box of any triangle.
 
+        Args:
+            cell_centers: ndarray, shape == (n, 3)
+            cell_size: float, edge length of cells
+            interval: finest cell size of the octree, not needed here
+
+        Returns:
+            1darray of bool, shape == (n,)
+        '''
+        vectors = self.mesh.vectors
+        half = cell_size / 2
+        cell_min, cell_max = cell_centers - half, cell_centers + half
+        crossed = np.zeros(cell_centers.shape[0], dtype=bool)
+        for triangle_min, triangle_max in zip(vectors.min(axis=1), vectors.max(axis=1)):
+            crossed |= np.all((cell_min <= triangle_max) & (cell_max >= triangle_min), axis=1)
+        return crossed
 
     def _isIntersect(self, origins, ray, triangle):
         '''Calculate all the points intersect with 1 triangle
@@ -77,46 +269,197 @@ class stlmodel:
 
 
 
-class mathmodel:
+class indexedmesh:
+    '''Triangle mesh read from stl file
+    Binary stl is memory mapped, so vectors and points are views of the
+    file without copy. ASCII stl is read by numpy-stl.
+
+    Attributes:
+        vectors: ndarray, shape == (n, 3, 3), vertices of each triangle
+        points: ndarray, shape == (n, 9), same data as vectors
+        normals: ndarray, shape == (n, 3)
+        boundary: (min_point, max_point), calculated in one pass
+        vertices, faces: indexed mesh with deduplicated vertices,
+            calculated on first use (e.g. by Plot.meshLod)
+        load_info: dict, load time (sec) and rss (MB) after loading
+    '''
+    binary_dtype = np.dtype([
+        ('normals', '<f4', (3,)),
+        ('vectors', '<f4', (3, 3)),
+        ('attr', '<u2'),
+    ])
+
+    def __init__(self, filepath, chunk_size=2**20):
+        begintime = time.time()
+        self.filepath = os.path.abspath(filepath)
+        n_facets = self._binaryFacetNum(self.filepath)
+        if n_facets is not None:
+            data = np.memmap(self.filepath, dtype=self.binary_dtype, mode='r', offset=84, shape=(n_facets,))
+            self.vectors = data['vectors']
+            self.normals = data['normals']
+        else:
+            from stl import mesh
+            ascii_mesh = mesh.Mesh.from_file(self.filepath)
+            self.vectors = ascii_mesh.vectors
+            self.normals = ascii_mesh.normals
+        self.points = self.vectors.reshape((-1, 9))
+        self.boundary = self._calcBoundary(chunk_size)
+        self._vertices, self._faces = None, None
+        self.load_info = {'time': time.time()-begintime, 'rss': currentRss(), 'facets': self.vectors.shape[0], 'mmap': n_facets is not None}
+
+    def __getstate__(self):
+        # points is the same data as vectors, do not pickle it twice,
+        # and the index is built again when needed
+        state = dict(self.__dict__, _vertices=None, _faces=None)
+        state.pop('points', None)
+        state.pop('lod_cache', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.points = self.vectors.reshape((-1, 9))
+
+    def _binaryFacetNum(self, filepath):
+        '''facet number if file is a valid binary stl, else None'''
+        size = os.path.getsize(filepath)
+        if size < 84:
+            return None
+        with open(filepath, 'rb') as f:
+            f.seek(80)
+            n_facets = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+        if size == 84 + 50*n_facets:
+            return n_facets
+        return None
+
+    def _calcBoundary(self, chunk_size):
+        '''min and max of all vertices in one pass over the data'''
+        boundary_min = np.full(3, np.inf)
+        boundary_max = np.full(3, -np.inf)
+        for begin in range(0, self.vectors.shape[0], chunk_size):
+            chunk = np.asarray(self.vectors[begin:begin+chunk_size]).reshape((-1, 3))
+            np.minimum(boundary_min, chunk.min(axis=0), out=boundary_min)
+            np.maximum(boundary_max, chunk.max(axis=0), out=boundary_max)
+        return boundary_min, boundary_max
+
+    def _genIndex(self):
+        # compare vertices as 12 byte keys, much faster than unique rows
+        # (+ 0.0 turns -0.0 into 0.0, so that they get the same key)
+        corners = np.ascontiguousarray(self.vectors, dtype='float32').reshape((-1, 3)) + np.float32(0)
+        keys = corners.view(np.dtype((np.void, corners.itemsize*3))).reshape(-1)
+        _, first, faces = np.unique(keys, return_index=True, return_inverse=True)
+        self._vertices = corners[first]
+        self._faces = faces.reshape((-1, 3))
+
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._genIndex()
+        return self._vertices
+
+    @property
+    def faces(self):
+        if self._faces is None:
+            self._genIndex()
+        return self._faces
+
+
+def _takesChunk(sld):
+    '''whether sld() of a math model takes the chunk as arguments'''
+    return len(inspect.signature(sld).parameters) > 0
+
+
+def _importSpecificMathmodel(filepath):
+    '''specific_mathmodel object defined in a math model file'''
+    dirname, basename = os.path.split(filepath)
+    if dirname not in sys.path:
+        sys.path.append(dirname)
+    module_name = os.path.splitext(basename)[0]
+    mathmodel_module = __import__(module_name)
+    return mathmodel_module.specific_mathmodel()
+
+
+class mathmodel(modelsection):
 
     def __init__(self, filepath):
         self.filepath = os.path.abspath(filepath)
         self.name = os.path.basename(filepath)
-        dirname, basename = os.path.split(filepath)
-        sys.path.append(dirname)
-        module_name = os.path.splitext(basename)[0]
-        mathmodel_module = __import__(module_name)
-        mathmodel_object = mathmodel_module.specific_mathmodel()
-        self.specific_mathmodel = mathmodel_object
-        self.genSamplePoints()
+        self.specific_mathmodel = _importSpecificMathmodel(self.filepath)
+        self.dirty = True
+
+    def __getstate__(self):
+        # class of specific_mathmodel lives in the model file, it is imported
+        # again from filepath when unpickled (e.g. in a worker on another node)
+        state = super().__getstate__()
+        if self.filepath is not None:
+            state['specific_mathmodel'] = dict(self.specific_mathmodel.__dict__)
+        return state
+
+    def __setstate__(self, state):
+        if state.get('filepath') is not None:
+            specific_mathmodel = _importSpecificMathmodel(state['filepath'])
+            specific_mathmodel.__dict__.update(state['specific_mathmodel'])
+            state = dict(state, specific_mathmodel=specific_mathmodel)
+        self.__dict__.update(state)
+
+    def isDirty(self, interval):
+        '''Changed params also need recalculation'''
+        params = getattr(self.specific_mathmodel, 'params', None)
+        return super().isDirty(interval) or params != getattr(self, 'box_params', None)
+
+    def calcInModelBox(self, interval, progress=None, cancel=None, pool_executor=None):
+        if not super().calcInModelBox(interval, progress=progress, cancel=cancel, pool_executor=pool_executor):
+            return False
+        self.box_params = dict(getattr(self.specific_mathmodel, 'params', {}))
+        return True
 
     def getBoundaryPoints(self):
         boundary_min = self.specific_mathmodel.boundary_min
         boundary_max = self.specific_mathmodel.boundary_max
         return boundary_min, boundary_max
 
-    def importGrid(self, grid):
-        self.grid = grid
+    def calcInModel(self, points):
+        '''Determine whether arbitrary points are inside the model
 
-    def calcInModelGridIndex(self):
-        grid = self.grid
+        Returns:
+            in_model: 1darray, shape == (n,), 1 is in, 0 is out
+            sld: 1darray, shape == (n,), sld of each point
+        '''
         specific_mathmodel = self.specific_mathmodel
-
         # change grid coords (xyz) to destination coords
         coord = specific_mathmodel.coord
-        grid_in_coord = coordConvert(grid, 'xyz', coord)
+        points_in_coord = coordConvert(points, 'xyz', coord)
+        in_model = specific_mathmodel.shape(points_in_coord)
+        if _takesChunk(specific_mathmodel.sld):
+            sld = specific_mathmodel.sld(points_in_coord, in_model)
+        else:
+            # old model files: sld() reads the state of the last shape()
+            # call, only safe when chunks are not evaluated at the same time
+            sld = specific_mathmodel.sld()
+        return in_model, sld
 
-        in_model_grid_index = specific_mathmodel.shape(grid_in_coord)
-        sld_grid_index = specific_mathmodel.sld()
-        points = grid[np.where(in_model_grid_index != 0)] # screen points in model
+    def calcCrossedCells(self, cell_centers, cell_size, interval, chunk_size=2**18):
+        '''Find the cubic cells that are not uniform in this model
+        Math models have no explicit surface, so each cell is sampled at the
+        centres of its sub cells of edge interval (the finest octree level),
+        and marked when the sld is not the same at all of them. Features
+        thinner than a cell are then still found.
 
-        self.in_model_grid_index = in_model_grid_index
-        self.sld_grid_index = sld_grid_index
-        self.points = points
-        return in_model_grid_index  # shape == (n,)
+        Returns:
+            1darray of bool, shape == (n,)
+        '''
+        m = max(1, int(round(cell_size/interval)))
+        sub = (np.arange(m)+0.5)*cell_size/m - cell_size/2
+        offsets = np.stack(np.meshgrid(sub, sub, sub, indexing='ij'), axis=-1).reshape(-1, 3)
+        crossed = np.zeros(cell_centers.shape[0], dtype=bool)
+        cells_per_chunk = max(1, chunk_size // offsets.shape[0])
+        for begin in range(0, cell_centers.shape[0], cells_per_chunk):
+            centers = cell_centers[begin:begin+cells_per_chunk]
+            samples = (centers[:,None,:] + offsets[None,:,:]).reshape(-1, 3)
+            sld = self.calcInModel(samples)[1].reshape(centers.shape[0], -1)
+            crossed[begin:begin+centers.shape[0]] = np.any(sld != sld[:,:1], axis=1)
+        return crossed
 
     def genSamplePoints(self, interval=None, grid_num=10000):
-        specific_mathmodel = self.specific_mathmodel
         # generate grid for sample points
         boundary_min = self.specific_mathmodel.boundary_min
         boundary_max = self.specific_mathmodel.boundary_max
@@ -137,21 +480,139 @@ class mathmodel:
         x, y, z = x.reshape(x.size,1), y.reshape(y.size,1), z.reshape(z.size,1)
         grid = np.hstack((x, y, z))
 
-        # change grid coords (xyz) to destination coords
-        coord = specific_mathmodel.coord
-        grid_in_coord = coordConvert(grid, 'xyz', coord)
-
-        in_model_grid_index = specific_mathmodel.shape(grid_in_coord)
-        sld_grid_index = specific_mathmodel.sld()
+        in_model_grid_index, sld_grid_index = self.calcInModel(grid)
         points = grid[np.where(in_model_grid_index != 0)] # screen points in model
         sld = sld_grid_index[np.where(sld_grid_index != 0)]
         sld = sld.reshape((sld.size, 1))
         points_with_sld = np.hstack((points, sld))
 
-        self.sample_points = points
-        self.sample_points_with_sld = points_with_sld
+        self._sample_points = points
+        self._sample_points_with_sld = points_with_sld
         return points_with_sld
 
-        
+    # sample points are only for preview, generated on first use
+    @property
+    def sample_points(self):
+        if getattr(self, '_sample_points', None) is None:
+            self.genSamplePoints()
+        return self._sample_points
+
+    @property
+    def sample_points_with_sld(self):
+        if getattr(self, '_sample_points_with_sld', None) is None:
+            self.genSamplePoints()
+        return self._sample_points_with_sld
+
+
+
+class expressionmodel(mathmodel):
+    '''A math model defined by expression strings instead of a .py file
+    It works the same way as mathmodel in model.genPoints.
+
+    Example: hollow sphere
+        expressionmodel('(r >= R1) & (r <= R2)', '15', coord='sph', params={'R1': 10, 'R2': 15}, boundary_min=[-15]*3, boundary_max=[15]*3)
+    '''
+
+    def __init__(self, shape, sld, coord='xyz', params=None, boundary_min=None, boundary_max=None, name='expression model'):
+        self.filepath = None
+        self.name = name
+        self.specific_mathmodel = compiledexpression(shape, sld, coord=coord, params=params, boundary_min=boundary_min, boundary_max=boundary_max)
+        self.dirty = True
+
+
+class compiledexpression:
+    '''specific_mathmodel compiled from expression strings
+
+    Attributes:
+        shape_expression: str, boolean expression, e.g. '(r >= R1) & (r <= R2)'
+        sld_expression: str, sld expression, e.g. '15' or '10 + 0.1*r'
+        coord: 'xyz' | 'sph' | 'cyl', variable names are
+            x, y, z | r, theta, phi | rho, theta, z
+        params: dict, parameters used in expressions
+
+    Expressions are evaluated by numexpr (fused and multi-threaded) if it is
+    installed, otherwise by numpy with the chunk split among threads. Both
+    accept the names in numpy_functions, numexpr has the same functions
+    built in, and the constants are given to it as variables.
+    '''
+    variable_names = {
+        'xyz': ('x', 'y', 'z'),
+        'sph': ('r', 'theta', 'phi'),
+        'cyl': ('rho', 'theta', 'z'),
+    }
+    numpy_functions = {
+        'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'abs': np.abs,
+        'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+        'arcsin': np.arcsin, 'arccos': np.arccos, 'arctan': np.arctan, 'arctan2': np.arctan2,
+        'where': np.where, 'pi': np.pi,
+    }
+
+    def __init__(self, shape, sld, coord='xyz', params=None, boundary_min=None, boundary_max=None):
+        if coord not in self.variable_names:
+            raise ValueError('coord must be one of {}'.format(list(self.variable_names)))
+        if boundary_min is None or boundary_max is None:
+            raise ValueError('boundary_min and boundary_max are needed for expression model')
+        self.shape_expression = str(shape)
+        self.sld_expression = str(sld)
+        self.coord = coord
+        self.params = dict(params or {})
+        self.boundary_min = np.array(boundary_min, dtype='float64')
+        self.boundary_max = np.array(boundary_max, dtype='float64')
+        self.threads = cpu_count()
+        # compile once, syntax errors are raised here
+        if numexpr is None:
+            self._shape_code = compile(self.shape_expression, '<shape>', 'eval')
+            self._sld_code = compile(self.sld_expression, '<sld>', 'eval')
+        else:
+            dummy = self._namespace(np.zeros((1, 3)))
+            numexpr.evaluate(self.shape_expression, local_dict=dummy)
+            numexpr.evaluate(self.sld_expression, local_dict=dummy)
+
+    def __getstate__(self):
+        # compiled code can not be pickled
+        state = dict(self.__dict__)
+        for key in ('_shape_code', '_sld_code'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.threads = cpu_count()
+        if numexpr is None:
+            self._shape_code = compile(self.shape_expression, '<shape>', 'eval')
+            self._sld_code = compile(self.sld_expression, '<sld>', 'eval')
+
+    def _namespace(self, points_in_coord):
+        namespace = dict(self.params)
+        for i, name in enumerate(self.variable_names[self.coord]):
+            namespace[name] = np.ascontiguousarray(points_in_coord[:, i])
+        if numexpr is not None:
+            namespace.update({name: value for name, value in self.numpy_functions.items() if not callable(value)})
+        return namespace
+
+    def _evaluate(self, expression, code, points_in_coord):
+        n = points_in_coord.shape[0]
+        if numexpr is not None:
+            value = numexpr.evaluate(expression, local_dict=self._namespace(points_in_coord))
+            return np.broadcast_to(value, (n,))
+        def evaluate(block):
+            namespace = self._namespace(block)
+            namespace['__builtins__'] = {}
+            namespace.update(self.numpy_functions)
+            return np.broadcast_to(eval(code, namespace), (block.shape[0],))
+        # numpy releases GIL in ufuncs, so split large chunks among threads
+        block_size = max(2**15, int(np.ceil(n/self.threads)))
+        if n <= block_size:
+            return evaluate(points_in_coord)
+        blocks = [points_in_coord[i:i+block_size] for i in range(0, n, block_size)]
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            return np.hstack(list(executor.map(evaluate, blocks)))
 
+    def shape(self, grid_in_coord):
+        shape_code = getattr(self, '_shape_code', None)
+        return self._evaluate(self.shape_expression, shape_code, grid_in_coord).astype('int8')
 
+    def sld(self, grid_in_coord, in_model_grid_index):
+        sld_code = getattr(self, '_sld_code', None)
+        sld = self._evaluate(self.sld_expression, sld_code, grid_in_coord)
+        return np.where(in_model_grid_index != 0, sld, 0).astype('float64')
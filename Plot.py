@@ -10,7 +10,143 @@ def genRgb(i, colormap='tab10', discrete_colormap=True):
     i = int(i)
     return colors[i%N]
 
-def plotStlMeshes(mesh_list, label_list=None, show=True, figure=None):
+########## level of detail ##########
+# Drawing cost of Axes3D grows with the number of artists, so points and
+# triangles are reduced to a budget before plotting. Preview time is then
+# bounded whatever the model size.
+
+def _guessInterval(points):
+    ''' lattice interval of a points model, the smallest nonzero spacing '''
+    spacing = []
+    for i in range(3):
+        diff = np.diff(np.unique(points[:, i]))
+        diff = diff[diff > 1e-9]
+        if diff.size > 0:
+            spacing.append(diff.min())
+    return min(spacing) if spacing else 1.0
+
+
+def surfacePointsIndex(points, interval=None):
+    ''' Index of voxels on the surface, i.e. with at least one of the
+    6 neighbours empty. Inner voxels are hidden behind them in a scatter plot.
+    '''
+    if interval is None:
+        interval = _guessInterval(points)
+    ijk = np.round((points[:, :3] - points[:, :3].min(axis=0)) / interval).astype('int64') + 1
+    shape = ijk.max(axis=0) + 2
+    key = (ijk[:, 0] * shape[1] + ijk[:, 1]) * shape[2] + ijk[:, 2]
+    occupied = np.sort(key)
+    neighbour_steps = [shape[1]*shape[2], shape[2], 1]
+    surface = np.zeros(points.shape[0], dtype=bool)
+    for step in neighbour_steps:
+        for sign in (1, -1):
+            neighbour = key + sign*step
+            position = np.minimum(np.searchsorted(occupied, neighbour), occupied.size-1)
+            surface |= occupied[position] != neighbour
+    return np.where(surface)[0]
+
+
+def downsamplePoints(points_with_sld, max_points=20000, mode='surface', interval=None, seed=0):
+    ''' Reduce points to at most max_points for plotting
+
+    Args:
+        mode: 'surface' | 'sld' | 'random'
+            'surface': only surface voxels, then random if still too many
+            'sld': stratified by sld value, every sld level keeps a share
+                of the budget, so small regions of different sld stay visible
+            'random': uniform random subset
+        interval: lattice interval, guessed from points if not given
+
+    Returns:
+        ndarray, rows of points_with_sld, in original order
+    '''
+    n = points_with_sld.shape[0]
+    if max_points is None or n <= max_points:
+        return points_with_sld
+    rng = np.random.default_rng(seed)
+    if mode == 'surface':
+        index = surfacePointsIndex(points_with_sld, interval=interval)
+        if index.size > max_points:
+            index = rng.choice(index, size=max_points, replace=False)
+    elif mode == 'sld':
+        sld = points_with_sld[:, 3]
+        levels, inverse, counts = np.unique(sld, return_inverse=True, return_counts=True)
+        if levels.size > 64:
+            # continuous sld, stratify by quantile bins
+            edges = np.quantile(sld, np.linspace(0, 1, 65)[1:-1])
+            inverse = np.searchsorted(edges, sld)
+            counts = np.bincount(inverse)
+        # half of the budget is shared equally, half by number of points
+        share = max_points / 2 / np.count_nonzero(counts) + max_points / 2 * counts / n
+        index_list = []
+        for level in np.where(counts > 0)[0]:
+            level_index = np.where(inverse == level)[0]
+            size = min(level_index.size, int(share[level]))
+            index_list.append(rng.choice(level_index, size=size, replace=False))
+        index = np.hstack(index_list)
+    else:
+        index = rng.choice(n, size=max_points, replace=False)
+    return points_with_sld[np.sort(index)]
+
+
+def _clusterMesh(vertices, faces, resolution):
+    ''' Vertex clustering decimation: vertices in the same cell of a
+    resolution**3 grid are merged into their mean, and triangles that
+    collapse or become duplicated are removed.
+    '''
+    vmin, vmax = vertices.min(axis=0), vertices.max(axis=0)
+    cell = np.maximum(vmax - vmin, 1e-12) / resolution
+    ijk = np.minimum(((vertices - vmin) / cell).astype('int64'), resolution - 1)
+    key = (ijk[:, 0] * resolution + ijk[:, 1]) * resolution + ijk[:, 2]
+    _, cluster = np.unique(key, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    centers = np.vstack([np.bincount(cluster, weights=vertices[:, i]) for i in range(3)]).T
+    centers /= np.bincount(cluster).reshape(-1, 1)
+    triangles = cluster[faces]
+    valid = (triangles[:, 0] != triangles[:, 1]) & (triangles[:, 1] != triangles[:, 2]) & (triangles[:, 0] != triangles[:, 2])
+    triangles = np.unique(np.sort(triangles[valid], axis=1), axis=0)
+    return centers[triangles].astype('float32')
+
+
+def meshLod(mesh, max_triangles=20000):
+    ''' Triangles (shape == (n, 3, 3)) of mesh reduced to max_triangles
+    Levels of detail use clustering grids of 8, 16, 32, ... cells per axis,
+    the finest level within budget is used. Levels are cached in the mesh
+    object, so showing the same mesh again costs nothing. The vertices and
+    faces of an indexed mesh are used, so each shared vertex is clustered
+    once, other meshes use the corners of every triangle.
+    '''
+    vectors = mesh.vectors
+    if max_triangles is None or len(vectors) <= max_triangles:
+        return vectors
+    cache = getattr(mesh, 'lod_cache', None)
+    if cache is None:
+        cache = {}
+        try:
+            mesh.lod_cache = cache
+        except AttributeError:
+            pass
+    if hasattr(mesh, 'faces'):
+        vertices, faces = mesh.vertices, mesh.faces
+    else:
+        vertices = np.asarray(vectors).reshape(-1, 3)
+        faces = np.arange(vertices.shape[0]).reshape(-1, 3)
+    chosen = None
+    resolution = 8
+    while resolution <= 2**12:
+        if resolution not in cache:
+            cache[resolution] = _clusterMesh(vertices, faces, resolution)
+        if len(cache[resolution]) > max_triangles:
+            break
+        chosen = cache[resolution]
+        resolution *= 2
+    return chosen if chosen is not None else cache[8]
+
+
+def plotStlMeshes(mesh_list, label_list=None, show=True, figure=None, max_triangles=20000):
+    ''' max_triangles is the total budget of all meshes, shared by their
+    triangle number, see meshLod. None means all triangles.
+    '''
     if label_list:
         use_legend = True
     else:
@@ -26,12 +162,21 @@ def plotStlMeshes(mesh_list, label_list=None, show=True, figure=None):
 
     # add the vectors to the plot
     temp = []  # for scale use
+    triangle_num = sum(len(mesh.vectors) for mesh in mesh_list)
     for i in range(len(mesh_list)):
         mesh = mesh_list[i]
-        temp.append(mesh.points.flatten())
+        if hasattr(mesh, 'boundary'):
+            # indexedmesh already knows its boundary, no need to flatten all points
+            temp.append(np.hstack(mesh.boundary))
+        else:
+            temp.append(mesh.points.flatten())
         # plot model frame mesh
+        if max_triangles is None:
+            vectors = mesh.vectors
+        else:
+            vectors = meshLod(mesh, max_triangles=max(1, int(max_triangles * len(mesh.vectors) / triangle_num)))
         Line3DCollection = mplot3d.art3d.Line3DCollection(
-            mesh.vectors,
+            vectors,
             linewidth=0.5,
             color=genRgb(i),
             label=label_list[i]
@@ -49,7 +194,8 @@ def plotStlMeshes(mesh_list, label_list=None, show=True, figure=None):
     return figure
         
 
-def plotPoints(points, show=True, figure=None):
+def plotPoints(points, show=True, figure=None, max_points=20000):
+    points = downsamplePoints(points, max_points=max_points, mode='random')
     # Create a new figure
     if figure:
         pass
@@ -69,7 +215,9 @@ def plotPoints(points, show=True, figure=None):
     return figure
 
 
-def plotPointsWithSld(points_with_sld, colormap='viridis', show=True, figure=None):
+def plotPointsWithSld(points_with_sld, colormap='viridis', show=True, figure=None, max_points=20000, downsample='surface', interval=None):
+    ''' At most max_points are plotted, see downsamplePoints for downsample modes '''
+    points_with_sld = downsamplePoints(points_with_sld, max_points=max_points, mode=downsample, interval=interval)
     # Create a new figure
     if figure:
         pass
@@ -110,3 +258,27 @@ def plotSasCurve(q, I, label=None, show=True, figure=None):
     if show:
         plt.show()
     return figure
+
+
+def plotPattern2d(qx, qy, I, colormap='viridis', show=True, figure=None):
+    ''' 2D scattering pattern in log scale, qx, qy are 1darray of pixel q '''
+    from matplotlib.colors import LogNorm
+    # Create a new figure
+    if figure:
+        pass
+    else:
+        figure = plt.figure()
+    axes = figure.add_subplot(111)
+
+    I = np.asarray(I)
+    positive = I[I > 0]
+    norm = LogNorm(vmin=positive.min(), vmax=positive.max()) if positive.size > 0 else None
+    mesh = axes.pcolormesh(qx, qy, np.where(I > 0, I, np.nan), cmap=plt.get_cmap(colormap), norm=norm, shading='auto')
+    figure.colorbar(mesh, ax=axes)
+    axes.set_aspect('equal')
+    axes.set_xlabel(r'$Q_x$ $(\AA^{-1})$')
+    axes.set_ylabel(r'$Q_y$ $(\AA^{-1})$')
+
+    if show:
+        plt.show()
+    return figure
@@ -11,6 +11,11 @@ coord is
   - 'xyz' |in (x, y, z)
   - 'sph' |in (r, theta, phi) |theta: 0~2pi ; phi: 0~pi
   - 'cyl' |in (rho, phi, z) |theta:0-2pi
+
+shape() is called on chunks of the grid, not on the whole grid at once,
+then sld() is called with the same chunk and the result of shape().
+Chunks may be evaluated at the same time in threads, so do not keep
+state of a chunk in self, and avoid building extra full-size arrays.
 '''
 
 # Don't change the class name, attributes name or method name !
@@ -32,14 +37,9 @@ class specific_mathmodel:
         R1 = self.params['R1']
         R2 = self.params['R2']
 
-        in_model_grid_index = np.zeros(points_sph.shape[0])
         r = points_sph[:, 0]
-        R1_array = R1 * np.ones_like(r)
-        R2_array = R2 * np.ones_like(r)
-        in_model_grid_index = np.sign(r-R1_array) * np.sign(R2_array-r)
-        in_model_grid_index = np.sign(in_model_grid_index+1)
-        self.in_model_grid_index = in_model_grid_index
-        return self.in_model_grid_index
-
-    def sld(self):
-        return 15 * self.in_model_grid_index
\ No newline at end of file
+        in_model_grid_index = ((r >= R1) & (r <= R2)).astype('int8')
+        return in_model_grid_index
+
+    def sld(self, grid_in_coord, in_model_grid_index):
+        return 15 * in_model_grid_index
\ No newline at end of file
@@ -80,6 +80,9 @@ class Ui_controlPanel(object):
         self.checkBox_parallel.setChecked(True)
         self.checkBox_parallel.setObjectName("checkBox_parallel")
         self.gridLayout_2.addWidget(self.checkBox_parallel, 4, 0, 1, 1)
+        self.pushButton_preview = QtWidgets.QPushButton(self.groupBox_calcSas)
+        self.pushButton_preview.setObjectName("pushButton_preview")
+        self.gridLayout_2.addWidget(self.pushButton_preview, 3, 1, 1, 2)
         self.pushButton_calcSas = QtWidgets.QPushButton(self.groupBox_calcSas)
         self.pushButton_calcSas.setObjectName("pushButton_calcSas")
         self.gridLayout_2.addWidget(self.pushButton_calcSas, 4, 1, 1, 2)
@@ -101,6 +104,10 @@ class Ui_controlPanel(object):
         self.progressBar.setProperty("value", 0)
         self.progressBar.setObjectName("progressBar")
         self.verticalLayout.addWidget(self.progressBar)
+        self.pushButton_cancel = QtWidgets.QPushButton(controlPanel)
+        self.pushButton_cancel.setEnabled(False)
+        self.pushButton_cancel.setObjectName("pushButton_cancel")
+        self.verticalLayout.addWidget(self.pushButton_cancel)
 
         self.retranslateUi(controlPanel)
         QtCore.QMetaObject.connectSlotsByName(controlPanel)
@@ -125,5 +132,7 @@ class Ui_controlPanel(object):
         self.label_7.setText(_translate("controlPanel", "OR process num"))
         self.checkBox_parallel.setText(_translate("controlPanel", "parallel"))
         self.pushButton_calcSas.setText(_translate("controlPanel", "calculate"))
+        self.pushButton_preview.setText(_translate("controlPanel", "preview"))
         self.lineEdit_cpuUsage.setText(_translate("controlPanel", "0.6"))
         self.label_8.setText(_translate("controlPanel", "Parallel Control"))
+        self.pushButton_cancel.setText(_translate("controlPanel", "cancel"))